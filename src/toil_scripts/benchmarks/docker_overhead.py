@@ -0,0 +1,97 @@
+#!/usr/bin/env python2.7
+"""
+Benchmarks the per-call overhead of toil_scripts.lib.programs.docker_call, with a new container for every call and
+with the node-local container pool (see toil_scripts.lib.docker_pool). Each call runs a command that does next to no
+work, by default `samtools --version`, so the time per call is almost entirely overhead, including the fix-up of the
+ownership of the work directory.
+
+Given a map of native tools (see toil_scripts.lib.native_tools) that maps the tool, calls are also timed with the
+native tool, which is the baseline that the overhead of the container modes can be compared to. Pass a real workload
+as the parameters to measure the overhead of a tool on the jobs it runs.
+
+    python -m toil_scripts.benchmarks.docker_overhead --calls 20 --native native-tools.yaml --output overhead.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+from toil_scripts.lib.docker_pool import ContainerPool
+from toil_scripts.lib.native_tools import native_tools
+from toil_scripts.lib.programs import docker_call
+
+
+def run_benchmark(work_root, tool, parameters, calls, native=None):
+    """
+    Times docker_call without and with a container pool, and optionally with a native tool
+
+    :param str work_root: Directory for the work directories of the calls, which is the root of the pool
+    :param str tool: Docker image
+    :param list[str] parameters: Parameters of every call
+    :param int calls: Number of calls per mode
+    :param str native: Path of a map of native tools that maps tool
+    :return: One result per mode: mode, calls, seconds per call, and for the pool the seconds of the first call, which
+             starts the pooled container
+    :rtype: list[dict]
+    """
+    subprocess.check_call(['docker', 'pull', tool])
+    results = []
+    for mode in ['run', 'pool'] + (['native'] if native else []):
+        if mode == 'pool':
+            os.environ['TOIL_SCRIPTS_DOCKER_POOL_ROOT'] = work_root
+        else:
+            os.environ.pop('TOIL_SCRIPTS_DOCKER_POOL_ROOT', None)
+        if mode == 'native':
+            os.environ['TOIL_SCRIPTS_NATIVE_TOOLS'] = native
+            assert native_tools().accepts(tool), 'No native tool for ' + tool
+        else:
+            os.environ.pop('TOIL_SCRIPTS_NATIVE_TOOLS', None)
+        elapsed = []
+        for _ in xrange(calls):
+            work_dir = tempfile.mkdtemp(dir=work_root)
+            start = time.time()
+            docker_call(tool=tool, parameters=parameters, work_dir=work_dir, check_output=True, mock=False)
+            elapsed.append(time.time() - start)
+        # The first pooled call starts the container, which later calls of the same tool on the node don't pay for
+        steady = elapsed[1:] if mode == 'pool' and calls > 1 else elapsed
+        results.append(dict(mode=mode, calls=calls, seconds_per_call=sum(steady) / len(steady),
+                            first_call=elapsed[0]))
+    os.environ.pop('TOIL_SCRIPTS_DOCKER_POOL_ROOT', None)
+    os.environ.pop('TOIL_SCRIPTS_NATIVE_TOOLS', None)
+    ContainerPool(work_root).reap(idle_timeout=0)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--tool', default='quay.io/ucsc_cgl/samtools:1.3--256539928ea162949d8a65ca5c79a72ef557ce7c',
+                        help='Docker image to call')
+    parser.add_argument('--parameters', default=['--version'], nargs='+', help='Parameters of every call')
+    parser.add_argument('--calls', default=20, type=int, help='Number of calls per mode')
+    parser.add_argument('--native', default=None, help='Map of native tools (YAML) that maps the tool, to also time '
+                                                       'calls of the native tool')
+    parser.add_argument('--work-dir', default=None, help='Directory for temporary files. Defaults to the system temp '
+                                                         'directory.')
+    parser.add_argument('--output', default=None, help='Path to write the JSON results to')
+    args = parser.parse_args()
+    work_root = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        results = run_benchmark(work_root, args.tool, args.parameters, args.calls, native=args.native)
+    finally:
+        shutil.rmtree(work_root)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(host=platform.node(), time=time.time(), tool=args.tool, results=results), f, indent=2)
+    print('{:>10} {:>10} {:>16} {:>12}'.format('mode', 'calls', 'seconds/call', 'first_call'))
+    for x in results:
+        print('{mode:>10} {calls:>10} {seconds_per_call:>16.3f} {first_call:>12.3f}'.format(**x))
+
+
+if __name__ == '__main__':
+    main()
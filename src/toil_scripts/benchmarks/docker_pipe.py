@@ -0,0 +1,113 @@
+#!/usr/bin/env python2.7
+"""
+Benchmarks toil_scripts.lib.programs.docker_pipe against chaining the same two tools through an intermediate file in
+the work directory, as pipelines did before. The first stage writes SIZE MiB of reads, the second checksums them.
+
+    Mode        Calls
+    files       docker_call(..., outfile=intermediate), then docker_call(... /data/intermediate ...)
+    pipe        docker_pipe([stage 1, stage 2])
+
+For each mode the wall time is reported with the bytes written to and read from the work directory's block device
+(from /proc/diskstats, after a sync, if the device can be found) and the size of the intermediate file.
+
+    python -m toil_scripts.benchmarks.docker_pipe --size 4096 --work-dir /mnt/ephemeral
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+from toil_scripts.lib.programs import docker_call, docker_pipe
+
+
+def run_benchmark(work_dir, size, tool='ubuntu'):
+    """
+    :param str work_dir: Work directory of the calls
+    :param int size: Size of the stream in bytes
+    :param str tool: Docker image with sh, yes, head and md5sum
+    :return: One result per mode: mode, seconds, bytes written and read on the device (None if unknown) and the
+             bytes of the intermediate file
+    :rtype: list[dict]
+    """
+    produce = dict(tool=tool, parameters=['sh', '-c', 'yes ACGTTGCAACGTTGCA | head -c {}'.format(size)])
+    results, checksums = [], []
+    for mode in ['files', 'pipe']:
+        before = _device_io(work_dir)
+        start = time.time()
+        if mode == 'files':
+            intermediate = os.path.join(work_dir, 'intermediate')
+            with open(intermediate, 'w') as f:
+                docker_call(work_dir=work_dir, outfile=f, **produce)
+            checksum = docker_call(tool=tool, parameters=['md5sum', '/data/intermediate'], work_dir=work_dir,
+                                   check_output=True)
+            intermediate_bytes = os.path.getsize(intermediate)
+        else:
+            checksum = docker_pipe([produce, dict(tool=tool, parameters=['md5sum'])], work_dir=work_dir,
+                                   check_output=True)
+            intermediate_bytes = 0
+        seconds = time.time() - start
+        # Measured before the intermediate file is removed, as it might otherwise never reach the device
+        after = _device_io(work_dir)
+        if mode == 'files':
+            os.remove(intermediate)
+        checksums.append(checksum.split()[0])
+        written, read = [b - a for a, b in zip(before, after)] if before and after else (None, None)
+        results.append(dict(mode=mode, size=size, seconds=seconds, device_written=written, device_read=read,
+                            intermediate_bytes=intermediate_bytes))
+    assert checksums[0] == checksums[1], 'Modes produced different output'
+    return results
+
+
+def _device_io(path):
+    """
+    :return: Bytes written and read by the block device of path since boot, or None if it is not a block device
+    :rtype: tuple(int, int)
+    """
+    subprocess.check_call(['sync'])
+    dev = os.stat(path).st_dev
+    try:
+        with open('/proc/diskstats') as f:
+            for line in f:
+                fields = line.split()
+                if (int(fields[0]), int(fields[1])) == (os.major(dev), os.minor(dev)):
+                    # Sectors are 512 bytes, whatever the device's sector size
+                    return int(fields[9]) * 512, int(fields[5]) * 512
+    except IOError:
+        pass
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--size', default=1024, type=int, help='Size of the stream in MiB')
+    parser.add_argument('--tool', default='ubuntu', help='Docker image with sh, yes, head and md5sum')
+    parser.add_argument('--work-dir', default=None, help='Directory for temporary files. Defaults to the system temp '
+                                                         'directory.')
+    parser.add_argument('--output', default=None, help='Path to write the JSON results to')
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        results = run_benchmark(work_dir, args.size * 1024 * 1024, tool=args.tool)
+    finally:
+        shutil.rmtree(work_dir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(host=platform.node(), time=time.time(), results=results), f, indent=2)
+    mib = 1024.0 * 1024
+
+    def fmt(value):
+        return 'n/a' if value is None else '{:.1f}'.format(value / mib)
+    print('{:>8} {:>10} {:>14} {:>14} {:>18}'.format('mode', 'seconds', 'written_MiB', 'read_MiB', 'intermediate_MiB'))
+    for x in results:
+        print('{:>8} {:>10.2f} {:>14} {:>14} {:>18}'.format(x['mode'], x['seconds'], fmt(x['device_written']),
+                                                           fmt(x['device_read']), fmt(x['intermediate_bytes'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python2.7
+"""
+Benchmarks the in-process QC engine of toil_scripts.lib.fastq_qc against FastQC on the same paired reads, as run by
+toil_scripts.tools.QC.run_fastq_qc and run_fastqc. Unless FASTQ files are given, a pair of uncompressed FASTQs of
+READS random reads each is generated, with qualities that fall along the read and an adapter in a few percent of them.
+
+    Mode        Calls
+    python      fastq_qc_files([R1, R2], ...): one worker process per mate
+    fastqc      docker_call(fastqc, [R1, -t, 2, R2])
+
+For each mode the wall time is reported with the throughput in MiB of FASTQ per second.
+
+    python -m toil_scripts.benchmarks.fastq_qc --reads 2000000 --length 100
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+from toil_scripts.lib.fastq_qc import fastq_qc_files
+from toil_scripts.lib.programs import docker_call
+
+FASTQC = 'quay.io/ucsc_cgl/fastqc:0.11.5--be13567d00cd4c586edf8ae47d991815c8c72a49'
+ADAPTER = 'AGATCGGAAGAGCACACGTCTGAACTCCAGTCAC'
+
+
+def run_benchmark(work_dir, r1, r2, modes=('python', 'fastqc')):
+    """
+    :param str work_dir: Work directory of the runs, which contains the FASTQs
+    :param str r1: Name of the FASTQ of read 1 in the work directory
+    :param str r2: Name of the FASTQ of read 2 in the work directory
+    :param tuple(str) modes: Modes to run
+    :return: One result per mode: mode, seconds and bytes of FASTQ
+    :rtype: list[dict]
+    """
+    size = sum(os.path.getsize(os.path.join(work_dir, x)) for x in [r1, r2])
+    results = []
+    for mode in modes:
+        output_dir = tempfile.mkdtemp(dir=work_dir)
+        start = time.time()
+        if mode == 'python':
+            fastq_qc_files([os.path.join(work_dir, r1), os.path.join(work_dir, r2)], output_dir, names=['R1', 'R2'])
+        else:
+            docker_call(tool=FASTQC, work_dir=work_dir, parameters=[
+                '-o', '/data/' + os.path.basename(output_dir), '/data/' + r1, '-t', '2', '/data/' + r2])
+        results.append(dict(mode=mode, seconds=time.time() - start, size=size))
+        shutil.rmtree(output_dir)
+    return results
+
+
+def write_reads(path, num_reads, length, seed=0):
+    """
+    :param str path: Path of the FASTQ to write
+    :param int num_reads: Number of reads
+    :param int length: Length of the reads
+    :param int seed: Seed of the reads
+    """
+    rng = random.Random(seed)
+    # Phred scores that fall from 40 to 20 along the read
+    quality = ''.join(chr(33 + 40 - 20 * i // length) for i in xrange(length))
+    with open(path, 'w') as f:
+        for i in xrange(num_reads):
+            sequence = ''.join(rng.choice('ACGT') for _ in xrange(length))
+            if rng.random() < 0.05:
+                cut = rng.randrange(length)
+                sequence = (sequence[:cut] + ADAPTER + sequence[cut + len(ADAPTER):])[:length]
+            f.write('@read{}\n{}\n+\n{}\n'.format(i, sequence, quality))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--reads', default=1000000, type=int, help='Number of reads per mate to generate')
+    parser.add_argument('--length', default=100, type=int, help='Length of the generated reads')
+    parser.add_argument('--fastq', default=None, nargs=2, metavar=('R1', 'R2'),
+                        help='Uncompressed FASTQs to use instead of generated reads')
+    parser.add_argument('--skip-fastqc', action='store_true', help='Only run the python engine, e.g. without Docker')
+    parser.add_argument('--work-dir', default=None, help='Directory for temporary files. Defaults to the system temp '
+                                                         'directory.')
+    parser.add_argument('--output', default=None, help='Path to write the JSON results to')
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        for i, name in enumerate(['R1.fastq', 'R2.fastq']):
+            if args.fastq:
+                shutil.copy(args.fastq[i], os.path.join(work_dir, name))
+            else:
+                write_reads(os.path.join(work_dir, name), args.reads, args.length, seed=i)
+        modes = ('python',) if args.skip_fastqc else ('python', 'fastqc')
+        results = run_benchmark(work_dir, 'R1.fastq', 'R2.fastq', modes=modes)
+    finally:
+        shutil.rmtree(work_dir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(host=platform.node(), time=time.time(), results=results), f, indent=2)
+    mib = 1024.0 * 1024
+    print('{:>8} {:>10} {:>10} {:>10}'.format('mode', 'MiB', 'seconds', 'MiB/s'))
+    for x in results:
+        print('{:>8} {:>10.1f} {:>10.2f} {:>10.1f}'.format(x['mode'], x['size'] / mib, x['seconds'],
+                                                          x['size'] / mib / x['seconds']))
+
+
+if __name__ == '__main__':
+    main()
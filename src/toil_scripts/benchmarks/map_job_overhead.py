@@ -0,0 +1,93 @@
+#!/usr/bin/env python2.7
+"""
+Benchmarks the job store overhead of toil_scripts.lib.jobs.map_job: one job per sample under a tree of partition
+jobs (the default), batches of samples per job, and lanes that cap the samples in flight. Each sample does no work
+beyond an optional sleep, so the time is almost entirely the overhead of scheduling jobs through the job store.
+
+For each mode the wall time of the workflow is reported with the number of jobs Toil ran, from its statistics.
+
+    python -m toil_scripts.benchmarks.map_job_overhead --samples 2000 --batch-size 50 --max-in-flight 16
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+from toil.common import Toil
+from toil.job import Job
+from toil.utils.toilStats import getStats
+
+from toil_scripts.lib.jobs import map_job
+
+
+def run_benchmark(work_root, num_samples, batch_size, max_in_flight, seconds=0.0):
+    """
+    :param str work_root: Directory for the job stores and work directories of the runs
+    :param int num_samples: Number of samples
+    :param int batch_size: Samples per job in batched mode
+    :param int max_in_flight: Samples in flight in capped mode
+    :param float seconds: Time each sample sleeps
+    :return: One result per mode: mode, samples, seconds and number of jobs
+    :rtype: list[dict]
+    """
+    modes = [('per_sample', {}),
+             ('batched', dict(batch_size=batch_size)),
+             ('capped', dict(max_in_flight=max_in_flight)),
+             ('batched_capped', dict(batch_size=batch_size, max_in_flight=max_in_flight))]
+    # Workers cannot import functions of __main__, so the sample function is taken from the module by its name
+    from toil_scripts.benchmarks.map_job_overhead import _sample
+    results = []
+    for mode, kwargs in modes:
+        work_dir = tempfile.mkdtemp(dir=work_root)
+        job_store = os.path.join(work_dir, 'job_store')
+        options = Job.Runner.getDefaultOptions(job_store)
+        options.workDir = work_dir
+        options.stats = True
+        options.clean = 'never'
+        options.logLevel = 'WARNING'
+        root = Job.wrapJobFn(map_job, _sample, range(num_samples), seconds, disk='1M', **kwargs)
+        start = time.time()
+        Job.Runner.startToil(root, options)
+        elapsed = time.time() - start
+        stats = getStats(Toil.resumeJobStore('file:' + job_store))
+        jobs = sum(len(x) for x in stats.jobs if x)
+        results.append(dict(mode=mode, samples=num_samples, seconds=elapsed, jobs=jobs, options=kwargs))
+        shutil.rmtree(work_dir)
+    return results
+
+
+def _sample(job, sample, seconds):
+    time.sleep(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--samples', default=1000, type=int, help='Number of samples')
+    parser.add_argument('--batch-size', default=50, type=int, help='Samples per job in the batched modes')
+    parser.add_argument('--max-in-flight', default=16, type=int, help='Samples in flight in the capped modes')
+    parser.add_argument('--sleep', default=0.0, type=float, help='Seconds each sample sleeps')
+    parser.add_argument('--work-dir', default=None, help='Directory for the job stores. Defaults to the system temp '
+                                                         'directory.')
+    parser.add_argument('--output', default=None, help='Path to write the JSON results to')
+    args = parser.parse_args()
+    work_root = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        results = run_benchmark(work_root, args.samples, args.batch_size, args.max_in_flight, seconds=args.sleep)
+    finally:
+        shutil.rmtree(work_root)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(host=platform.node(), time=time.time(), results=results), f, indent=2)
+    print('{:>16} {:>10} {:>10} {:>10} {:>14}'.format('mode', 'samples', 'jobs', 'seconds', 'ms/sample'))
+    for x in results:
+        print('{:>16} {:>10} {:>10} {:>10.1f} {:>14.1f}'.format(x['mode'], x['samples'], x['jobs'], x['seconds'],
+                                                               1000 * x['seconds'] / x['samples']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python2.7
+"""
+Benchmarks S3 downloads in toil_scripts.lib.urls against a local S3 stand-in.
+A single stream (num_cores=1) is the baseline for the ranged, multi-part downloads.
+
+    python -m toil_scripts.benchmarks.s3_download --size 1024 --num-cores 1 2 4 8
+"""
+from __future__ import print_function
+
+import argparse
+import filecmp
+import os
+import shutil
+import tempfile
+import time
+
+from toil_scripts.benchmarks.s3_standin import S3StandIn, create_object
+from toil_scripts.lib.urls import download_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--size', default=256, type=int, help='Size of the test object in MiB')
+    parser.add_argument('--part-size', default=50, type=int, help='Size of each byte range in MiB')
+    parser.add_argument('--num-cores', default=[1, 2, 4, 8], type=int, nargs='+',
+                        help='Numbers of concurrent byte ranges to benchmark')
+    parser.add_argument('--repeat', default=3, type=int, help='Runs per configuration, the fastest is reported')
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp()
+    try:
+        root = os.path.join(work_dir, 'store')
+        src = create_object(root, 'bench', 'object', args.size * 1024 * 1024)
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'standin')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'standin')
+        with S3StandIn(root) as endpoint:
+            os.environ['TOIL_SCRIPTS_S3_ENDPOINT'] = endpoint
+            print('{:>10} {:>10} {:>10}'.format('num_cores', 'seconds', 'MiB/s'))
+            for num_cores in args.num_cores:
+                elapsed = []
+                for _ in xrange(args.repeat):
+                    start = time.time()
+                    dst = download_url('s3://bench/object', work_dir=work_dir, name='download',
+                                       part_size=args.part_size * 1024 * 1024, num_cores=num_cores)
+                    elapsed.append(time.time() - start)
+                    assert filecmp.cmp(src, dst, shallow=False)
+                    os.remove(dst)
+                print('{:>10} {:>10.2f} {:>10.1f}'.format(num_cores, min(elapsed), args.size / min(elapsed)))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+from bd2k.util.files import mkdir_p
+
+
+class S3StandIn(object):
+    """
+    Minimal S3-compatible object store that serves a local directory over HTTP, for benchmarks and tests.
+    Objects live at root/BUCKET/KEY and are addressed path-style (http://host:port/BUCKET/KEY).
+    Requests are not authenticated and SSE-C headers are ignored. Supported: HEAD and GET (with Range) of objects,
+    bucket listings (by prefix), bucket locations, PUT of objects, and multipart uploads (initiate, upload part,
+    list parts, list uploads, complete and abort). Parts of uploads in progress are kept in root/.uploads/UPLOAD_ID/.
+
+    Usage:
+        with S3StandIn(root) as endpoint:
+            os.environ['TOIL_SCRIPTS_S3_ENDPOINT'] = endpoint
+    """
+    def __init__(self, root, port=0):
+        """
+        :param str root: Directory that holds one subdirectory per bucket
+        :param int port: Port to listen on. If 0, a free port is chosen.
+        """
+        self.root = root
+        self.server = _ThreadingHTTPServer(('127.0.0.1', port), _S3Handler)
+        self.server.root = root
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.endpoint
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _S3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    chunk_size = 1024 * 1024
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._get(send_body=False)
+
+    def do_GET(self):
+        self._get(send_body=True)
+
+    def do_PUT(self):
+        path = self._path()
+        if path is None:
+            return self._send_status(400)
+        query = self._query()
+        if 'uploadId' in query:
+            upload_dir = self._upload_dir(query['uploadId'])
+            if not os.path.isdir(upload_dir):
+                return self._send_status(404)
+            path = os.path.join(upload_dir, query['partNumber'])
+        mkdir_p(os.path.dirname(path))
+        md5 = hashlib.md5()
+        remaining = int(self.headers.getheader('content-length', 0))
+        with open(path, 'wb') as f:
+            while remaining:
+                data = self.rfile.read(min(self.chunk_size, remaining))
+                md5.update(data)
+                f.write(data)
+                remaining -= len(data)
+        self.send_response(200)
+        self.send_header('ETag', '"{}"'.format(md5.hexdigest()))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        bucket, key = self._bucket_and_key()
+        query = self._query()
+        # Request bodies (e.g. the part list of a completion) are not needed, parts are taken from disk
+        self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            mkdir_p(self._upload_dir(upload_id))
+            with open(os.path.join(self._upload_dir(upload_id), 'key'), 'w') as f:
+                f.write('{}/{}'.format(bucket, key))
+            self._send_xml('<InitiateMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key><UploadId>{}</UploadId>'
+                           '</InitiateMultipartUploadResult>'.format(bucket, key, upload_id))
+        elif 'uploadId' in query:
+            upload_dir = self._upload_dir(query['uploadId'])
+            if not os.path.isdir(upload_dir):
+                return self._send_status(404)
+            path = self._path()
+            mkdir_p(os.path.dirname(path))
+            with open(path, 'wb') as f_out:
+                for part_number, _, _ in self._parts(upload_dir):
+                    with open(os.path.join(upload_dir, str(part_number)), 'rb') as f_in:
+                        shutil.copyfileobj(f_in, f_out, self.chunk_size)
+            shutil.rmtree(upload_dir)
+            self._send_xml('<CompleteMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key><ETag>"{}"</ETag>'
+                           '</CompleteMultipartUploadResult>'.format(bucket, key, _md5(path)))
+        else:
+            self._send_status(400)
+
+    def do_DELETE(self):
+        query = self._query()
+        if 'uploadId' in query:
+            shutil.rmtree(self._upload_dir(query['uploadId']), ignore_errors=True)
+        elif self._path() and os.path.isfile(self._path()):
+            os.remove(self._path())
+        self._send_status(204)
+
+    def _get(self, send_body):
+        bucket, key = self._bucket_and_key()
+        if not os.path.isdir(os.path.join(self.server.root, bucket)):
+            return self._send_status(404)
+        query = self._query()
+        if 'location' in query:
+            return self._send_xml('<LocationConstraint xmlns="http://s3.amazonaws.com/doc/2006-03-01/"/>', send_body)
+        if 'uploads' in query:
+            uploads = []
+            uploads_dir = os.path.join(self.server.root, '.uploads')
+            for upload_id in os.listdir(uploads_dir) if os.path.isdir(uploads_dir) else []:
+                with open(os.path.join(uploads_dir, upload_id, 'key')) as f:
+                    upload_bucket, upload_key = f.read().split('/', 1)
+                if upload_bucket == bucket:
+                    uploads.append('<Upload><Key>{}</Key><UploadId>{}</UploadId></Upload>'.format(upload_key,
+                                                                                                  upload_id))
+            return self._send_xml('<ListMultipartUploadsResult><Bucket>{}</Bucket>{}<IsTruncated>false</IsTruncated>'
+                                  '</ListMultipartUploadsResult>'.format(bucket, ''.join(uploads)), send_body)
+        if 'uploadId' in query:
+            upload_dir = self._upload_dir(query['uploadId'])
+            if not os.path.isdir(upload_dir):
+                return self._send_status(404)
+            parts = ''.join('<Part><PartNumber>{}</PartNumber><ETag>"{}"</ETag><Size>{}</Size></Part>'.format(*part)
+                            for part in self._parts(upload_dir))
+            return self._send_xml('<ListPartsResult><Bucket>{}</Bucket><Key>{}</Key><UploadId>{}</UploadId>{}'
+                                  '<IsTruncated>false</IsTruncated></ListPartsResult>'.format(
+                                      bucket, key, query['uploadId'], parts), send_body)
+        if not key:
+            return self._send_xml('<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/"><Name>{}</Name>'
+                                  '{}<IsTruncated>false</IsTruncated></ListBucketResult>'.format(
+                                      bucket, ''.join(self._contents(bucket, query.get('prefix', '')))), send_body)
+        path = self._path()
+        if not os.path.isfile(path):
+            return self._send_status(404)
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.getheader('range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                return self._send_status(416)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('ETag', '"{}"'.format(_md5(path)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if send_body:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining:
+                    data = f.read(min(self.chunk_size, remaining))
+                    self.wfile.write(data)
+                    remaining -= len(data)
+
+    def _contents(self, bucket, prefix):
+        """
+        :return: Listing entries of the objects in a bucket whose key starts with prefix, in key order
+        :rtype: list[str]
+        """
+        bucket_dir = os.path.join(self.server.root, bucket)
+        keys = []
+        for root, _, files in os.walk(bucket_dir):
+            keys.extend(os.path.relpath(os.path.join(root, name), bucket_dir) for name in files)
+        return ['<Contents><Key>{}</Key><Size>{}</Size><ETag>"{}"</ETag></Contents>'.format(
+                key, os.path.getsize(os.path.join(bucket_dir, key)), _md5(os.path.join(bucket_dir, key)))
+                for key in sorted(keys) if key.startswith(prefix)]
+
+    def _query(self):
+        return {k: v[0] for k, v in parse_qs(urlparse(self.path).query, keep_blank_values=True).iteritems()}
+
+    def _upload_dir(self, upload_id):
+        return os.path.join(self.server.root, '.uploads', os.path.basename(upload_id))
+
+    @staticmethod
+    def _parts(upload_dir):
+        """
+        :return: Part number, MD5 and size of every uploaded part, in order
+        :rtype: list[tuple(int, str, int)]
+        """
+        part_numbers = sorted(int(name) for name in os.listdir(upload_dir) if name.isdigit())
+        return [(n, _md5(os.path.join(upload_dir, str(n))), os.path.getsize(os.path.join(upload_dir, str(n))))
+                for n in part_numbers]
+
+    def _send_xml(self, body, send_body=True):
+        body = '<?xml version="1.0" encoding="UTF-8"?>' + body
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _bucket_and_key(self):
+        parts = urlparse(self.path).path.lstrip('/').split('/', 1)
+        return parts[0], parts[1] if len(parts) == 2 else ''
+
+    def _path(self):
+        bucket, key = self._bucket_and_key()
+        if not bucket or not key:
+            return None
+        return os.path.join(self.server.root, bucket, key)
+
+    def _send_status(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+_md5_cache = {}
+
+
+def _md5(path):
+    """
+    MD5 of a file, cached by path and modification time since benchmark objects can be large
+
+    :param str path: Path to file
+    :return: Hex digest
+    :rtype: str
+    """
+    stat = os.stat(path)
+    cache_key = (path, stat.st_mtime, stat.st_size)
+    if cache_key not in _md5_cache:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), ''):
+                md5.update(block)
+        _md5_cache[cache_key] = md5.hexdigest()
+    return _md5_cache[cache_key]
+
+
+def create_object(root, bucket, key, size):
+    """
+    Creates an object of random bytes in the stand-in's directory
+
+    :param str root: Stand-in root directory
+    :param str bucket: Bucket name
+    :param str key: Key name
+    :param int size: Size of object in bytes
+    :return: Path to the object
+    :rtype: str
+    """
+    path = os.path.join(root, bucket, key)
+    mkdir_p(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            block = os.urandom(min(remaining, 1024 * 1024))
+            f.write(block)
+            remaining -= len(block)
+    return path
+
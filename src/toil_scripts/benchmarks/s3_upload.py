@@ -0,0 +1,55 @@
+#!/usr/bin/env python2.7
+"""
+Benchmarks multipart uploads by toil_scripts.lib.urls.s3am_upload against a local S3 stand-in.
+
+    python -m toil_scripts.benchmarks.s3_upload --size 1024 --num-cores 1 2 4 8
+"""
+from __future__ import print_function
+
+import argparse
+import filecmp
+import os
+import shutil
+import tempfile
+import time
+
+from bd2k.util.files import mkdir_p
+
+from toil_scripts.benchmarks.s3_standin import S3StandIn, create_object
+from toil_scripts.lib.urls import s3am_upload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--size', default=256, type=int, help='Size of the test file in MiB')
+    parser.add_argument('--part-size', default=50, type=int, help='Size of each part in MiB')
+    parser.add_argument('--num-cores', default=[1, 2, 4, 8], type=int, nargs='+',
+                        help='Numbers of concurrent part uploads to benchmark')
+    parser.add_argument('--repeat', default=3, type=int, help='Runs per configuration, the fastest is reported')
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp()
+    try:
+        src = create_object(work_dir, 'local', 'upload_file', args.size * 1024 * 1024)
+        root = os.path.join(work_dir, 'store')
+        mkdir_p(os.path.join(root, 'bench'))
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'standin')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'standin')
+        with S3StandIn(root) as endpoint:
+            os.environ['TOIL_SCRIPTS_S3_ENDPOINT'] = endpoint
+            print('{:>10} {:>10} {:>10}'.format('num_cores', 'seconds', 'MiB/s'))
+            for num_cores in args.num_cores:
+                elapsed = []
+                for _ in xrange(args.repeat):
+                    start = time.time()
+                    s3am_upload(src, 's3://bench/dir', num_cores=num_cores, part_size=args.part_size * 1024 * 1024)
+                    elapsed.append(time.time() - start)
+                    dst = os.path.join(root, 'bench', 'dir', 'upload_file')
+                    assert filecmp.cmp(src, dst, shallow=False)
+                    os.remove(dst)
+                print('{:>10} {:>10.2f} {:>10.1f}'.format(num_cores, min(elapsed), args.size / min(elapsed)))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
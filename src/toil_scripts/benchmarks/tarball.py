@@ -0,0 +1,70 @@
+#!/usr/bin/env python2.7
+"""
+Benchmarks toil_scripts.lib.files.tarball_files against a single-core tarfile.open(..., 'w:gz').
+
+    python -m toil_scripts.benchmarks.tarball --size 1024 --num-cores 1 2 4 8
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+from toil_scripts.lib.files import tarball_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--size', default=256, type=int, help='Size of the test file in MiB')
+    parser.add_argument('--num-cores', default=[1, 2, 4, 8], type=int, nargs='+',
+                        help='Numbers of concurrently compressed blocks to benchmark')
+    parser.add_argument('--compression', default='gz', choices=['gz', 'zst'], help='Compression of tarball_files')
+    parser.add_argument('--repeat', default=3, type=int, help='Runs per configuration, the fastest is reported')
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(work_dir, 'input')
+        _create_input(src, args.size * 1024 * 1024)
+        out = os.path.join(work_dir, 'out.tar.gz')
+        print('{:>10} {:>10} {:>10} {:>10}'.format('num_cores', 'seconds', 'MiB/s', 'ratio'))
+
+        def report(label, func):
+            elapsed = []
+            for _ in xrange(args.repeat):
+                start = time.time()
+                func()
+                elapsed.append(time.time() - start)
+            print('{:>10} {:>10.2f} {:>10.1f} {:>10.3f}'.format(label, min(elapsed), args.size / min(elapsed),
+                                                                 float(os.path.getsize(out)) / os.path.getsize(src)))
+            os.remove(out)
+
+        def baseline():
+            with tarfile.open(out, 'w:gz') as f_out:
+                f_out.add(src, arcname='input')
+
+        report('tarfile', baseline)
+        for num_cores in args.num_cores:
+            report(num_cores, lambda: tarball_files('out.tar.gz', [src], output_dir=work_dir, num_cores=num_cores,
+                                                    compression=args.compression))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def _create_input(path, size):
+    """
+    Creates a compressible input: lines of text made of random words, similar to the quantification tables and VCFs
+    that are tarred by the pipelines
+    """
+    words = [os.urandom(4).encode('hex') for _ in xrange(1000)]
+    with open(path, 'wb') as f:
+        block = '\n'.join('\t'.join(words[(i * 7 + j) % len(words)] for j in xrange(10)) for i in xrange(10000))
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python2.7
+"""
+Summarizes the telemetry log of a run (see toil_scripts.lib.telemetry), per tool, calling job function and backend
+(docker, native or pull) by default.
+Use the peak memory, CPU time and work directory growth of each job function to size its cores, memory and disk.
+
+    TOIL_SCRIPTS_TELEMETRY=/shared/run1.jsonl toil-rnaseq run ...
+    python -m toil_scripts.benchmarks.telemetry /shared/run1.jsonl --by job_function
+"""
+from __future__ import print_function
+
+import argparse
+import json
+
+from toil_scripts.lib.telemetry import read_records, summarize
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('log', help='Telemetry log of a run')
+    parser.add_argument('--by', default=['tool', 'job_function', 'backend'], nargs='+',
+                        help='Record fields to group by, e.g. tool, job_function, uuid or host')
+    parser.add_argument('--json', action='store_true', help='Print the summaries as JSON')
+    args = parser.parse_args()
+    summaries = summarize(read_records(args.log), key=tuple(args.by))
+    if args.json:
+        print(json.dumps(summaries, indent=2, sort_keys=True))
+        return
+    gib = 1024.0 ** 3
+    print('{:>6} {:>6} {:>12} {:>10} {:>12} {:>10} {:>10} {:>10}  {}'.format(
+        'calls', 'failed', 'wall_total', 'wall_max', 'cpu_total', 'mem_GiB', 'io_GiB', 'disk_GiB', ' '.join(args.by)))
+    for x in summaries:
+        io = (x['max_read_bytes'] or 0) + (x['max_write_bytes'] or 0)
+        print('{:>6} {:>6} {:>12.1f} {:>10.1f} {:>12.1f} {:>10.2f} {:>10.2f} {:>10.2f}  {}'.format(
+            x['calls'], x['failures'], x['total_wall_seconds'], x['max_wall_seconds'] or 0, x['total_cpu_seconds'],
+            (x['max_peak_memory'] or 0) / gib, io / gib, (x['max_work_dir_growth'] or 0) / gib,
+            ' '.join(str(x[field]) for field in args.by)))
+
+
+if __name__ == '__main__':
+    main()
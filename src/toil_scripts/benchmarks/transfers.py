@@ -0,0 +1,206 @@
+#!/usr/bin/env python2.7
+"""
+Benchmarks the transfer paths of toil_scripts.lib.urls against local stand-ins, over a range of file sizes and
+concurrency levels. The S3 stand-in serves both the s3:// URLs and the plain HTTP URLs (SSE-C headers are ignored).
+
+    Path        Function                                    Source / destination
+    http        download_url                                http://127.0.0.1:PORT/bench/OBJECT
+    s3          download_url                                s3://bench/OBJECT
+    sse-c       download_url(s3_key_path=...)               http://127.0.0.1:PORT/bench/OBJECT
+    upload      s3am_upload                                 s3://bench/upload/
+    sse-c-up    s3am_upload(s3_key_path=...)                s3://bench/upload/
+
+Every run is made in a forked child process so that its CPU time (user + system) and peak RSS can be measured.
+The stand-ins run in the parent, so their cost is not included. Results are written as JSON to --output and can be
+compared with a previous results file with --baseline, which exits with status 1 if any configuration is slower
+than the baseline by more than --tolerance.
+
+    python -m toil_scripts.benchmarks.transfers --sizes 1M 100M 1G 10G 50G --num-cores 1 4 8 16 \\
+        --output results.json --baseline previous.json
+"""
+from __future__ import print_function
+
+import argparse
+import filecmp
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+from bd2k.util.files import mkdir_p
+from bd2k.util.humanize import human2bytes
+
+from toil_scripts.benchmarks.s3_standin import S3StandIn, create_object
+from toil_scripts.lib.urls import download_url, s3am_upload
+
+transfer_paths = ['http', 's3', 'sse-c', 'upload', 'sse-c-up']
+
+
+def run_benchmarks(work_dir, sizes, num_cores, paths=transfer_paths, part_size=50 * 1024 * 1024, repeat=1):
+    """
+    Runs every transfer path for every combination of file size and concurrency level
+
+    :param str work_dir: Directory for the stand-in objects and the transferred files
+    :param list[int] sizes: File sizes in bytes
+    :param list[int] num_cores: Numbers of concurrent transfers (byte ranges or parts)
+    :param list[str] paths: Transfer paths to benchmark, see module docstring
+    :param int part_size: Size in bytes of each byte range or part
+    :param int repeat: Runs per configuration, the fastest is reported
+    :return: One result per configuration: path, size, num_cores, seconds, MiB/s, cpu_seconds and peak_rss (bytes)
+    :rtype: list[dict]
+    """
+    root = os.path.join(work_dir, 'store')
+    mkdir_p(os.path.join(root, 'bench'))
+    key_path = os.path.join(work_dir, 'master.key')
+    with open(key_path, 'wb') as f:
+        f.write(os.urandom(32))
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'standin')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'standin')
+    results = []
+    with S3StandIn(root) as endpoint:
+        os.environ['TOIL_SCRIPTS_S3_ENDPOINT'] = endpoint
+        for size in sizes:
+            name = 'object_{}'.format(size)
+            src = create_object(root, 'bench', name, size)
+            for path in paths:
+                transfer, dst = _transfer(path, endpoint, name, work_dir, key_path, part_size)
+                for n in num_cores:
+                    runs = []
+                    for _ in xrange(repeat):
+                        runs.append(_measure(lambda: transfer(n)))
+                        assert filecmp.cmp(src, dst, shallow=False), 'Transferred file differs from source'
+                        os.remove(dst)
+                    seconds, cpu_seconds, peak_rss = min(runs)
+                    results.append(dict(path=path, size=size, num_cores=n, seconds=seconds,
+                                        mib_per_s=size / 1024.0 / 1024 / seconds, cpu_seconds=cpu_seconds,
+                                        peak_rss=peak_rss))
+            os.remove(src)
+    return results
+
+
+def _transfer(path, endpoint, name, work_dir, key_path, part_size):
+    """
+    :return: Function that runs the transfer given a number of concurrent transfers, and the path it writes to
+    :rtype: tuple(function, str)
+    """
+    http_url = '{}/bench/{}'.format(endpoint, name)
+    src = os.path.join(work_dir, 'store', 'bench', name)
+    downloaded = os.path.join(work_dir, 'download')
+    uploaded = os.path.join(work_dir, 'store', 'bench', 'upload', name)
+    if path == 'http':
+        return lambda n: download_url(http_url, work_dir=work_dir, name='download', part_size=part_size,
+                                      num_cores=n), downloaded
+    elif path == 's3':
+        return lambda n: download_url('s3://bench/' + name, work_dir=work_dir, name='download',
+                                      part_size=part_size, num_cores=n), downloaded
+    elif path == 'sse-c':
+        return lambda n: download_url(http_url, work_dir=work_dir, name='download', s3_key_path=key_path,
+                                      part_size=part_size, num_cores=n), downloaded
+    elif path == 'upload':
+        return lambda n: s3am_upload(src, 's3://bench/upload', num_cores=n, part_size=part_size), uploaded
+    elif path == 'sse-c-up':
+        return lambda n: s3am_upload(src, 's3://bench/upload', num_cores=n, s3_key_path=key_path,
+                                     part_size=part_size), uploaded
+    raise ValueError('Unknown transfer path: {}'.format(path))
+
+
+def _measure(func):
+    """
+    Runs a function in a forked child process
+
+    :param function func: Function to run
+    :return: Wall clock time and CPU time in seconds, and peak RSS in bytes of the child
+    :rtype: tuple(float, float, int)
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 1
+        try:
+            start = time.time()
+            func()
+            os.write(w, repr(time.time() - start))
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(w)
+    with os.fdopen(r) as f:
+        output = f.read()
+    _, status, rusage = os.wait4(pid, 0)
+    if status:
+        raise RuntimeError('Transfer failed, see the traceback above')
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    return float(output), rusage.ru_utime + rusage.ru_stime, peak_rss
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results with those of a baseline run
+
+    :param list[dict] results: Results of `run_benchmarks`
+    :param list[dict] baseline: Results of a previous run
+    :param float tolerance: Fraction by which a configuration may be slower than the baseline
+    :return: Results that are slower than their baseline by more than the tolerance, with the baseline MiB/s added
+    :rtype: list[dict]
+    """
+    baseline = {(x['path'], x['size'], x['num_cores']): x['mib_per_s'] for x in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline.get((result['path'], result['size'], result['num_cores']))
+        if previous and result['mib_per_s'] < previous * (1 - tolerance):
+            regressions.append(dict(result, baseline_mib_per_s=previous))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', default=['1M', '10M', '100M', '1G'], nargs='+',
+                        help='File sizes to benchmark, e.g. 1M 50G')
+    parser.add_argument('--num-cores', default=[1, 4, 8, 16], type=int, nargs='+',
+                        help='Numbers of concurrent byte ranges or parts to benchmark')
+    parser.add_argument('--paths', default=transfer_paths, choices=transfer_paths, nargs='+',
+                        help='Transfer paths to benchmark')
+    parser.add_argument('--part-size', default=50, type=int, help='Size of each byte range or part in MiB')
+    parser.add_argument('--repeat', default=1, type=int, help='Runs per configuration, the fastest is reported')
+    parser.add_argument('--work-dir', default=None, help='Directory for temporary files, must fit twice the '
+                                                         'largest size. Defaults to the system temp directory.')
+    parser.add_argument('--output', default='transfers.json', help='Path to write the JSON results to')
+    parser.add_argument('--baseline', default=None, help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='Fraction by which a configuration may be slower than the baseline')
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        results = run_benchmarks(work_dir, [human2bytes(size) for size in args.sizes], args.num_cores,
+                                 paths=args.paths, part_size=args.part_size * 1024 * 1024, repeat=args.repeat)
+    finally:
+        shutil.rmtree(work_dir)
+    with open(args.output, 'w') as f:
+        json.dump(dict(host=platform.node(), time=time.time(), part_size=args.part_size * 1024 * 1024,
+                       results=results), f, indent=2)
+    print('{:>10} {:>12} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'path', 'size', 'num_cores', 'seconds', 'MiB/s', 'cpu', 'rss_MiB'))
+    for x in results:
+        print('{:>10} {:>12} {:>10} {:>10.2f} {:>10.1f} {:>10.2f} {:>10.1f}'.format(
+            x['path'], x['size'], x['num_cores'], x['seconds'], x['mib_per_s'], x['cpu_seconds'],
+            x['peak_rss'] / 1024.0 / 1024))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        for x in regressions:
+            print('Regression: {path} size={size} num_cores={num_cores}: {mib_per_s:.1f} MiB/s, '
+                  'baseline {baseline_mib_per_s:.1f} MiB/s'.format(**x))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
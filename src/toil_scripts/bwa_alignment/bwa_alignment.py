@@ -7,12 +7,13 @@ import textwrap
 from urlparse import urlparse
 
 import yaml
+from bd2k.util.humanize import human2bytes
 from toil.job import Job
 
 from toil_scripts.lib import require, required_length
-from toil_scripts.lib.files import copy_file_job
-from toil_scripts.lib.jobs import map_job
-from toil_scripts.lib.urls import download_url_job, s3am_upload_job
+from toil_scripts.lib.jobs import map_job, prefetch_map_job, prefetch_waves
+from toil_scripts.lib.outputs import remove_finished_samples, store_output_job
+from toil_scripts.lib.urls import download_url_job
 from toil_scripts.rnaseq_cgl.rnaseq_cgl_pipeline import generate_file
 from toil_scripts.tools.aligners import run_bwakit
 from toil_scripts.tools.indexing import run_samtools_faidx, run_bwa_index
@@ -34,19 +35,19 @@ def download_reference_files(job, inputs, samples):
     if inputs.alt:
         urls.append(('alt', inputs.alt))
     # Download reference
-    download_ref = job.wrapJobFn(download_url_job, inputs.ref, disk='3G')  # Human genomes are typically ~3G
+    download_ref = job.wrapJobFn(download_url_job, inputs.ref, stream=True)
     job.addChild(download_ref)
     shared_ids['ref'] = download_ref.rv()
     # If FAI is provided, download it. Otherwise, generate it
     if inputs.fai:
-        shared_ids['fai'] = job.addChildJobFn(download_url_job, inputs.fai).rv()
+        shared_ids['fai'] = job.addChildJobFn(download_url_job, inputs.fai, stream=True).rv()
     else:
         faidx = job.wrapJobFn(run_samtools_faidx, download_ref.rv())
         shared_ids['fai'] = download_ref.addChild(faidx).rv()
     # If all BWA index files are provided, download them. Otherwise, generate them
     if all(urls):
         for name, url in urls:
-            shared_ids[name] = job.addChildJobFn(download_url_job, url).rv()
+            shared_ids[name] = job.addChildJobFn(download_url_job, url, stream=True).rv()
     else:
         job.fileStore.logToMaster('BWA index files not provided, creating now')
         bwa_index = job.wrapJobFn(run_bwa_index, download_ref.rv())
@@ -55,7 +56,10 @@ def download_reference_files(job, inputs, samples):
             shared_ids[name] = bwa_index.rv(x)
 
     # Map_job distributes one sample in samples to the downlaod_sample_and_align function
-    job.addFollowOnJobFn(map_job, download_sample_and_align, samples, inputs, shared_ids)
+    if inputs.prefetch:
+        job.addFollowOnJobFn(prefetch_map_job, prefetch_sample, align, samples, '2G', inputs, shared_ids)
+    else:
+        job.addFollowOnJobFn(map_job, download_sample_and_align, samples, inputs, shared_ids)
 
 
 def download_sample_and_align(job, sample, inputs, ids):
@@ -70,12 +74,42 @@ def download_sample_and_align(job, sample, inputs, ids):
     uuid, urls = sample
     r1_url, r2_url = urls if len(urls) == 2 else (urls[0], None)
     job.fileStore.logToMaster('Downloaded sample: {0}. R1 {1}\nR2 {2}\nStarting BWA Run'.format(uuid, r1_url, r2_url))
-    # Read fastq samples from file store
-    ids['r1'] = job.addChildJobFn(download_url_job, r1_url, s3_key_path=inputs.ssec, disk=inputs.file_size).rv()
+    # Stream fastq samples into the file store
+    ids['r1'] = job.addChildJobFn(download_url_job, r1_url, s3_key_path=inputs.ssec, stream=True).rv()
     if r2_url:
-        ids['r2'] = job.addChildJobFn(download_url_job, r2_url, s3_key_path=inputs.ssec, disk=inputs.file_size).rv()
+        ids['r2'] = job.addChildJobFn(download_url_job, r2_url, s3_key_path=inputs.ssec, stream=True).rv()
     else:
         ids['r2'] = None
+    job.addFollowOnJobFn(align, uuid, inputs, ids)
+
+
+def prefetch_sample(job, sample, inputs, ids):
+    """
+    Downloads the sample fastqs within the calling job, for use with `prefetch_map_job`
+
+    :param JobFunctionWrappingJob job: Passed by Toil automatically
+    :param tuple(str, list) sample: UUID and URLS for sample
+    :param Namespace inputs: Contains input arguments
+    :param dict ids: FileStore IDs for shared inputs
+    :return: Arguments of align: UUID, inputs and FileStore IDs including those of the fastqs
+    :rtype: tuple(str, Namespace, dict)
+    """
+    uuid, urls = sample
+    ids = dict(ids)
+    ids['r1'] = download_url_job(job, urls[0], s3_key_path=inputs.ssec, stream=True)
+    ids['r2'] = download_url_job(job, urls[1], s3_key_path=inputs.ssec, stream=True) if len(urls) == 2 else None
+    return uuid, inputs, ids
+
+
+def align(job, uuid, inputs, ids):
+    """
+    Runs BWA-kit on a downloaded sample and stores the output BAM
+
+    :param JobFunctionWrappingJob job: Passed by Toil automatically
+    :param str uuid: UUID of the sample
+    :param Namespace inputs: Contains input arguments
+    :param dict ids: FileStore IDs for shared inputs and the sample fastqs (r1, r2)
+    """
     # Create config for bwakit
     inputs.cores = min(inputs.maxCores, multiprocessing.cpu_count())
     inputs.uuid = uuid
@@ -85,14 +119,16 @@ def download_sample_and_align(job, sample, inputs, ids):
     # Define and wire job functions
     bam_id = job.wrapJobFn(run_bwakit, config, threads=inputs.cores, sort=inputs.sort,
                            trim=inputs.trim, disk=inputs.file_size, cores=inputs.cores)
-    job.addFollowOn(bam_id)
+    job.addChild(bam_id)
     output_name = uuid + '.bam' + str(inputs.suffix) if inputs.suffix else uuid + '.bam'
     if urlparse(inputs.output_dir).scheme == 's3':
-        upload = job.wrapJobFn(s3am_upload_job, file_id=bam_id.rv(), file_name=output_name, s3_dir=inputs.output_dir,
-                               num_cores=inputs.cores, s3_key_path=inputs.ssec, cores=inputs.cores)
+        upload = job.wrapJobFn(store_output_job, file_id=bam_id.rv(), file_name=output_name,
+                               output_dir=inputs.output_dir, num_cores=inputs.cores, s3_key_path=inputs.ssec,
+                               cores=inputs.cores)
         bam_id.addChild(upload)
     else:
-        bam_id.addChild(copy_file_job, name=output_name, file_id=bam_id.rv(), output_dir=inputs.output_dir)
+        bam_id.addChildJobFn(store_output_job, file_id=bam_id.rv(), file_name=output_name,
+                             output_dir=inputs.output_dir)
 
 
 def generate_config():
@@ -206,6 +242,20 @@ def parse_manifest(manifest_path):
     return samples
 
 
+def output_paths(sample, inputs):
+    """
+    Path of the output BAM of a sample
+
+    :param list sample: UUID and URLs of the sample
+    :param Namespace inputs: Contains input arguments
+    :return: Output paths
+    :rtype: list[str]
+    """
+    uuid = sample[0]
+    output_name = uuid + '.bam' + str(inputs.suffix) if inputs.suffix else uuid + '.bam'
+    return [os.path.join(inputs.output_dir, output_name)]
+
+
 def main():
     """
     Computational Genomics Lab, Genomics Institute, UC Santa Cruz
@@ -230,13 +280,11 @@ def main():
     1 = Run BWA-kit
     ===================================================================
     :Dependencies:
-    cURL:       apt-get install curl
     Toil:       pip install toil
     Docker:     wget -qO- https://get.docker.com/ | sh
 
     Optional:
-    S3AM:       pip install --s3am (requires ~/.boto config file)
-    Boto:       pip install boto
+    Boto:       pip install boto (requires ~/.boto config file)
     """
     # Define Parser object and add to Toil
     parser = argparse.ArgumentParser(description=main.__doc__, formatter_class=argparse.RawTextHelpFormatter)
@@ -255,6 +303,12 @@ def main():
                             '\nDefault value: "%(default)s".')
     group.add_argument('--sample', nargs='+', action=required_length(2, 3),
                        help='Space delimited sample UUID and fastq files in the format: uuid url1 [url2].')
+    parser_run.add_argument('--rerun-finished', action='store_true',
+                            help='Rerun samples whose output BAM is already complete from a previous run. '
+                                 'By default these samples are skipped.')
+    parser_run.add_argument('--prefetch-budget', default=None, type=str,
+                            help='Download the inputs of the next samples while the current samples are aligned, '
+                                 'using at most this much disk across the cluster for inputs (e.g. 500G).')
     # Print docstring help if no arguments provided
     if len(sys.argv) == 1:
         parser.print_help()
@@ -282,6 +336,14 @@ def main():
         # Sanity checks
         require(config.ref, 'Missing URL for reference file: {}'.format(config.ref))
         require(config.output_dir, 'No output location specified: {}'.format(config.output_dir))
+        # Skip samples whose outputs are complete, so a rerun after failures only processes the failed samples
+        if not args.rerun_finished:
+            samples = remove_finished_samples(samples, lambda sample: output_paths(sample, config))
+        # Group samples in waves if inputs are prefetched
+        if args.prefetch_budget:
+            samples = prefetch_waves(samples, lambda sample: sample[1], human2bytes(args.prefetch_budget),
+                                     s3_key_path=config.ssec)
+        config.prefetch = bool(args.prefetch_budget)
         # Launch Pipeline
         Job.Runner.startToil(Job.wrapJobFn(download_reference_files, config, samples), args)
 
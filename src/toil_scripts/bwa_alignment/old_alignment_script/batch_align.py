@@ -26,6 +26,7 @@ import shutil
 from toil.job import Job
 
 from toil_scripts import download_from_s3_url
+from toil_scripts.lib.programs import docker_pipe
 
 
 def build_parser():
@@ -201,31 +202,24 @@ def alignment(job, ids, input_args, sample):
         download_encrypted_file(work_dir, url, key_path, os.path.basename(url))
 
     # Parameters for BWA and Bamsort
-    docker_cmd = ['docker', 'run', '--rm', '-v', '{}:/data'.format(work_dir)]
-
-    bwa_command = ["jvivian/bwa",
-                   "mem",
+    bwa_command = ["mem",
                    "-R", "@RG\tID:{0}\tPL:Illumina\tSM:{0}\tLB:KapaHyper".format(uuid),
                    "-T", str(0),
                    "-t", str(cores),
                    "/data/ref.fa"] + [os.path.join('/data/',  os.path.basename(x)) for x in urls]
 
-    bamsort_command = ["jeltje/biobambam",
-                       "/usr/local/bin/bamsort",
+    bamsort_command = ["/usr/local/bin/bamsort",
                        "inputformat=sam",
                        "level=1",
                        "inputthreads={}".format(cores),
                        "outputthreads={}".format(cores),
                        "calmdnm=1",
                        "calmdnmrecompindetonly=1",
-                       "calmdnmreference=/data/ref.fa",
-                       "I=/data/{}".format(uuid + '.sam')]
-    # Piping the output to a file handle
-    with open(os.path.join(work_dir, uuid + '.sam'), 'w') as f_out:
-        subprocess.check_call(docker_cmd + bwa_command, stdout=f_out)
-
+                       "calmdnmreference=/data/ref.fa"]
+    # Stream the SAM from BWA into Bamsort, piping the output to a file handle
     with open(os.path.join(work_dir, uuid + '.bam'), 'w') as f_out:
-        subprocess.check_call(docker_cmd + bamsort_command, stdout=f_out)
+        docker_pipe([dict(tool='jvivian/bwa', parameters=bwa_command),
+                     dict(tool='jeltje/biobambam', parameters=bamsort_command)], work_dir=work_dir, outfile=f_out)
 
     # Save in JobStore
     # job.fileStore.updateGlobalFile(ids['bam'], os.path.join(work_dir, uuid + '.bam'))
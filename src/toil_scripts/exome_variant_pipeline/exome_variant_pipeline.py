@@ -3,20 +3,20 @@ import argparse
 import multiprocessing
 import os
 import sys
-import tarfile
 import textwrap
-from contextlib import closing
 from urlparse import urlparse
 
 import yaml
-from bd2k.util.files import mkdir_p
+from bd2k.util.humanize import human2bytes
 from bd2k.util.processes import which
 from toil.job import Job
 
 from toil_scripts.lib import require
-from toil_scripts.lib.files import copy_files
-from toil_scripts.lib.jobs import map_job
-from toil_scripts.lib.urls import download_url_job, s3am_upload
+from toil_scripts.lib.files import consolidate_tarballs
+from toil_scripts.lib.jobs import map_job, prefetch_map_job, prefetch_waves
+from toil_scripts.lib.outputs import open_output, remove_finished_samples
+from toil_scripts.lib.programs import referenced_images
+from toil_scripts.lib.urls import download_url_job
 from toil_scripts.tools.mutation_callers import run_muse
 from toil_scripts.tools.mutation_callers import run_mutect
 from toil_scripts.tools.mutation_callers import run_pindel
@@ -40,7 +40,8 @@ def download_shared_files(job, samples, config):
     urls = [config.reference, config.phase, config.mills, config.dbsnp, config.cosmic]
     for name, url in zip(file_names, urls):
         if url:
-            vars(config)[name] = job.addChildJobFn(download_url_job, url=url, s3_key_path=config.ssec).rv()
+            vars(config)[name] = job.addChildJobFn(download_url_job, url=url, s3_key_path=config.ssec,
+                                                   stream=True).rv()
     job.addFollowOnJobFn(reference_preprocessing, samples, config)
 
 
@@ -55,7 +56,24 @@ def reference_preprocessing(job, samples, config):
     job.fileStore.logToMaster('Processed reference files')
     config.fai = job.addChildJobFn(run_samtools_faidx, config.reference).rv()
     config.dict = job.addChildJobFn(run_picard_create_sequence_dictionary, config.reference).rv()
-    job.addFollowOnJobFn(map_job, download_sample, samples, config)
+    if config.prefetch:
+        disk = '20G' if config.gtkey and not config.ci_test else '1G'
+        job.addFollowOnJobFn(prefetch_map_job, prefetch_sample, index_bams, samples, disk, config)
+    elif config.longest_first:
+        # Largest samples first, by the size of their inputs
+        job.addFollowOnJobFn(map_job, download_sample, samples, config, sample_urls=sample_urls,
+                             s3_key_path=config.ssec)
+    else:
+        job.addFollowOnJobFn(map_job, download_sample, samples, config)
+
+
+def sample_urls(sample):
+    """
+    :param list sample: UUID, normal URL and tumor URL of a sample
+    :return: Input URLs of the sample
+    :rtype: list[str]
+    """
+    return sample[1:]
 
 
 def download_sample(job, sample, config):
@@ -66,23 +84,49 @@ def download_sample(job, sample, config):
     :param list sample: Contains uuid, normal URL, and tumor URL
     :param Namespace config: Argparse Namespace object containing argument inputs
     """
-    # Create copy of config that is sample specific
-    config = argparse.Namespace(**vars(config))
-    uuid, normal_url, tumor_url = sample
-    job.fileStore.logToMaster('Downloaded sample: ' + uuid)
-    config.uuid = uuid
-    config.normal = normal_url
-    config.tumor = tumor_url
-    config.cores = min(config.maxCores, int(multiprocessing.cpu_count()))
-    disk = '1G' if config.ci_test else '20G'
+    config = sample_config(sample, config)
+    job.fileStore.logToMaster('Downloaded sample: ' + config.uuid)
+    # Inputs are streamed into the file store, so only GeneTorrent downloads need local disk
+    disk = '20G' if config.gtkey and not config.ci_test else '1G'
     # Download sample bams and launch pipeline
     config.normal_bam = job.addChildJobFn(download_url_job, url=config.normal, s3_key_path=config.ssec,
-                                          cghub_key_path=config.gtkey, disk=disk).rv()
+                                          cghub_key_path=config.gtkey, stream=True, disk=disk).rv()
     config.tumor_bam = job.addChildJobFn(download_url_job, url=config.tumor, s3_key_path=config.ssec,
-                                         cghub_key_path=config.gtkey, disk=disk).rv()
+                                         cghub_key_path=config.gtkey, stream=True, disk=disk).rv()
     job.addFollowOnJobFn(index_bams, config)
 
 
+def prefetch_sample(job, sample, config):
+    """
+    Downloads the sample bams within the calling job, for use with `prefetch_map_job`
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list sample: Contains uuid, normal URL, and tumor URL
+    :param Namespace config: Argparse Namespace object containing argument inputs
+    :return: Arguments of index_bams: the sample specific config
+    :rtype: tuple(Namespace)
+    """
+    config = sample_config(sample, config)
+    config.normal_bam = download_url_job(job, url=config.normal, s3_key_path=config.ssec,
+                                         cghub_key_path=config.gtkey, stream=True)
+    config.tumor_bam = download_url_job(job, url=config.tumor, s3_key_path=config.ssec,
+                                        cghub_key_path=config.gtkey, stream=True)
+    return config,
+
+
+def sample_config(sample, config):
+    """
+    :param list sample: Contains uuid, normal URL, and tumor URL
+    :param Namespace config: Argparse Namespace object containing argument inputs
+    :return: Copy of config that is sample specific
+    :rtype: Namespace
+    """
+    config = argparse.Namespace(**vars(config))
+    config.uuid, config.normal, config.tumor = sample
+    config.cores = min(config.maxCores, int(multiprocessing.cpu_count()))
+    return config
+
+
 def index_bams(job, config):
     """
     Convenience job for handling bam indexing to make the workflow declaration cleaner
@@ -174,29 +218,30 @@ def consolidate_output(job, config, mutect, pindel, muse):
         pindel_tar = job.fileStore.readGlobalFile(pindel, os.path.join(work_dir, 'pindel.tar.gz'))
     if muse:
         muse_tar = job.fileStore.readGlobalFile(muse, os.path.join(work_dir, 'muse.tar.gz'))
-    out_tar = os.path.join(work_dir, config.uuid + '.tar.gz')
-    # Consolidate separate tarballs into one as streams (avoids unnecessary untaring)
-    tar_list = [x for x in [mutect_tar, pindel_tar, muse_tar] if x is not None]
-    with tarfile.open(os.path.join(work_dir, out_tar), 'w:gz') as f_out:
-        for tar in tar_list:
-            with tarfile.open(tar, 'r') as f_in:
-                for tarinfo in f_in:
-                    with closing(f_in.extractfile(tarinfo)) as f_in_file:
-                        if tar is mutect_tar:
-                            tarinfo.name = os.path.join(config.uuid, 'mutect', os.path.basename(tarinfo.name))
-                        elif tar is pindel_tar:
-                            tarinfo.name = os.path.join(config.uuid, 'pindel', os.path.basename(tarinfo.name))
-                        else:
-                            tarinfo.name = os.path.join(config.uuid, 'muse', os.path.basename(tarinfo.name))
-                        f_out.addfile(tarinfo, fileobj=f_in_file)
-    # Move to output directory of selected
-    if config.output_dir:
-        job.fileStore.logToMaster('Moving {} to output dir: {}'.format(config.uuid, config.output_dir))
-        mkdir_p(config.output_dir)
-        copy_files(file_paths=[out_tar], output_dir=config.output_dir)
-    if config.s3_output_dir:
-        job.fileStore.logToMaster('Uploading {} to S3: {}'.format(config.uuid, config.s3_output_dir))
-        s3am_upload(fpath=out_tar, s3_dir=config.s3_output_dir, num_cores=config.cores)
+    tars = [(mutect_tar, 'mutect'), (pindel_tar, 'pindel'), (muse_tar, 'muse')]
+    output_dirs = [x for x in [config.output_dir, config.s3_output_dir] if x]
+    job.fileStore.logToMaster('Writing {} to: {}'.format(config.uuid, ', '.join(output_dirs)))
+    # Consolidate separate tarballs into one, copying their compressed data where possible (avoids recompression),
+    # and stream it to the output directories
+    with open_output(config.uuid + '.tar.gz', output_dirs, num_cores=config.cores) as f_out:
+        consolidate_tarballs(f_out, [(tar, os.path.join(config.uuid, subdir)) for tar, subdir in tars if tar],
+                             num_cores=config.cores)
+
+
+def pipeline_images(config):
+    """
+    Docker images used by the pipeline with the given config
+
+    :param Namespace config: Argparse Namespace object containing argument inputs
+    :return: Names of the images
+    :rtype: list[str]
+    """
+    funcs = [run_samtools_faidx, run_picard_create_sequence_dictionary, run_samtools_index]
+    funcs += [run_gatk_preprocessing] if config.preprocessing else []
+    funcs += [run_mutect] if config.run_mutect else []
+    funcs += [run_pindel] if config.run_pindel else []
+    funcs += [run_muse] if config.run_muse else []
+    return referenced_images(*funcs)
 
 
 def parse_manifest(path_to_manifest):
@@ -221,6 +266,19 @@ def parse_manifest(path_to_manifest):
     return samples
 
 
+def output_paths(sample, config):
+    """
+    Paths of the final output tarball of a sample, in the output directory and/or S3
+
+    :param list sample: Contains uuid, normal URL, and tumor URL
+    :param Namespace config: Argparse Namespace object containing argument inputs
+    :return: Output paths
+    :rtype: list[str]
+    """
+    uuid = sample[0]
+    return [os.path.join(x, uuid + '.tar.gz') for x in [config.output_dir, config.s3_output_dir] if x]
+
+
 def generate_config():
     return textwrap.dedent("""
     # CGL Exome Pipeline configuration file
@@ -349,7 +407,6 @@ def main():
     17 = Consolidate Output and move/upload results
     ==================================================
     Dependencies
-    Curl:       apt-get install curl
     Docker:     wget -qO- https://get.docker.com/ | sh
     Toil:       pip install toil
     Boto:       pip install boto (OPTIONAL)
@@ -376,6 +433,16 @@ def main():
                                  'and gnos://. The UUID for the sample must be given with the "--uuid" flag.')
     parser_run.add_argument('--uuid', default=None, type=str, help='Provide the UUID of a sample when using the'
                                                                    '"--tumor" and "--normal" option')
+    parser_run.add_argument('--rerun-finished', action='store_true',
+                            help='Rerun samples whose output tarball is already complete from a previous run. '
+                                 'By default these samples are skipped.')
+    parser_run.add_argument('--longest-first', action='store_true',
+                            help='Look up the size of every input before the run and start the samples with the '
+                                 'largest inputs first, so that they do not leave a long tail. Inputs whose size '
+                                 'cannot be looked up count as empty.')
+    parser_run.add_argument('--prefetch-budget', default=None, type=str,
+                            help='Download the inputs of the next samples while the current samples are processed, '
+                                 'using at most this much disk across the cluster for inputs (e.g. 500G).')
     # If no arguments provided, print full help menu
     if len(sys.argv) == 1:
         parser.print_help()
@@ -417,9 +484,19 @@ def main():
         require(config.output_dir or config.s3_output_dir, 'output-dir AND/OR s3-output-dir need to be defined, '
                                                            'otherwise sample output is not stored anywhere!')
         # Program checks
-        for program in ['curl', 'docker']:
+        for program in ['docker']:
             require(next(which(program), None), program + ' must be installed on every node.'.format(program))
 
+        # Skip samples whose outputs are complete, so a rerun after failures only processes the failed samples
+        if not args.rerun_finished:
+            samples = remove_finished_samples(samples, lambda sample: output_paths(sample, config))
+        # Group samples in waves if inputs are prefetched
+        if args.prefetch_budget:
+            samples = prefetch_waves(samples, sample_urls, human2bytes(args.prefetch_budget), s3_key_path=config.ssec)
+        config.prefetch = bool(args.prefetch_budget)
+        config.longest_first = args.longest_first
+        # The first tool call on each node pulls the tools' images in parallel (Toil passes the environment to jobs)
+        os.environ.setdefault('TOIL_SCRIPTS_DOCKER_IMAGES', ' '.join(pipeline_images(config)))
         # Launch Pipeline
         Job.Runner.startToil(Job.wrapJobFn(download_shared_files, samples, config), args)
 
@@ -204,7 +204,8 @@ def create_reference_index_hc(job, shared_ids, input_args):
                 parameters = faidx_command,
                 tool = 'quay.io/ucsc_cgl/samtools',
                 inputs=inputs,
-                outputs=outputs)
+                outputs=outputs,
+                memoize=True)
     # Update fileStore for output
     shared_ids['ref.fa.fai'] = job.fileStore.writeGlobalFile(faidx_output)
     job.addChildJobFn(create_reference_dict_hc, shared_ids, input_args)
@@ -234,7 +235,8 @@ def create_reference_dict_hc(job, shared_ids, input_args):
                 parameters = command,
                 tool = 'quay.io/ucsc_cgl/picardtools',
                 inputs=inputs,
-                outputs=outputs)
+                outputs=outputs,
+                memoize=True)
     # Update fileStore for output
     shared_ids['ref.dict'] = job.fileStore.writeGlobalFile(picard_output)
     job.addChildJobFn(spawn_batch_variant_calling, shared_ids, input_args)
@@ -0,0 +1,792 @@
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import closing, contextmanager
+
+from bd2k.util.exceptions import panic
+from bd2k.util.files import mkdir_p
+from bd2k.util.humanize import human2bytes
+
+from toil_scripts.lib.files import _place_file
+
+_log = logging.getLogger(__name__)
+
+
+def node_cache():
+    """
+    Returns the node-local cache configured by the environment, or None if caching is disabled.
+
+    TOIL_SCRIPTS_CACHE_DIR      Directory of the cache. Caching is disabled if this is unset.
+    TOIL_SCRIPTS_CACHE_SIZE     Disk budget of the cache (e.g. 100G). Default: 100G
+    TOIL_SCRIPTS_CACHE_HARDLINK If set to 1, cached files are hard linked rather than copied, see `FileCache`
+
+    :return: The node-local cache or None
+    :rtype: FileCache
+    """
+    cache_dir = os.environ.get('TOIL_SCRIPTS_CACHE_DIR')
+    if not cache_dir:
+        return None
+    return FileCache(cache_dir, max_size=human2bytes(os.environ.get('TOIL_SCRIPTS_CACHE_SIZE', '100G')),
+                     hardlink=_hardlink())
+
+
+def _hardlink():
+    return os.environ.get('TOIL_SCRIPTS_CACHE_HARDLINK', '0') == '1'
+
+
+class FileCache(object):
+    """
+    Node-local, content-addressed cache of downloaded files that is shared by every process on the node.
+
+    Layout of the cache directory:
+        blobs/DIGEST            Cached content, named by its SHA-256 digest and shared by all URLs with that content
+        extracted/DIGEST/       Extracted contents of a cached tarball
+        extracted/DIGEST.json   Marker written once extraction is complete, holding the size of the tree
+        urls/URL_HASH           JSON record mapping a URL to the digest of its content
+        stats                   JSON hit and miss counts
+        tmp/PID-*/              Downloads and extractions in progress, owned by process PID
+
+    Files are populated atomically by downloading (and extracting) into tmp/ and renaming into place. A lock per URL
+    ensures that concurrent jobs wait for a single download, and a global lock guards eviction and statistics. Least
+    recently used entries are evicted once the cache exceeds max_size. An entry in use is pinned by hard linking it into
+    tmp/ under the global lock, so evicting it never pulls a file out from under a running job. Pinned entries are
+    meant to be used in place, e.g. mounted read-only into a container (see `pinned`), so that the jobs on a node share
+    a single copy. Callers that need a file of their own get a reflink where the file system supports it and a copy
+    otherwise, made after the locks are released (see `get`). Leftovers of crashed processes, in tmp/ or as an
+    extracted tree without a marker, are removed.
+
+    Hard links save the copy, but share the cached inode with the work directory: a tool that runs as root in a
+    container, or the chown of its outputs, changes the cached file for every job. Only use hardlink if the work
+    directories are not mounted into containers that run as root.
+    """
+    def __init__(self, cache_dir, max_size, hardlink=False):
+        """
+        :param str cache_dir: Directory of the cache
+        :param int max_size: Disk budget of the cache in bytes
+        :param bool hardlink: Hard link files into work directories instead of copying them
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hardlink = hardlink
+        for subdir in ['blobs', 'extracted', 'urls', 'tmp']:
+            mkdir_p(os.path.join(cache_dir, subdir))
+
+    def get(self, url, file_path, download_func):
+        """
+        Places a copy of the content of a URL at file_path, downloading it into the cache first if it is not cached.
+        This is the fallback for callers that cannot use the pinned file itself, see `pinned`.
+
+        :param str url: URL of the file, which is the cache key
+        :param str file_path: Path to place the file at
+        :param function download_func: Called as download_func(path) to download the URL to path on a cache miss
+        :return: Path to the file
+        :rtype: str
+        """
+        with self.pinned(url, download_func) as path:
+            _place(path, file_path, self.hardlink)
+        return file_path
+
+    @contextmanager
+    def pinned(self, url, download_func):
+        """
+        Yields the path of the cached content of a URL, downloading it into the cache first if it is not cached. The
+        file is pinned against eviction until the context exits, so it can be read, or mounted read-only into a
+        container, in place of a copy. The lock of the URL is only held until the file is pinned.
+
+        :param str url: URL of the file, which is the cache key
+        :param function download_func: Called as download_func(path) to download the URL to path on a cache miss
+        """
+        url_hash = hashlib.sha1(url).hexdigest()
+        with _flock(os.path.join(self.cache_dir, 'urls', url_hash + '.lock')):
+            with self._lock():
+                blob = self._lookup(url_hash)
+                if blob:
+                    # Touch the blob so that eviction is least recently used rather than least recently downloaded
+                    os.utime(blob, None)
+                    pin_dir = self._pin(blob)
+                self._record('hits' if blob else 'misses')
+            if not blob:
+                pin_dir = self._populate(url, url_hash, download_func)
+        try:
+            self.evict()
+            yield os.path.join(pin_dir, 'pinned')
+        finally:
+            shutil.rmtree(pin_dir)
+
+    def get_extracted(self, url, dest_dir, download_func):
+        """
+        Places a copy of the extracted contents of a tarball URL in dest_dir, downloading and extracting it into the
+        cache first if it is not cached. Only the extracted tree is cached, not the tarball. This is the fallback for
+        callers that cannot use the pinned tree itself, see `pinned_extracted`.
+
+        :param str url: URL of the tarball, which is the cache key
+        :param str dest_dir: Directory to place the contents of the tarball in
+        :param function download_func: Called as download_func(path) to download the URL to path on a cache miss
+        :return: Path to dest_dir
+        :rtype: str
+        """
+        with self.pinned_extracted(url, download_func) as tree:
+            _place_tree(tree, dest_dir, self.hardlink)
+        return dest_dir
+
+    @contextmanager
+    def pinned_extracted(self, url, download_func):
+        """
+        Yields the path of the extracted contents of a tarball URL in the cache, downloading and extracting it first
+        if it is not cached. The tree is pinned against eviction until the context exits, see `pinned`.
+
+        :param str url: URL of the tarball, which is the cache key
+        :param function download_func: Called as download_func(path) to download the URL to path on a cache miss
+        """
+        url_hash = hashlib.sha1(url).hexdigest()
+        with _flock(os.path.join(self.cache_dir, 'urls', url_hash + '.lock')):
+            with self._lock():
+                tree = self._lookup_extracted(url_hash)
+                if tree:
+                    os.utime(tree + '.json', None)
+                    pin_dir = self._pin(tree)
+                self._record('hits' if tree else 'misses')
+            if not tree:
+                pin_dir = self._populate_extracted(url, url_hash, download_func)
+        try:
+            self.evict()
+            yield os.path.join(pin_dir, 'pinned')
+        finally:
+            shutil.rmtree(pin_dir)
+
+    def stats(self):
+        """
+        :return: Hit and miss counts, number of cached entries (files or extracted tarballs), and their total size
+                 in bytes
+        :rtype: dict
+        """
+        with self._lock():
+            stats = self._read_stats()
+            entries = self._entries()
+        stats.update(files=len(entries), size=sum(size for _, size, _ in entries))
+        return stats
+
+    def evict(self):
+        """
+        Removes leftovers of crashed processes, then least recently used entries until the cache is within its budget
+        """
+        with self._lock():
+            tmp_dir = os.path.join(self.cache_dir, 'tmp')
+            for name in os.listdir(tmp_dir):
+                if not _pid_exists(int(name.split('-')[0])):
+                    shutil.rmtree(os.path.join(tmp_dir, name), ignore_errors=True)
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            total = sum(size for _, size, _ in entries)
+            while entries and total > self.max_size:
+                path, size, _ = entries.pop(0)
+                if os.path.isdir(path):
+                    # Remove the marker first, so an interrupted removal is seen as a partial extraction
+                    os.remove(path + '.json')
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                total -= size
+
+    def _lock(self):
+        """
+        Global lock of the cache, held while blobs are added, linked out, or evicted and while statistics change
+        """
+        return _flock(os.path.join(self.cache_dir, 'lock'))
+
+    def _pin(self, path):
+        """
+        Hard links a blob, or every file of an extracted tree, into tmp/ as PIN_DIR/pinned, so that it can be placed
+        outside of the global lock without being evicted in the meantime
+
+        :param str path: Path of the blob or tree
+        :return: PIN_DIR, to be removed once the entry is placed
+        :rtype: str
+        """
+        pin_dir = self._mkdtemp()
+        if os.path.isdir(path):
+            _place_tree(path, os.path.join(pin_dir, 'pinned'), hardlink=True)
+        else:
+            os.link(path, os.path.join(pin_dir, 'pinned'))
+        return pin_dir
+
+    def _lookup(self, url_hash):
+        try:
+            with open(os.path.join(self.cache_dir, 'urls', url_hash)) as f:
+                record = json.load(f)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        blob = os.path.join(self.cache_dir, 'blobs', record['digest'])
+        return blob if os.path.exists(blob) else None
+
+    def _lookup_extracted(self, url_hash):
+        try:
+            with open(os.path.join(self.cache_dir, 'urls', url_hash)) as f:
+                tree = os.path.join(self.cache_dir, 'extracted', json.load(f)['digest'])
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        if os.path.exists(tree + '.json'):
+            return tree
+        if os.path.exists(tree):
+            # Extracted tree without a marker, left behind by a process that crashed while removing it
+            shutil.rmtree(tree)
+        return None
+
+    def _populate(self, url, url_hash, download_func):
+        """
+        Downloads a URL into the cache and pins its blob
+
+        :return: PIN_DIR of the blob, see `_pin`
+        :rtype: str
+        """
+        # Download and hash outside of the global lock, as these are the slow parts
+        tmp_dir = self._mkdtemp()
+        try:
+            tmp_path = os.path.join(tmp_dir, 'download')
+            download_func(tmp_path)
+            digest = _sha256(tmp_path)
+            os.chmod(tmp_path, 0o444)
+            with self._lock():
+                blob = os.path.join(self.cache_dir, 'blobs', digest)
+                os.rename(tmp_path, blob)
+                _write_json(os.path.join(self.cache_dir, 'urls', url_hash),
+                            dict(url=url, digest=digest, size=os.path.getsize(blob)))
+                return self._pin(blob)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def _populate_extracted(self, url, url_hash, download_func):
+        """
+        Downloads and extracts a tarball URL into the cache and pins its tree
+
+        :return: PIN_DIR of the tree, see `_pin`
+        :rtype: str
+        """
+        tmp_dir = self._mkdtemp()
+        try:
+            tar_path = os.path.join(tmp_dir, 'download.tar')
+            download_func(tar_path)
+            digest = _sha256(tar_path)
+            tmp_tree = os.path.join(tmp_dir, 'extracted')
+            os.mkdir(tmp_tree)
+            subprocess.check_call(['tar', '-xf', tar_path, '-C', tmp_tree])
+            os.remove(tar_path)
+            size = 0
+            for root, _, files in os.walk(tmp_tree):
+                for name in files:
+                    path = os.path.join(root, name)
+                    size += os.path.getsize(path)
+                    os.chmod(path, 0o444)
+            with self._lock():
+                tree = os.path.join(self.cache_dir, 'extracted', digest)
+                # A tree with a marker was extracted from the same content under another URL, and is kept as is. A
+                # marker is only ever written after its tree is in place, and removed before it.
+                if not os.path.exists(tree + '.json'):
+                    if os.path.exists(tree):
+                        shutil.rmtree(tree)
+                    os.rename(tmp_tree, tree)
+                    _write_json(tree + '.json', dict(url=url, size=size))
+                _write_json(os.path.join(self.cache_dir, 'urls', url_hash), dict(url=url, digest=digest, size=size))
+                return self._pin(tree)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def _mkdtemp(self):
+        # Prefixed by PID so that the leftovers of a crashed process can be identified
+        return tempfile.mkdtemp(prefix='{}-'.format(os.getpid()), dir=os.path.join(self.cache_dir, 'tmp'))
+
+    def _entries(self):
+        """
+        :return: Path, size in bytes and last use of every blob and complete extracted tree
+        :rtype: list[tuple(str, int, float)]
+        """
+        entries = []
+        blob_dir = os.path.join(self.cache_dir, 'blobs')
+        for name in os.listdir(blob_dir):
+            stat = os.stat(os.path.join(blob_dir, name))
+            entries.append((os.path.join(blob_dir, name), stat.st_size, stat.st_mtime))
+        extracted_dir = os.path.join(self.cache_dir, 'extracted')
+        for name in os.listdir(extracted_dir):
+            if name.endswith('.json'):
+                marker = os.path.join(extracted_dir, name)
+                with open(marker) as f:
+                    size = json.load(f)['size']
+                entries.append((os.path.splitext(marker)[0], size, os.stat(marker).st_mtime))
+        return entries
+
+    def _record(self, counter):
+        stats = self._read_stats()
+        stats[counter] += 1
+        _write_json(os.path.join(self.cache_dir, 'stats'), stats)
+
+    def _read_stats(self):
+        try:
+            with open(os.path.join(self.cache_dir, 'stats')) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return dict(hits=0, misses=0)
+            raise
+
+
+def result_cache():
+    """
+    Returns the result cache configured by the environment, or None if memoization is disabled.
+
+    TOIL_SCRIPTS_RESULT_CACHE       Directory, e.g. on a file system shared by the workers, or S3 prefix
+                                    (s3://BUCKET/PREFIX) of the cache. Memoization is disabled if this is unset.
+    TOIL_SCRIPTS_RESULT_CACHE_SIZE  Size budget of the cached outputs (e.g. 100G). Default: 100G
+    TOIL_SCRIPTS_CACHE_HARDLINK     If set to 1, outputs are restored as hard links rather than copies, see `FileCache`
+
+    :return: The result cache or None
+    :rtype: ResultCache
+    """
+    location = os.environ.get('TOIL_SCRIPTS_RESULT_CACHE')
+    if not location:
+        return None
+    return ResultCache(location, max_size=human2bytes(os.environ.get('TOIL_SCRIPTS_RESULT_CACHE_SIZE', '100G')),
+                       hardlink=_hardlink())
+
+
+class ResultCache(object):
+    """
+    Outputs of tool calls, keyed by the image, parameters and inputs of the call (see `call_key`), so that a call that
+    was already made with the same inputs restores its outputs instead of running again.
+
+    Layout of the cache directory or S3 prefix:
+        results/KEY     JSON record of a call: the digest of each output, by its path relative to the work directory,
+                        and the digest of the call's standard output if that was captured
+        blobs/DIGEST    Content of an output, named by its SHA-256 digest and shared by all calls with that content
+
+    A record is written after its blobs, so it never refers to content that was not yet stored. Restoring a call
+    touches its record. Once the blobs exceed max_size, the least recently used records are removed, then the blobs
+    no record refers to. A record whose blobs have gone missing, e.g. in a concurrent eviction, is a miss. Outputs
+    are restored from a local cache as reflinks or copies (read-only), or as hard links if hardlink is True, as by
+    `FileCache`.
+    """
+    # Blobs younger than this are not evicted, even if unreferenced, as their record may not be written yet
+    grace_period = 3600
+
+    def __init__(self, location, max_size, hardlink=False):
+        """
+        :param str location: Directory or S3 prefix (s3://BUCKET/PREFIX) of the cache
+        :param int max_size: Size budget of the blobs in bytes
+        :param bool hardlink: Hard link outputs restored from a local cache instead of copying them
+        """
+        self.location = location
+        self.max_size = max_size
+        self.store = _S3Store(location) if location.startswith('s3://') else _LocalStore(location, hardlink)
+
+    def call(self, key, work_dir, outputs, run, check_output=False):
+        """
+        Restores the outputs of a call, or runs it and stores its outputs if it is not cached
+
+        :param str key: Key of the call (see `call_key`)
+        :param str work_dir: Work directory of the call
+        :param list[str] outputs: Paths of the outputs, relative to work_dir or absolute inside it
+        :param function run: Runs the call, returning its standard output if check_output is True
+        :param bool check_output: True if the standard output of the call is captured
+        :return: Return value of run
+        """
+        paths = _relative_paths(outputs, work_dir)
+        restored = self.restore(key, work_dir)
+        if restored is not None:
+            _log.info('Restored the outputs of call %s from %s', key, self.location)
+            return restored[1]
+        output = run()
+        self.save(key, work_dir, paths, output if check_output else None)
+        self.evict()
+        return output
+
+    def restore(self, key, work_dir):
+        """
+        :param str key: Key of the call
+        :param str work_dir: Work directory to restore the outputs of the call in
+        :return: None if the call is not cached, otherwise True and the standard output of the call, if it was captured
+        :rtype: tuple(bool, str)
+        """
+        content = self.store.read('results/' + key)
+        if content is None:
+            return None
+        record = json.loads(content)
+        stdout = None
+        if record['stdout'] is not None:
+            stdout = self.store.read('blobs/' + record['stdout'])
+            if stdout is None:
+                return None
+        # Outputs are only moved into the work directory once every blob is fetched, so that a blob evicted in the
+        # meantime does not leave the tool to run over read-only outputs of the cached call
+        restore_dir = tempfile.mkdtemp(dir=work_dir, prefix='.restore-')
+        try:
+            for path, digest in sorted(record['outputs'].iteritems()):
+                dest = os.path.join(restore_dir, path)
+                mkdir_p(os.path.dirname(dest))
+                if not self.store.fetch('blobs/' + digest, dest):
+                    return None
+            for path in sorted(record['outputs']):
+                dest = os.path.join(work_dir, path)
+                mkdir_p(os.path.dirname(dest))
+                os.rename(os.path.join(restore_dir, path), dest)
+        finally:
+            shutil.rmtree(restore_dir)
+        self.store.touch('results/' + key)
+        return True, stdout
+
+    def save(self, key, work_dir, outputs, stdout=None):
+        """
+        Stores the outputs of a call
+
+        :param str key: Key of the call
+        :param str work_dir: Work directory of the call
+        :param list[str] outputs: Paths of the outputs relative to work_dir
+        :param str stdout: Standard output of the call, if it was captured
+        """
+        record = dict(outputs={}, stdout=None, time=time.time())
+        for path in outputs:
+            digest = _sha256(os.path.join(work_dir, path))
+            self.store.write_file('blobs/' + digest, os.path.join(work_dir, path))
+            record['outputs'][path] = digest
+        if stdout is not None:
+            record['stdout'] = hashlib.sha256(stdout).hexdigest()
+            self.store.write('blobs/' + record['stdout'], stdout)
+        self.store.write('results/' + key, json.dumps(record))
+
+    def evict(self):
+        """
+        Removes the least recently used calls and unreferenced blobs until the cache is within its budget
+        """
+        with self.store.lock():
+            blobs = self.store.list('blobs/')
+            if sum(size for _, size, _ in blobs) <= self.max_size:
+                return
+            results = sorted(self.store.list('results/'), key=lambda entry: entry[2])
+            referenced = {}
+            for name, _, _ in results:
+                content = self.store.read(name)
+                if content is not None:
+                    record = json.loads(content)
+                    referenced[name] = set(record['outputs'].values()) | ({record['stdout']} - {None})
+            sizes = {posixpath.basename(name): size for name, size, _ in blobs}
+            # Only blobs that are referenced count towards the budget, others are removed below
+            live = set().union(*referenced.values()) if referenced else set()
+            total = sum(sizes.get(digest, 0) for digest in live)
+            while results and total > self.max_size:
+                name, _, _ = results.pop(0)
+                self.store.delete(name)
+                digests = referenced.pop(name, set())
+                live = set().union(*referenced.values()) if referenced else set()
+                total -= sum(sizes.get(digest, 0) for digest in digests - live)
+            now = time.time()
+            for name, _, mtime in blobs:
+                if posixpath.basename(name) not in live and now - mtime > self.grace_period:
+                    self.store.delete(name)
+
+    def stats(self):
+        """
+        :return: Number of cached calls and blobs, and the total size of the blobs in bytes
+        :rtype: dict
+        """
+        blobs = self.store.list('blobs/')
+        return dict(calls=len(self.store.list('results/')), blobs=len(blobs), size=sum(size for _, size, _ in blobs))
+
+
+def call_key(image, parameters, work_dir, env=None, inputs=None, check_output=False, docker_parameters=None):
+    """
+    Key of a tool call: a digest of the image, the parameters, Docker parameters and environment, and the names and
+    contents of the inputs. References to the work directory are normalized to /data, and paths below /data to their
+    normal form, so that the key does not depend on the work directory of the call.
+
+    :param str image: Identity of the tool, e.g. the ID of its Docker image
+    :param list[str] parameters: Command line arguments passed to the tool
+    :param str work_dir: Work directory of the call
+    :param dict[str,str] env: Environment variables of the call
+    :param list[str] inputs: Paths of the inputs, relative to work_dir
+    :param bool check_output: True if the standard output of the call is captured
+    :param list[str] docker_parameters: Parameters passed to docker, e.g. --entrypoint or -e
+    :return: Hex SHA-256 digest
+    :rtype: str
+    """
+    work_dir = os.path.abspath(work_dir)
+    inputs = _relative_paths(inputs or [], work_dir)
+    key = dict(image=image,
+               parameters=[_normalize(p, work_dir) for p in parameters or []],
+               docker_parameters=[_normalize(p, work_dir) for p in docker_parameters or []],
+               env={e: _normalize(str(v), work_dir) for e, v in (env or {}).iteritems()},
+               inputs=sorted([path, _sha256(os.path.join(work_dir, path))] for path in inputs),
+               stdout=check_output)
+    return hashlib.sha256(json.dumps(key, sort_keys=True)).hexdigest()
+
+
+def _normalize(value, work_dir):
+    value = re.sub(re.escape(work_dir) + r'(?=/|$)', '/data', value)
+    return re.sub(r'(?:^|(?<=[=:,\s]))/data(?:/[^=:,\s]*)?', lambda m: posixpath.normpath(m.group(0)), value)
+
+
+def _relative_paths(paths, work_dir):
+    """
+    :param list[str] paths: Paths relative to work_dir or absolute inside it
+    :return: Normalized paths relative to work_dir
+    :rtype: list[str]
+    """
+    work_dir = os.path.abspath(work_dir)
+    relative = []
+    for path in paths:
+        path = os.path.relpath(os.path.join(work_dir, path), work_dir)
+        if path.startswith(os.pardir):
+            raise ValueError('Path of a memoized call outside of its work directory: {}'.format(path))
+        relative.append(path)
+    return relative
+
+
+class _LocalStore(object):
+    """
+    Cache in a directory, which processes on the nodes that mount it may share. Files are written atomically by
+    renaming them into place.
+    """
+    def __init__(self, root, hardlink=False):
+        self.root = os.path.abspath(root)
+        self.hardlink = hardlink
+        for subdir in ['blobs', 'results', 'tmp']:
+            mkdir_p(os.path.join(self.root, subdir))
+
+    def read(self, name):
+        try:
+            with open(os.path.join(self.root, name)) as f:
+                return f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def write(self, name, data):
+        with self._tmp() as tmp_path:
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            self._rename(tmp_path, name)
+
+    def write_file(self, name, path):
+        if os.path.exists(os.path.join(self.root, name)):
+            return
+        with self._tmp() as tmp_path:
+            shutil.copyfile(path, tmp_path)
+            self._rename(tmp_path, name)
+
+    def fetch(self, name, path):
+        try:
+            _place(os.path.join(self.root, name), path, self.hardlink)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        return True
+
+    def touch(self, name):
+        try:
+            os.utime(os.path.join(self.root, name), None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def list(self, prefix):
+        entries = []
+        directory = os.path.join(self.root, prefix)
+        for name in os.listdir(directory):
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue  # Evicted while listing
+                raise
+            entries.append((prefix + name, stat.st_size, stat.st_mtime))
+        return entries
+
+    def delete(self, name):
+        try:
+            os.remove(os.path.join(self.root, name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def lock(self):
+        return _flock(os.path.join(self.root, 'lock'))
+
+    @contextmanager
+    def _tmp(self):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, 'tmp'))
+        os.close(fd)
+        try:
+            yield tmp_path
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _rename(self, tmp_path, name):
+        if name.startswith('blobs/'):
+            os.chmod(tmp_path, 0o444)
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, os.path.join(self.root, name))
+
+
+class _S3Store(object):
+    """
+    Cache under an S3 prefix, which workers anywhere may share. Objects are written whole, so readers never see a
+    partial object. There is no lock, so concurrent evictions may both remove entries.
+    """
+    def __init__(self, url):
+        from toil_scripts.lib.urls import _parse_s3_url
+        self.url = url.rstrip('/') + '/'
+        self.bucket_name, self.prefix = _parse_s3_url(self.url)
+
+    def read(self, name):
+        with self._bucket() as bucket:
+            key = bucket.get_key(self.prefix + name)
+            return key.get_contents_as_string() if key is not None else None
+
+    def write(self, name, data):
+        with self._bucket() as bucket:
+            bucket.new_key(self.prefix + name).set_contents_from_string(data)
+
+    def write_file(self, name, path):
+        from toil_scripts.lib.urls import _upload_with_retry
+        with self._bucket() as bucket:
+            if bucket.get_key(self.prefix + name) is not None:
+                return
+        _upload_with_retry(path, self.url + name)
+
+    def fetch(self, name, path):
+        from toil_scripts.lib.urls import _download_s3_url
+        try:
+            _download_s3_url(path, self.url + name)
+        except ValueError:
+            return False  # Does not exist
+        return True
+
+    def touch(self, name):
+        # Copying an object onto itself with new metadata updates its modification time
+        with self._bucket() as bucket:
+            bucket.copy_key(self.prefix + name, self.bucket_name, self.prefix + name,
+                            metadata={'touched': str(time.time())})
+
+    def list(self, prefix):
+        from boto.utils import parse_ts
+        from calendar import timegm
+        with self._bucket() as bucket:
+            return [(key.name[len(self.prefix):], key.size, timegm(parse_ts(key.last_modified).timetuple()))
+                    for key in bucket.list(self.prefix + prefix)]
+
+    def delete(self, name):
+        with self._bucket() as bucket:
+            bucket.delete_key(self.prefix + name)
+
+    @contextmanager
+    def lock(self):
+        yield
+
+    @contextmanager
+    def _bucket(self):
+        from toil_scripts.lib.urls import _s3_connection
+        with closing(_s3_connection()) as s3:
+            yield s3.get_bucket(self.bucket_name, validate=False)
+
+
+@contextmanager
+def _flock(path):
+    """
+    Holds an exclusive lock on a lock file, which works across processes on the same node
+
+    :param str path: Path to lock file
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _place(src, dst, hardlink=False):
+    """
+    Places src at dst as a reflink or copy, or as a hard link if hardlink is True and both are on the same file system.
+    The file is placed under a temporary name and renamed into place, so dst is never partial.
+
+    :param str src: Path to source
+    :param str dst: Path to destination
+    :param bool hardlink: Hard link the file if possible
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst)),
+                                    prefix='.{}.'.format(os.path.basename(dst)))
+    os.close(fd)
+    try:
+        _place_file(src, tmp_path, hardlink=hardlink)
+        os.rename(tmp_path, dst)
+    except:
+        with panic():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def _place_tree(src, dst, hardlink=False):
+    """
+    Recreates the directory tree src in dst with every file placed by `_place`
+
+    :param str src: Path to source directory
+    :param str dst: Path to destination directory
+    :param bool hardlink: Hard link the files if possible
+    """
+    for root, dirs, files in os.walk(src):
+        dst_root = os.path.join(dst, os.path.relpath(root, src))
+        mkdir_p(dst_root)
+        for name in files:
+            _place(os.path.join(root, name), os.path.join(dst_root, name), hardlink)
+
+
+def _pid_exists(pid):
+    """
+    :param int pid: Process ID
+    :return: True if a process with this PID is running on this node
+    :rtype: bool
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _write_json(path, obj):
+    """
+    Atomically writes an object as JSON
+
+    :param str path: Path to file
+    :param obj: JSON serializable object
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.rename(tmp_path, path)
+
+
+def _sha256(path):
+    """
+    :param str path: Path to file
+    :return: Hex SHA-256 digest of the file
+    :rtype: str
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            sha.update(block)
+    return sha.hexdigest()
@@ -0,0 +1,301 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+from bd2k.util.files import mkdir_p
+
+
+def node_pool():
+    """
+    Returns the node-local container pool configured by the environment, or None if pooling is disabled.
+
+    TOIL_SCRIPTS_DOCKER_POOL_ROOT   Directory that is mounted into pooled containers, usually Toil's --workDir. Only
+                                    calls whose work_dir is inside it are pooled. Pooling is disabled if this is unset.
+    TOIL_SCRIPTS_DOCKER_POOL_IDLE   Seconds a pooled container may be idle before it is removed. Default: 300
+
+    :return: The node-local container pool or None
+    :rtype: ContainerPool
+    """
+    root = os.environ.get('TOIL_SCRIPTS_DOCKER_POOL_ROOT')
+    if not root:
+        return None
+    return ContainerPool(root, idle_timeout=int(os.environ.get('TOIL_SCRIPTS_DOCKER_POOL_IDLE', '300')))
+
+
+class ContainerPool(object):
+    """
+    Long-lived containers, one per image (and set of docker parameters), that are shared by every process on the node.
+    Commands are run in them with `docker exec`, which avoids the cost of creating, starting and removing a container
+    for every call.
+
+    A pooled container mounts the pool root at the same path, rather than a work directory at /data, so that one
+    container serves the work directories of every job. References to /data in the parameters and environment of a
+    call are rewritten to its work directory (see `translate_paths`), which is also the working directory of the
+    command. References elsewhere, e.g. in files read by the tool or in paths the tool builds itself, are not, so such
+    calls must not be pooled. Calls that set the entrypoint, and images whose entrypoint refers to /data itself, are
+    not pooled (see `accepts`), nor are calls of `docker_call` with mounts.
+
+    Layout of the state directory (ROOT/.toil-scripts-docker-pool):
+        NAME            JSON record of a running container: its image's entrypoint and command. Empty once removed.
+
+    Next to it, ROOT/.toil-scripts-docker-pool.images records which images have an entrypoint that refers to /data,
+    and ROOT/.toil-scripts-docker-pool.reaper is the lock of the reaper.
+
+    Each record is also the lock of its container. It is shared while commands run in the container, so calls of the
+    same image run concurrently, and only held exclusively while the container is started. Its modification time is
+    the last use of the container, and containers that have been idle for longer than idle_timeout are removed by
+    `reap`. This is called after every call, and by a detached reaper process (see `run_reaper`) that is started with
+    the first container, so that the last containers on a node are removed once the workflow is done with them.
+    """
+    def __init__(self, root, idle_timeout=300):
+        """
+        :param str root: Directory mounted into pooled containers
+        :param int idle_timeout: Seconds a container may be idle before it is removed
+        """
+        self.root = os.path.abspath(root)
+        self.idle_timeout = idle_timeout
+        self.state_dir = os.path.join(self.root, '.toil-scripts-docker-pool')
+        mkdir_p(self.state_dir)
+
+    def accepts(self, work_dir, tool=None, docker_parameters=None):
+        """
+        :param str work_dir: Work directory of a call
+        :param str tool: Name of the Docker image of the call
+        :param list[str] docker_parameters: Parameters the call passes to docker
+        :return: True if the work directory is visible in pooled containers, the call does not set the entrypoint, which
+                 would replace the one that keeps pooled containers running, and the image's entrypoint does not
+                 refer to /data (see `_uses_data`)
+        :rtype: bool
+        """
+        if not os.path.abspath(work_dir).startswith(self.root + os.sep):
+            return False
+        if any(p == '--entrypoint' or p.startswith('--entrypoint=') for p in docker_parameters or []):
+            return False
+        return tool is None or not self._uses_data(tool)
+
+    def _uses_data(self, tool):
+        """
+        Returns True if the entrypoint of an image refers to /data, e.g. a wrapper script that chowns it. Pooled
+        containers have no /data mount, and only the parameters of a call are rewritten, so such images are run in a
+        new container. Each image is checked once per pool root. Entrypoints that cannot be checked, e.g. in images
+        without a shell, count as referring to /data.
+
+        :param str tool: Name of the Docker image, which must be present
+        :rtype: bool
+        """
+        with open(self.state_dir + '.images', 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                images = json.loads(content) if content else {}
+                if tool not in images:
+                    images[tool] = _entrypoint_uses_data(tool)
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(images, f)
+                return images[tool]
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextmanager
+    def command(self, tool, parameters, work_dir, env=None, docker_parameters=None, exec_parameters=None):
+        """
+        Yields the `docker exec` command that runs a call in the pooled container of tool, which is started if needed.
+        The container is not removed while the context is open.
+
+        :param str tool: Name of the Docker image
+        :param list[str] parameters: Command line arguments to be passed to the tool
+        :param str work_dir: Work directory of the call, inside the pool root
+        :param dict[str,str] env: Environment variables of the call
+        :param list[str] docker_parameters: Parameters to pass to `docker run` when the container is started
+        :param list[str] exec_parameters: Parameters to pass to `docker exec`
+        :return: Command line and the name of the container
+        :rtype: tuple(list[str], str)
+        """
+        work_dir = os.path.abspath(work_dir)
+        name = self._name(tool, docker_parameters)
+        path = os.path.join(self.state_dir, name)
+        with open(path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            try:
+                record = self._running(f, name)
+                if record is None:
+                    # Converting the lock is not atomic, so another call may have started the container in between
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    record = self._running(f, name) or self._start(f, name, tool, docker_parameters)
+                    # Mark the container as used before the lock is downgraded, so that it is not reaped in between
+                    os.utime(path, None)
+                    fcntl.flock(f, fcntl.LOCK_SH)
+                    self._spawn_reaper()
+                os.utime(path, None)
+                command = ['docker', 'exec', '-w', work_dir] + (exec_parameters or [])
+                for e, v in (env or {}).iteritems():
+                    command.extend(['-e', '{}={}'.format(e, translate_paths(v, work_dir))])
+                command.append(name)
+                # Docker replaces the image's command, but not its entrypoint, with the parameters
+                command += record['entrypoint'] + [translate_paths(p, work_dir)
+                                                   for p in parameters or record['cmd']]
+                yield command, name
+            finally:
+                os.utime(path, None)
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self.reap()
+
+    def reap(self, idle_timeout=None):
+        """
+        Removes the containers that have been idle for longer than idle_timeout and are not in use
+
+        :param int idle_timeout: Overrides the idle timeout of the pool, e.g. 0 to remove every unused container
+        """
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        for name in os.listdir(self.state_dir):
+            path = os.path.join(self.state_dir, name)
+            if os.path.getsize(path) == 0 or time.time() - os.path.getmtime(path) < idle_timeout:
+                continue
+            with open(path, 'a+') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue  # In use
+                try:
+                    if os.fstat(f.fileno()).st_size and time.time() - os.path.getmtime(path) >= idle_timeout:
+                        _remove(name)
+                        f.truncate(0)
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def run_reaper(self, interval=None):
+        """
+        Reaps the pool every interval seconds until it has no containers left. At most one reaper runs per pool root,
+        so this returns at once if another process is reaping.
+
+        :param float interval: Seconds between reaps. Defaults to the idle timeout, at most a minute.
+        """
+        interval = min(self.idle_timeout, 60) if interval is None else interval
+        with open(self.state_dir + '.reaper', 'a') as lock:
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    return  # Another reaper is running
+                while self._containers():
+                    time.sleep(interval)
+                    self.reap()
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                # A container started while the lock was held would not have started a reaper of its own
+                if not self._containers():
+                    return
+
+    def _containers(self):
+        """
+        :return: True if the pool has containers that have not been removed
+        :rtype: bool
+        """
+        return any(os.path.getsize(os.path.join(self.state_dir, x)) for x in os.listdir(self.state_dir))
+
+    def _spawn_reaper(self):
+        """
+        Starts `run_reaper` in a detached process, which outlives the job that started the container
+        """
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen([sys.executable, '-m', 'toil_scripts.lib.docker_pool', self.root, str(self.idle_timeout)],
+                             stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+
+    def _name(self, tool, docker_parameters):
+        key = json.dumps([self.root, tool, docker_parameters or []])
+        return 'toil-scripts-pool-' + hashlib.sha1(key).hexdigest()[:16]
+
+    def _running(self, f, name):
+        """
+        :return: The record of the container if it is running
+        :rtype: dict
+        """
+        f.seek(0)
+        content = f.read()
+        if not content:
+            return None
+        with open(os.devnull, 'w') as devnull:
+            state = subprocess.Popen(['docker', 'inspect', '--format', '{{.State.Running}}', name],
+                                     stdout=subprocess.PIPE, stderr=devnull).communicate()[0]
+        return json.loads(content) if state.strip() == 'true' else None
+
+    def _start(self, f, name, tool, docker_parameters):
+        """
+        Starts the container and writes its record
+
+        :return: The record of the container
+        :rtype: dict
+        """
+        _remove(name)
+        with open(os.devnull, 'w') as devnull:
+            if subprocess.call(['docker', 'inspect', tool], stdout=devnull, stderr=devnull):
+                subprocess.check_call(['docker', 'pull', tool], stdout=devnull)
+        entrypoint, cmd = _image_config(tool)
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['docker', 'run', '-d', '--log-driver=none', '--name', name,
+                                   '-v', '{0}:{0}'.format(self.root), '--entrypoint', 'tail'] +
+                                  (docker_parameters or []) + [tool, '-f', '/dev/null'], stdout=devnull)
+        record = dict(tool=tool, entrypoint=entrypoint, cmd=cmd)
+        f.seek(0)
+        f.truncate()
+        json.dump(record, f)
+        f.flush()
+        return record
+
+
+# /data as a whole argument, after =, :, a comma, a quote or whitespace, or attached to a single letter flag (-o/data)
+_data_pattern = re.compile(r'''(?:^|(?<=[=:,\s'"])|(?<=^-\w)|(?<=\s-\w))/data(?=[/\s'",:;]|$)''')
+
+
+def translate_paths(value, work_dir):
+    """
+    Rewrites references to /data, as a whole argument, after =, :, a comma, a quote or whitespace, or attached to a
+    single letter flag such as -o/data/out, to the work directory. Other references, e.g. in files read by the tool,
+    are left as they are.
+    """
+    return _data_pattern.sub(work_dir, value)
+
+
+def _image_config(tool):
+    """
+    :param str tool: Name of the Docker image, which must be present
+    :return: Entrypoint and command of the image
+    :rtype: tuple(list[str], list[str])
+    """
+    config = subprocess.check_output(['docker', 'inspect', '--format',
+                                      '{{json .Config.Entrypoint}}\n{{json .Config.Cmd}}', tool])
+    entrypoint, cmd = [json.loads(x) or [] for x in config.splitlines()]
+    return entrypoint, cmd
+
+
+def _entrypoint_uses_data(tool):
+    """
+    :param str tool: Name of the Docker image
+    :return: True if a file of the image's entrypoint, looked up on its PATH, mentions /data or cannot be checked
+    :rtype: bool
+    """
+    entrypoint = _image_config(tool)[0]
+    if not entrypoint:
+        return False
+    script = 'for f; do p=$(command -v "$f") && grep -qs /data "$p" && exit 0; done; exit 1'
+    with open(os.devnull, 'w') as devnull:
+        status = subprocess.call(['docker', 'run', '--rm', '--log-driver=none', '--entrypoint', 'sh', tool,
+                                  '-c', script, 'sh'] + entrypoint, stdout=devnull, stderr=devnull)
+    return status != 1
+
+
+def _remove(name):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(['docker', 'rm', '-f', name], stdout=devnull, stderr=devnull)
+
+
+if __name__ == '__main__':
+    # Detached reaper of a pool, see ContainerPool.run_reaper
+    ContainerPool(sys.argv[1], idle_timeout=int(sys.argv[2])).run_reaper()
@@ -0,0 +1,323 @@
+import gzip
+import json
+import os
+from contextlib import closing
+from functools import partial
+from multiprocessing import Pool
+
+# Phred scores are binned up to this value, higher scores are counted in the last bin
+MAX_QUALITY = 63
+# Index of each base in per-position counts: A, C, G, T, and N for every other character
+BASES = 'ACGTN'
+
+
+def fastq_qc(path, batch_bytes=16 * 1024 * 1024, kmer_size=7, kmer_fraction=0.05, top_kmers=20, seed=0):
+    """
+    Quality control of a FASTQ file in a single streaming pass. Reads are parsed in batches of about batch_bytes into
+    NumPy arrays of one row per read, padded to the longest read of the batch, so the statistics are computed with
+    array operations rather than per read. Qualities are read as Phred+33.
+
+    The summary holds the number of reads and bases, the read length histogram, the quality distribution (mean and
+    10th, 25th, 50th, 75th and 90th percentiles) and base composition of each position, the histogram of the GC
+    content and mean quality of the reads, the N content, and the k-mers most enriched over their expected frequency
+    in a random sample of the reads. This requires the numpy package.
+
+    :param str path: Path of the FASTQ file, which may be gzipped
+    :param int batch_bytes: Bytes of the file read per batch
+    :param int kmer_size: Length of the k-mers counted
+    :param float kmer_fraction: Fraction of the reads whose k-mers are counted
+    :param int top_kmers: Number of k-mers reported
+    :param int seed: Seed of the sample of reads whose k-mers are counted
+    :return: Summary of the file
+    :rtype: dict
+    """
+    numpy = _numpy()
+    stats = _Stats(kmer_size)
+    random = numpy.random.RandomState(seed)
+    for sequences, qualities in _read_batches(path, batch_bytes):
+        stats.add(sequences, qualities, random.random_sample(len(sequences)) < kmer_fraction)
+    return stats.summary(top_kmers)
+
+
+def fastq_qc_files(paths, output_dir, names=None, **kwargs):
+    """
+    Runs `fastq_qc` on each file in a worker process of its own, e.g. for both mates of a paired sample, and writes a
+    JSON summary and an HTML report of each file to the output directory as NAME_qc.json and NAME_qc.html.
+
+    :param list[str] paths: Paths of the FASTQ files
+    :param str output_dir: Directory to write the summaries and reports to
+    :param list[str] names: Name of each file. Defaults to the file names without extensions.
+    :param kwargs: Options of `fastq_qc`
+    :return: Paths of the summaries and reports
+    :rtype: list[str]
+    """
+    _numpy()
+    names = names or [os.path.basename(x).split('.')[0] for x in paths]
+    if len(paths) > 1:
+        with closing(Pool(len(paths))) as pool:
+            summaries = pool.map(partial(fastq_qc, **kwargs), paths)
+    else:
+        summaries = [fastq_qc(x, **kwargs) for x in paths]
+    output_files = []
+    for name, summary in zip(names, summaries):
+        summary['name'] = name
+        json_path = os.path.join(output_dir, name + '_qc.json')
+        with open(json_path, 'w') as f:
+            json.dump(summary, f, sort_keys=True, separators=(',', ':'))
+        html_path = os.path.join(output_dir, name + '_qc.html')
+        with open(html_path, 'w') as f:
+            f.write(qc_html(summary))
+        output_files.extend([json_path, html_path])
+    return output_files
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError('FASTQ quality control requires the numpy package: pip install numpy')
+    return numpy
+
+
+def _open_fastq(path):
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == '\x1f\x8b'
+    return gzip.open(path, 'rb') if gzipped else open(path, 'rb')
+
+
+def _read_batches(path, batch_bytes):
+    """
+    Yields the reads of a FASTQ file in batches. Records are four lines: a header starting with @, the sequence, a
+    separator and the qualities.
+
+    :param str path: Path of the FASTQ file, which may be gzipped
+    :param int batch_bytes: Bytes read per batch
+    :return: Sequences and qualities of the reads of each batch
+    :rtype: iter[tuple(list[str], list[str])]
+    """
+    rest = ''
+    with _open_fastq(path) as f:
+        while True:
+            chunk = f.read(batch_bytes)
+            lines = (rest + chunk).split('\n')
+            # The last line is incomplete unless the file has ended
+            rest = lines.pop() if chunk else ''
+            if not chunk and lines and not lines[-1]:
+                lines.pop()
+            complete = len(lines) - len(lines) % 4
+            if not chunk and complete < len(lines):
+                raise ValueError('Truncated FASTQ record at the end of ' + path)
+            if complete < len(lines):
+                rest = '\n'.join(lines[complete:] + [rest])
+            del lines[complete:]
+            if lines:
+                if '\r' in chunk:
+                    lines = [x.rstrip('\r') for x in lines]
+                if any(not x.startswith('@') for x in lines[0::4]):
+                    raise ValueError('Malformed FASTQ record in ' + path)
+                yield lines[1::4], lines[3::4]
+            if not chunk:
+                break
+
+
+class _Stats(object):
+    """
+    Counts of the reads of a FASTQ file, accumulated batch by batch. Per-position counts grow with the longest read.
+    """
+    def __init__(self, kmer_size):
+        numpy = _numpy()
+        self.kmer_size = kmer_size
+        self.reads = 0
+        self.lengths = numpy.zeros(1, numpy.int64)
+        self.qualities = numpy.zeros((0, MAX_QUALITY + 1), numpy.int64)
+        self.bases = numpy.zeros((0, len(BASES)), numpy.int64)
+        self.gc = numpy.zeros(101, numpy.int64)
+        self.read_qualities = numpy.zeros(MAX_QUALITY + 1, numpy.int64)
+        self.kmers = numpy.zeros(4 ** kmer_size, numpy.int64)
+        self.kmer_reads = 0
+        self.codes = numpy.full(256, BASES.index('N'), numpy.uint8)
+        for i, base in enumerate('ACGT'):
+            self.codes[ord(base)] = self.codes[ord(base.lower())] = i
+
+    def add(self, sequences, qualities, sampled):
+        """
+        :param list[str] sequences: Sequences of a batch of reads
+        :param list[str] qualities: Qualities of the reads
+        :param numpy.ndarray sampled: True for the reads whose k-mers are counted
+        """
+        numpy = _numpy()
+        lengths = numpy.fromiter((len(x) for x in sequences), numpy.int64, len(sequences))
+        if not numpy.array_equal(lengths, numpy.fromiter((len(x) for x in qualities), numpy.int64, len(qualities))):
+            raise ValueError('Sequence and quality of a read differ in length')
+        width = int(lengths.max())
+        self._grow(width)
+        # One row per read, padded with zeros after its end
+        mask = numpy.arange(width) < lengths[:, None]
+        codes = numpy.zeros((len(sequences), width), numpy.uint8)
+        codes[mask] = self.codes[numpy.frombuffer(''.join(sequences), numpy.uint8)]
+        quals = numpy.zeros((len(sequences), width), numpy.uint8)
+        quals[mask] = numpy.clip(numpy.frombuffer(''.join(qualities), numpy.uint8), 33, 33 + MAX_QUALITY) - 33
+        positions = numpy.arange(width)[None, :]
+        self.reads += len(sequences)
+        self.lengths = _add(self.lengths, numpy.bincount(lengths))
+        self.qualities[:width] += numpy.bincount((positions * (MAX_QUALITY + 1) + quals)[mask],
+                                                 minlength=width * (MAX_QUALITY + 1)).reshape(width, MAX_QUALITY + 1)
+        self.bases[:width] += numpy.bincount((positions * len(BASES) + codes)[mask],
+                                             minlength=width * len(BASES)).reshape(width, len(BASES))
+        nonzero = numpy.maximum(lengths, 1)
+        gc = (((codes == 1) | (codes == 2)) & mask).sum(axis=1)
+        self.gc += numpy.bincount(numpy.rint(100.0 * gc / nonzero).astype(numpy.int64), minlength=101)
+        mean_quality = numpy.rint(quals.sum(axis=1) / nonzero.astype(float)).astype(numpy.int64)
+        self.read_qualities += numpy.bincount(mean_quality, minlength=MAX_QUALITY + 1)
+        if sampled.any():
+            self._add_kmers(codes[sampled], lengths[sampled])
+
+    def _add_kmers(self, codes, lengths):
+        """
+        Counts the k-mers of reads as 2-bit encoded integers, skipping k-mers that contain an N or pass the read's end
+        """
+        numpy = _numpy()
+        k = self.kmer_size
+        windows = codes.shape[1] - k + 1
+        self.kmer_reads += len(codes)
+        if windows < 1:
+            return
+        values = numpy.zeros((len(codes), windows), numpy.int64)
+        valid = numpy.arange(windows) + k <= lengths[:, None]
+        for i in xrange(k):
+            column = codes[:, i:i + windows]
+            valid &= column < 4
+            values = (values << 2) | (column & 3)
+        self.kmers += numpy.bincount(values[valid], minlength=len(self.kmers))
+
+    def _grow(self, width):
+        numpy = _numpy()
+        if width > len(self.bases):
+            self.qualities = numpy.vstack([self.qualities, numpy.zeros((width - len(self.qualities), MAX_QUALITY + 1),
+                                                                       numpy.int64)])
+            self.bases = numpy.vstack([self.bases, numpy.zeros((width - len(self.bases), len(BASES)), numpy.int64)])
+
+    def summary(self, top_kmers):
+        """
+        :param int top_kmers: Number of k-mers reported
+        :return: Summary of the counts (see `fastq_qc`)
+        :rtype: dict
+        """
+        numpy = _numpy()
+        bases = int(self.bases.sum())
+        covered = numpy.maximum(self.bases.sum(axis=1), 1)
+        cumulative = self.qualities.cumsum(axis=1)
+        quality = dict(mean=_round(self.qualities.dot(numpy.arange(MAX_QUALITY + 1)) / covered.astype(float)))
+        for name, fraction in [('p10', 0.1), ('p25', 0.25), ('median', 0.5), ('p75', 0.75), ('p90', 0.9)]:
+            quality[name] = (cumulative < fraction * cumulative[:, -1:]).sum(axis=1).tolist()
+        composition = self.bases / covered[:, None].astype(float)
+        observed = numpy.flatnonzero(self.lengths)
+        return dict(reads=self.reads, bases=bases,
+                    length=dict(min=int(observed[0]) if self.reads else 0, max=int(observed[-1]) if self.reads else 0,
+                                mean=round(float(bases) / max(self.reads, 1), 2),
+                                histogram={int(x): int(self.lengths[x]) for x in observed}),
+                    per_position=dict(quality=quality,
+                                      bases={base: _round(100 * composition[:, i]) for i, base in enumerate(BASES)}),
+                    gc=dict(mean=round(100.0 * self.bases[:, 1:3].sum() / max(bases, 1), 2),
+                            histogram=self.gc.tolist()),
+                    read_quality=dict(histogram=self.read_qualities.tolist()),
+                    n_content=dict(percent=round(100.0 * self.bases[:, 4].sum() / max(bases, 1), 4),
+                                   max_per_position=round(100 * float(composition[:, 4].max()), 4)
+                                   if len(composition) else 0.0),
+                    kmers=dict(k=self.kmer_size, sampled_reads=self.kmer_reads, top=self._top_kmers(top_kmers)))
+
+    def _top_kmers(self, n):
+        """
+        :return: The k-mers most enriched over the frequency expected from the base composition, with their count,
+                 percent of the counted k-mers and ratio of observed to expected frequency
+        :rtype: list[dict]
+        """
+        numpy = _numpy()
+        total = self.kmers.sum()
+        acgt = self.bases[:, :4].sum(axis=0).astype(float)
+        if not total or not acgt.sum():
+            return []
+        # Expected frequency of each k-mer is the product of the frequencies of its bases
+        expected = numpy.ones(len(self.kmers))
+        frequencies = acgt / acgt.sum()
+        for i in xrange(self.kmer_size):
+            expected *= frequencies[(numpy.arange(len(self.kmers)) >> (2 * i)) & 3]
+        enrichment = numpy.where(expected > 0, self.kmers / (total * numpy.maximum(expected, 1e-300)), 0)
+        top = [x for x in numpy.argsort(-enrichment, kind='mergesort')[:n] if self.kmers[x]]
+        return [dict(kmer=_decode_kmer(x, self.kmer_size), count=int(self.kmers[x]),
+                     percent=round(100.0 * self.kmers[x] / total, 4), enrichment=round(float(enrichment[x]), 2))
+                for x in top]
+
+
+def _add(a, b):
+    """
+    :return: Sum of two 1-D arrays, padded with zeros to the longer one
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    a = a.copy()
+    a[:len(b)] += b
+    return a
+
+
+def _round(values):
+    return [round(float(x), 2) for x in values]
+
+
+def _decode_kmer(value, k):
+    return ''.join('ACGT'[(value >> (2 * (k - 1 - i))) & 3] for i in xrange(k))
+
+
+def qc_html(summary):
+    """
+    :param dict summary: Summary of `fastq_qc`, with the name of the file
+    :return: Self-contained HTML report of the summary, with inline SVG plots
+    :rtype: str
+    """
+    quality = summary['per_position']['quality']
+    positions = len(quality['mean'])
+    rows = [('Reads', summary['reads']), ('Bases', summary['bases']),
+            ('Read length', '{min}-{max} (mean {mean})'.format(**summary['length'])),
+            ('GC', '{}%'.format(summary['gc']['mean'])), ('N', '{}%'.format(summary['n_content']['percent']))]
+    kmers = summary['kmers']
+    html = ['<!DOCTYPE html><html><head><meta charset="utf-8"><title>QC: {0}</title>'
+            '<style>body{{font-family:sans-serif}}td,th{{padding:2px 8px;text-align:left}}</style>'
+            '</head><body><h1>{0}</h1><table>'.format(_escape(summary.get('name', '')))]
+    html.extend('<tr><th>{}</th><td>{}</td></tr>'.format(k, v) for k, v in rows)
+    html.append('</table><h2>Quality per position</h2>')
+    html.append(_svg([(quality['p10'], '#ccc'), (quality['p25'], '#999'), (quality['median'], '#c00'),
+                      (quality['p75'], '#999'), (quality['p90'], '#ccc'), (quality['mean'], '#00c')],
+                     max(quality['p90'] or [0]) + 1))
+    html.append('<h2>Base composition per position (%)</h2>')
+    colors = dict(A='#0a0', C='#00c', G='#000', T='#c00', N='#aaa')
+    html.append(_svg([(summary['per_position']['bases'][x], colors[x]) for x in BASES], 100))
+    html.append('<p>A green, C blue, G black, T red, N grey, over {} positions</p>'.format(positions))
+    html.append('<h2>GC content of reads (%)</h2>')
+    html.append(_svg([(summary['gc']['histogram'], '#0a0')], max(summary['gc']['histogram']) or 1))
+    html.append('<h2>Enriched {}-mers in {} sampled reads</h2><table><tr><th>k-mer</th><th>Count</th><th>%</th>'
+                '<th>Observed/expected</th></tr>'.format(kmers['k'], kmers['sampled_reads']))
+    html.extend('<tr><td><code>{kmer}</code></td><td>{count}</td><td>{percent}</td><td>{enrichment}</td></tr>'
+                .format(**x) for x in kmers['top'])
+    html.append('</table></body></html>\n')
+    return ''.join(html)
+
+
+def _svg(series, y_max, width=600, height=200):
+    """
+    :param list[tuple(list[float], str)] series: Values and color of each line
+    :param float y_max: Value at the top of the plot
+    :return: SVG element plotting each series as a line
+    :rtype: str
+    """
+    lines = []
+    for values, color in series:
+        x_scale = float(width) / max(len(values) - 1, 1)
+        points = ' '.join('{:.1f},{:.1f}'.format(i * x_scale, height - height * float(v) / y_max)
+                          for i, v in enumerate(values))
+        lines.append('<polyline fill="none" stroke="{}" points="{}"/>'.format(color, points))
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" style="border:1px solid #ddd">{2}'
+            '<text x="2" y="12" font-size="10">{3}</text></svg>'.format(width, height, ''.join(lines), y_max))
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
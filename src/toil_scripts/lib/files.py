@@ -1,10 +1,19 @@
-from contextlib import closing
+from collections import deque
+from contextlib import closing, contextmanager
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+import ctypes
+import errno
+import fcntl
 import os
+import struct
+import sys
 import tarfile
 import shutil
+import zlib
 
 
-def tarball_files(tar_name, file_paths, output_dir='.', prefix=''):
+def tarball_files(tar_name, file_paths, output_dir='.', prefix='', num_cores=1, compression='gz', fileobj=None):
     """
     Creates a tarball from a group of files
 
@@ -12,8 +21,16 @@ def tarball_files(tar_name, file_paths, output_dir='.', prefix=''):
     :param list[str] file_paths: Absolute file paths to include in the tarball
     :param str output_dir: Output destination for tarball
     :param str prefix: Optional prefix for files in tarball
+    :param int num_cores: Number of blocks to compress concurrently
+    :param str compression: 'gz' or 'zst', see `open_tar_writer`
+    :param file fileobj: File object to stream the tarball to instead of writing it to output_dir, e.g. a file store
+                         write stream or an S3 upload (see `toil_scripts.lib.urls.open_s3_upload`)
     """
-    with tarfile.open(os.path.join(output_dir, tar_name), 'w:gz') as f_out:
+    if fileobj is None:
+        with open(os.path.join(output_dir, tar_name), 'wb') as f:
+            return tarball_files(tar_name, file_paths, prefix=prefix, num_cores=num_cores, compression=compression,
+                                 fileobj=f)
+    with open_tar_writer(fileobj, num_cores=num_cores, compression=compression) as f_out:
         for file_path in file_paths:
             if not file_path.startswith('/'):
                 raise ValueError('Path provided is relative not absolute.')
@@ -21,18 +38,154 @@ def tarball_files(tar_name, file_paths, output_dir='.', prefix=''):
             f_out.add(file_path, arcname=arcname)
 
 
-def copy_files(file_paths, output_dir):
+def tarball_files_job(job, file_paths, prefix='', num_cores=1):
     """
-    Moves files from the working directory to the output directory.
+    Job version of `tarball_files` that streams the tarball into the file store, without a local copy
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list[str] file_paths: Absolute file paths to include in the tarball
+    :param str prefix: Optional prefix for files in tarball
+    :param int num_cores: Number of blocks to compress concurrently
+    :return: FileStoreID of the tarball
+    :rtype: str
+    """
+    with job.fileStore.writeGlobalFileStream() as (f_out, file_id):
+        tarball_files(None, file_paths, prefix=prefix, num_cores=num_cores, fileobj=f_out)
+    return file_id
+
+
+def copy_files(file_paths, output_dir, hardlink=False):
+    """
+    Places files from the working directory in the output directory.
+
+    Each file is cloned (FICLONE) if the filesystem supports it, otherwise copied within the kernel with
+    copy_file_range or sendfile, or, failing all of those, copied through a buffer. A file that is already in place
+    (the same file as its destination) is left alone.
+
+    With hardlink, files are hardlinked instead where the output directory is on the same filesystem. A hardlinked
+    output shares its inode, and so its content and permissions, with the source file, so this is only safe if the
+    source is never modified again, e.g. it is not in a file store cache and no tool rewrites it.
 
     :param str output_dir: Output directory
-    :param list[str] file_paths: Absolute file paths to move
+    :param list[str] file_paths: Absolute file paths to place
+    :param bool hardlink: Hardlink files where possible
+    :return: Method used for each file: 'same', 'hardlink', 'reflink', 'copy_file_range', 'sendfile' or 'copy'
+    :rtype: list[str]
     """
+    methods = []
     for file_path in file_paths:
         if not file_path.startswith('/'):
             raise ValueError('Path provided is relative not absolute.')
         dest = os.path.join(output_dir, os.path.basename(file_path))
-        shutil.copy(file_path, dest)
+        methods.append(_place_file(os.path.realpath(file_path), dest, hardlink=hardlink))
+    return methods
+
+
+def _place_file(src, dest, hardlink=False):
+    """
+    Places a file at dest using the cheapest method available, see `copy_files`
+
+    :param str src: Path of the source file
+    :param str dest: Path to place the file at, replaced if it exists
+    :param bool hardlink: Hardlink the file if possible
+    :return: Method used
+    :rtype: str
+    """
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    if os.path.exists(dest):
+        if os.path.samefile(src, dest):
+            return 'same'
+        os.remove(dest)
+    if hardlink:
+        try:
+            os.link(src, dest)
+            return 'hardlink'
+        except OSError:
+            pass
+    size = os.path.getsize(src)
+    with open(src, 'rb') as f_in, open(dest, 'wb') as f_out:
+        for method, func in [('reflink', _reflink), ('copy_file_range', _copy_file_range), ('sendfile', _sendfile)]:
+            try:
+                func(f_in.fileno(), f_out.fileno(), size)
+                break
+            except (OSError, IOError, AttributeError):
+                # Start over with the next method from the start of the source and an empty file
+                os.lseek(f_in.fileno(), 0, os.SEEK_SET)
+                os.lseek(f_out.fileno(), 0, os.SEEK_SET)
+                os.ftruncate(f_out.fileno(), 0)
+        else:
+            method = 'copy'
+            shutil.copyfileobj(f_in, f_out, 16 * 1024 * 1024)
+    shutil.copymode(src, dest)
+    return method
+
+
+_FICLONE = 0x40049409
+_libc = None
+
+
+def _syscall(name):
+    """
+    Python 2.7 exposes neither sendfile nor copy_file_range, so they are called through libc
+
+    :param str name: Name of the libc function
+    :return: The function, raising OSError on failure
+    :rtype: function
+    """
+    global _libc
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.ENOSYS, '{} is only used on Linux'.format(name))
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    func = getattr(_libc, name)  # AttributeError if libc is too old
+
+    def call(*args):
+        result = func(*args)
+        if result < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return result
+    return call
+
+
+def _reflink(fd_in, fd_out, size):
+    """
+    Shares the extents of fd_in with fd_out, on filesystems with copy-on-write support (btrfs, XFS)
+    """
+    fcntl.ioctl(fd_out, _FICLONE, fd_in)
+
+
+def _copy_file_range(fd_in, fd_out, size):
+    """
+    Copies within the kernel, which also clones extents on filesystems that support it (Linux 4.5+)
+    """
+    copy_file_range = _syscall('copy_file_range')
+    _copy_loop(lambda n: copy_file_range(fd_in, None, fd_out, None, ctypes.c_size_t(n), 0), size)
+
+
+def _sendfile(fd_in, fd_out, size):
+    """
+    Copies within the kernel without passing the data through user space (Linux 2.6.33+ for file targets)
+    """
+    sendfile = _syscall('sendfile')
+    _copy_loop(lambda n: sendfile(fd_out, fd_in, None, ctypes.c_size_t(n)), size)
+
+
+def _copy_loop(copy, size, chunk=1024 * 1024 * 1024):
+    """
+    Calls copy with the number of bytes still to copy until size bytes have been copied
+
+    :param function copy: Copies at most n bytes, returning the number copied
+    :param int size: Number of bytes to copy
+    :param int chunk: Maximum number of bytes per call
+    """
+    copied = 0
+    while copied < size:
+        n = copy(min(chunk, size - copied))
+        if n == 0:
+            raise OSError(errno.EIO, 'Source file shrank while being copied')
+        copied += n
 
 
 def copy_file_job(job, name, file_id, output_dir):
@@ -46,16 +199,18 @@ def copy_file_job(job, name, file_id, output_dir):
     """
     work_dir = job.fileStore.getLocalTempDir()
     fpath = job.fileStore.readGlobalFile(file_id, os.path.join(work_dir, name))
-    copy_files([fpath], output_dir)
+    method, = copy_files([fpath], output_dir)
+    job.fileStore.logToMaster('Placed {} in {} ({})'.format(name, output_dir, method))
 
 
-def consolidate_tarballs_job(job, fname_to_id):
+def consolidate_tarballs_job(job, fname_to_id, num_cores=1):
     """
     Combine the contents of separate tarballs into one.
     Subdirs within the tarball will be named the keys in **fname_to_id
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
     :param dict[str,str] fname_to_id: Dictionary of the form: file-name-prefix=FileStoreID
+    :param int num_cores: Number of blocks to compress concurrently
     :return: The file store ID of the generated tarball
     :rtype: str
     """
@@ -65,16 +220,270 @@ def consolidate_tarballs_job(job, fname_to_id):
     for fname, file_store_id in fname_to_id.iteritems():
         p = job.fileStore.readGlobalFile(file_store_id, os.path.join(work_dir, fname + '.tar.gz'))
         tar_paths.append((p, fname))
-    # I/O
     # output_name is arbitrary as this job function returns a FileStoreId
     output_name = 'foo.tar.gz'
-    out_tar = os.path.join(work_dir, output_name)
-    # Consolidate separate tarballs into one
-    with tarfile.open(os.path.join(work_dir, out_tar), 'w:gz') as f_out:
-        for tar, fname in tar_paths:
-            with tarfile.open(tar, 'r') as f_in:
-                for tarinfo in f_in:
-                    with closing(f_in.extractfile(tarinfo)) as f_in_file:
-                        tarinfo.name = os.path.join(output_name, fname, os.path.basename(tarinfo.name))
-                        f_out.addfile(tarinfo, fileobj=f_in_file)
-    return job.fileStore.writeGlobalFile(out_tar)
+    # Consolidate separate tarballs into one, streamed into the file store
+    with job.fileStore.writeGlobalFileStream() as (f_out, file_id):
+        consolidate_tarballs(f_out, [(tar, os.path.join(output_name, fname)) for tar, fname in tar_paths],
+                             num_cores=num_cores)
+    return file_id
+
+
+def consolidate_tarballs(fileobj, tars, num_cores=1):
+    """
+    Combines the contents of tarballs into one, placing the members of each in a subdir. The data of tarballs written
+    by `open_tar_writer` is copied as compressed blocks, only the member headers are rewritten. Other tarballs are
+    decompressed and recompressed. Tarballs compressed with zstd require the zstandard package.
+
+    :param file fileobj: File object to write the consolidated tarball to, e.g. a local file, a file store write
+                         stream or an S3 upload (see `toil_scripts.lib.urls.open_s3_upload`)
+    :param list[tuple(str, str)] tars: Path of each tarball and the subdir for its members in the consolidated tarball
+    :param int num_cores: Number of blocks to compress concurrently when recompressing
+    """
+    with open_tar_writer(fileobj, num_cores=num_cores) as f_out:
+        for tar, subdir in tars:
+            members = _tar_blocks(tar)
+            if members is None:
+                with _open_tar_reader(tar) as f_in:
+                    for tarinfo in f_in:
+                        with closing(f_in.extractfile(tarinfo)) as f_in_file:
+                            tarinfo.name = os.path.join(subdir, os.path.basename(tarinfo.name))
+                            f_out.addfile(tarinfo, fileobj=f_in_file)
+            else:
+                with open(tar, 'rb') as f_in:
+                    for tarinfo, blocks in members:
+                        tarinfo.name = os.path.join(subdir, os.path.basename(tarinfo.name))
+                        f_out.addfile_blocks(tarinfo, f_in, blocks)
+
+
+@contextmanager
+def open_tar_writer(fileobj, num_cores=1, compression='gz', block_size=4 * 1024 * 1024, level=6):
+    """
+    Opens a tarball for writing whose compression is split over several cores. The tar stream is cut into blocks
+    that are compressed concurrently, each into a separate gzip member (or zstd frame) written in order. Concatenated
+    members form a valid gzip file, so the tarball can be read with `tar xzf`, gunzip or tarfile.open(path, 'r').
+    Tarballs compressed with zstd (which requires the zstandard package) are read with `tar --zstd -xf`.
+    Each block is compressed without the history of the previous one, so blocks are kept large (4 MiB by default)
+    to stay within a few percent of the single-stream compression ratio.
+
+    Member headers are compressed into blocks of their own, and gzip members record their sizes in an extra field,
+    so that `consolidate_tarballs` can copy the data of members without recompressing it.
+
+    :param file fileobj: File object to write the compressed tarball to
+    :param int num_cores: Number of blocks to compress concurrently
+    :param str compression: 'gz' for gzip or 'zst' for zstd
+    :param int block_size: Size in bytes of the uncompressed blocks
+    :param int level: Compression level
+    :return: Tarball opened for writing
+    :rtype: tarfile.TarFile
+    """
+    if compression == 'gz':
+        compress = _gzip_member
+    elif compression == 'zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError('zstd compression requires the zstandard package: pip install zstandard')
+        compress = lambda data, level: zstandard.ZstdCompressor(level=level).compress(data)
+    else:
+        raise ValueError('Unsupported compression: {}'.format(compression))
+    with closing(_ParallelCompressor(fileobj, compress, num_cores, block_size, level)) as compressor:
+        with _TarWriter(fileobj=compressor, mode='w') as f_out:
+            yield f_out
+
+
+class _TarWriter(tarfile.TarFile):
+    """
+    Tarball written to a `_ParallelCompressor`, with every member header and the end-of-archive marker in a block of
+    its own. The data and padding of a member therefore never share a block with another member.
+    """
+    def addfile(self, tarinfo, fileobj=None):
+        self.fileobj.start_block()
+        tarfile.TarFile.addfile(self, tarinfo, fileobj)
+
+    def addfile_blocks(self, tarinfo, f_in, blocks):
+        """
+        Adds a member whose data is copied as gzip members from a tarball written by `open_tar_writer`
+
+        :param tarfile.TarInfo tarinfo: Member to add
+        :param file f_in: Tarball to copy the data from
+        :param list[tuple(int, int, int)] blocks: Offset, size and uncompressed size of the gzip members that hold
+                                                  the data and padding of the member in f_in
+        """
+        self.addfile(tarinfo)
+        for offset, size, uncompressed_size in blocks:
+            f_in.seek(offset)
+            self.fileobj.write_block(f_in.read(size), uncompressed_size)
+            self.offset += uncompressed_size
+
+    def close(self):
+        if not self.closed and self.mode in 'aw':
+            self.fileobj.start_block()
+        tarfile.TarFile.close(self)
+
+
+class _ParallelCompressor(object):
+    """
+    Write-only file object that compresses the data written to it in blocks on a pool of threads.
+    zlib and zstandard release the GIL while compressing, so blocks are compressed in parallel.
+    """
+    def __init__(self, fileobj, compress, num_cores, block_size, level):
+        self.fileobj = fileobj
+        self.compress = compress
+        self.num_cores = num_cores
+        self.block_size = block_size
+        self.level = level
+        self.pool = ThreadPool(num_cores)
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        self.position = 0
+        self.single_write = False
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.position += len(data)
+        if self.single_write or self.buffered >= self.block_size:
+            self._submit()
+            self.single_write = False
+
+    def start_block(self):
+        """
+        Ends the current block. The next write is compressed into a block of its own.
+        """
+        if self.buffered:
+            self._submit()
+        self.single_write = True
+
+    def write_block(self, block, uncompressed_size):
+        """
+        Writes an already compressed block
+
+        :param str block: Compressed block
+        :param int uncompressed_size: Uncompressed size of the block
+        """
+        self.start_block()
+        self.single_write = False
+        self.position += uncompressed_size
+        self._queue(lambda: block)
+
+    def close(self):
+        try:
+            if self.buffered:
+                self._submit()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft()())
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+
+    def _submit(self):
+        block = ''.join(self.buffer)
+        self.buffer, self.buffered = [], 0
+        self._queue(self.pool.apply_async(self.compress, (block, self.level)).get)
+
+    def _queue(self, get_block):
+        self.pending.append(get_block)
+        # Bound the memory used by blocks waiting to be written
+        while len(self.pending) > 2 * self.num_cores:
+            self.fileobj.write(self.pending.popleft()())
+
+
+# Gzip member header: magic, deflate, FEXTRA flag, no mtime, no extra flags, unknown OS, and a 12 byte extra field
+# with a 'TS' subfield that holds the size of the member and the uncompressed size of its data
+_gzip_header = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x0c\x00TS\x08\x00'
+_gzip_header_size = len(_gzip_header) + 8
+# Magic number of a zstd frame
+_zstd_magic = '\x28\xb5\x2f\xfd'
+
+
+@contextmanager
+def _open_tar_reader(tar_path):
+    """
+    Opens a tarball for reading its members in order. tarfile cannot read zstd, so zstd tarballs (e.g. written by
+    `open_tar_writer` with compression='zst') are decompressed as they are read.
+
+    :param str tar_path: Path to tarball, uncompressed or compressed with gzip, bzip2 or zstd
+    :return: Tarball opened for reading
+    :rtype: tarfile.TarFile
+    """
+    with open(tar_path, 'rb') as f:
+        is_zstd = f.read(len(_zstd_magic)) == _zstd_magic
+    if not is_zstd:
+        with tarfile.open(tar_path, 'r') as f_in:
+            yield f_in
+        return
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('{} is compressed with zstd, which requires the zstandard package: '
+                           'pip install zstandard'.format(tar_path))
+    with open(tar_path, 'rb') as f:
+        # A tarball written by open_tar_writer is a sequence of frames
+        with closing(zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)) as reader:
+            with tarfile.open(fileobj=reader, mode='r|') as f_in:
+                yield f_in
+
+
+def _gzip_member(data, level):
+    """
+    Compresses data into a complete gzip member
+
+    :param str data: Data to compress
+    :param int level: Compression level
+    :return: Gzip member
+    :rtype: str
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    size = _gzip_header_size + len(deflated) + 8
+    return ''.join([_gzip_header, struct.pack('<II', size, len(data)), deflated,
+                    struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)])
+
+
+def _tar_blocks(tar_path):
+    """
+    Lists the members of a tarball written by `open_tar_writer` with the gzip members that hold their data
+
+    :param str tar_path: Path to tarball
+    :return: Each member and the offset, size and uncompressed size of the gzip members of its data,
+             or None if the tarball was not written by `open_tar_writer` with gzip compression
+    :rtype: list[tuple(tarfile.TarInfo, list[tuple(int, int, int)])]
+    """
+    with open(tar_path, 'rb') as f:
+        # Gzip members, from the sizes in their headers
+        blocks = []
+        offset, file_size = 0, os.fstat(f.fileno()).st_size
+        while offset < file_size:
+            f.seek(offset)
+            header = f.read(_gzip_header_size)
+            if len(header) < _gzip_header_size or not header.startswith(_gzip_header):
+                return None
+            size, uncompressed_size = struct.unpack('<II', header[len(_gzip_header):])
+            blocks.append((offset, size, uncompressed_size))
+            offset += size
+        # Tar members: a block with the header, followed by the blocks of their data
+        members, data_size = [], 0
+        for offset, size, uncompressed_size in blocks:
+            if data_size:
+                if uncompressed_size > data_size:
+                    return None
+                members[-1][1].append((offset, size, uncompressed_size))
+                data_size -= uncompressed_size
+                continue
+            f.seek(offset)
+            header = zlib.decompress(f.read(size)[_gzip_header_size:-8], -zlib.MAX_WBITS)
+            if not header.strip('\0'):
+                return members
+            tarinfo = tarfile.open(fileobj=BytesIO(header), mode='r:').firstmember
+            if tarinfo is None or tarinfo.offset_data != len(header):
+                return None
+            members.append((tarinfo, []))
+            if tarinfo.isreg() or tarinfo.type not in tarfile.SUPPORTED_TYPES:
+                data_size = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    # No end-of-archive marker
+    return None
@@ -1,23 +1,406 @@
+import heapq
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
 from toil_scripts.lib import partitions
+from toil_scripts.lib.urls import url_size
 
 
-def map_job(job, func, inputs, *args):
+def map_job(job, func, inputs, *args, **kwargs):
     """
     Spawns a tree of jobs to avoid overloading the number of jobs spawned by a single parent.
     This function is appropriate to use when batching samples greater than 1,000.
 
+    Cheap samples can be packed into batches of batch_size samples, each run by one job that calls func for each of
+    its samples, in sequence or in a pool of batch_workers threads. The calls share the batch job: it must be given
+    the requirements of batch_workers samples at a time, children added by func are children of the batch job, and a
+    failed sample fails and retries the whole batch. Toil's Job and FileStore are not thread-safe, so with several
+    workers func is given a proxy of the batch job that calls their methods one at a time (see `_SerializedJob`).
+
+    If max_in_flight is set, the samples (or batches) are dealt into that many lanes instead of a tree. Each lane runs
+    its samples one after the other, the next starting once the jobs of the previous sample are all done, so at most
+    max_in_flight samples use disk at any time. Toil only starts the rest of a lane once the jobs of a sample have
+    succeeded, so a sample that fails for good stops its lane: the remaining samples of the lane are not run, and the
+    workflow fails once the other lanes are done. Rerun the workflow, or restart it, to process them.
+
+    Given a cost per sample, either as costs or as the total size of the sample's input URLs (see `sample_sizes`),
+    samples are scheduled longest first, so that the largest samples don't start last and leave a long tail. The
+    partitions of the tree, or the lanes, are then balanced by their total cost rather than by their number of samples.
+
     :param JobFunctionWrappingJob job: passed automatically by Toil
     :param function func: Function to spawn dynamically, passes one sample as first argument
     :param list inputs: Array of samples to be batched
     :param list args: any arguments to be passed to the function
+    :param int batch_size: Keyword only. Number of samples per job. Default: 1
+    :param int batch_workers: Keyword only. Number of samples of a batch run at a time. Default: 1
+    :param dict batch_requirements: Keyword only. Requirements of batch jobs, e.g. dict(cores=4, disk='20G')
+    :param int max_in_flight: Keyword only. Maximum number of samples, or batches, processed at once. Default: no limit
+    :param list[float] costs: Keyword only. Estimated cost of each sample, e.g. the size of its inputs
+    :param function sample_urls: Keyword only. Called as sample_urls(sample) to get the input URLs of a sample, whose
+                                 total size is its cost if costs are not given. Must be a module-level function.
+    :param str s3_key_path: Keyword only. Path to 32-byte encryption key if inputs are S3 files that use SSE-C
+    """
+    options = dict(batch_size=1, batch_workers=1, batch_requirements={}, max_in_flight=None)
+    costs = kwargs.pop('costs', None)
+    urls_func, s3_key_path = kwargs.pop('sample_urls', None), kwargs.pop('s3_key_path', None)
+    unknown = set(kwargs) - set(options)
+    if unknown:
+        raise TypeError('Unexpected keyword arguments to map_job: {}'.format(', '.join(sorted(unknown))))
+    options.update(kwargs)
+    if costs is None and urls_func:
+        costs = sample_sizes(inputs, urls_func, s3_key_path=s3_key_path)
+    if costs is not None:
+        # Longest first, samples of equal cost in manifest order
+        order = sorted(xrange(len(inputs)), key=lambda i: -costs[i])
+        inputs, costs = [inputs[i] for i in order], [costs[i] for i in order]
+        job.fileStore.logToMaster('Scheduling {} samples longest first, costs from {} to {}'.format(
+            len(inputs), costs[0] if costs else None, costs[-1] if costs else None))
+    units, unit_costs = inputs, costs
+    if options['batch_size'] > 1:
+        size = options['batch_size']
+        units = [inputs[i:i + size] for i in xrange(0, len(inputs), size)]
+        unit_costs = [sum(costs[i:i + size]) for i in xrange(0, len(inputs), size)] if costs is not None else None
+    if options['max_in_flight']:
+        num_lanes = min(options['max_in_flight'], len(units))
+        if unit_costs is None:
+            lanes = [units[i::options['max_in_flight']] for i in xrange(num_lanes)]
+        else:
+            lanes = [lane for lane, _ in _balanced_partitions(units, unit_costs, num_lanes)]
+        for lane in lanes:
+            job.addChildJobFn(_map_lane, func, lane, options, *args)
+    else:
+        _map_tree(job, func, units, options, *args, costs=unit_costs)
+
+
+def _map_tree(job, func, units, options, *args, **kwargs):
+    """
+    Spawns the units of `map_job` (samples or batches), through a tree of jobs if there are many. Given the costs of
+    the units, in descending order, partitions are balanced by cost.
     """
+    costs = kwargs.get('costs')
     # num_partitions isn't exposed as an argument in order to be transparent to the user.
     # The value for num_partitions is a tested value
     num_partitions = 100
-    partition_size = len(inputs) / num_partitions
-    if partition_size > 1:
-        for partition in partitions(inputs, partition_size):
-            job.addChildJobFn(map_job, func, partition, *args)
+    partition_size = len(units) / num_partitions
+    if partition_size > 1 and costs is not None:
+        num_bins = (len(units) + partition_size - 1) / partition_size
+        for partition, partition_costs in _balanced_partitions(units, costs, num_bins):
+            job.addChildJobFn(_map_tree, func, partition, options, *args, costs=partition_costs)
+    elif partition_size > 1:
+        for partition in partitions(units, partition_size):
+            job.addChildJobFn(_map_tree, func, partition, options, *args)
+    else:
+        for unit in units:
+            _add_unit(job, func, unit, options, *args)
+
+
+def _balanced_partitions(units, costs, num_bins):
+    """
+    Splits units into bins of about equal total cost, adding each unit, largest first, to the cheapest bin
+
+    :param list units: Units in descending order of cost
+    :param list[float] costs: Cost of each unit
+    :param int num_bins: Number of bins
+    :return: Units and their costs per bin, each in descending order of cost, most expensive bins first
+    :rtype: list[tuple(list, list[float])]
+    """
+    bins = [(0, i, [], []) for i in xrange(num_bins)]
+    for unit, cost in zip(units, costs):
+        total, i, bin_units, bin_costs = heapq.heappop(bins)
+        bin_units.append(unit)
+        bin_costs.append(cost)
+        heapq.heappush(bins, (total + cost, i, bin_units, bin_costs))
+    bins.sort(key=lambda x: (-x[0], x[1]))
+    return [(bin_units, bin_costs) for _, _, bin_units, bin_costs in bins if bin_units]
+
+
+def _map_lane(job, func, lane, options, *args):
+    """
+    Spawns the first unit of a lane of `map_job`, and the rest of the lane as a follow-on, which Toil runs once the
+    jobs of the first unit are all done
+    """
+    _add_unit(job, func, lane[0], options, *args)
+    if len(lane) > 1:
+        job.addFollowOnJobFn(_map_lane, func, lane[1:], options, *args)
+
+
+def _add_unit(job, func, unit, options, *args):
+    if options['batch_size'] > 1:
+        job.addChildJobFn(_run_batch, func, unit, options['batch_workers'], *args, **options['batch_requirements'])
+    else:
+        job.addChildJobFn(func, unit, *args)
+
+
+def _run_batch(job, func, samples, num_workers, *args):
+    """
+    Calls func for each sample of a batch within the batch job
+    """
+    job.fileStore.logToMaster('Running a batch of {} samples'.format(len(samples)))
+    if num_workers > 1:
+        pool = ThreadPool(num_workers)
+        shared_job = _SerializedJob(job, threading.RLock())
+        try:
+            pool.map(lambda sample: func(shared_job, sample, *args), samples)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for sample in samples:
+            func(job, sample, *args)
+
+
+class _SerializedJob(object):
+    """
+    Proxy of a job, or of its file store, that is shared by the threads of a batch. Methods are called under a lock,
+    as are __enter__ and __exit__ of the context managers they return, e.g. file store streams. Reads and writes of
+    the streams themselves are not serialized.
+    """
+    def __init__(self, target, lock):
+        self._target = target
+        self._lock = lock
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name == 'fileStore':
+            return _SerializedJob(value, self._lock)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            with self._lock:
+                result = value(*args, **kwargs)
+            return _SerializedContext(result, self._lock) if hasattr(result, '__enter__') else result
+        return call
+
+
+class _SerializedContext(object):
+    """
+    Context manager returned by a method of `_SerializedJob`, entered and exited under the lock
+    """
+    def __init__(self, context, lock):
+        self._context = context
+        self._lock = lock
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+    def __enter__(self):
+        with self._lock:
+            return self._context.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._lock:
+            return self._context.__exit__(exc_type, exc_value, traceback)
+
+
+def map_reduce_job(job, func, combine, inputs, *args, **kwargs):
+    """
+    Variant of `map_job` that combines the return values of func into a single result, through a tree of jobs that
+    each gather at most fan_in results. No job holds more than fan_in promises, so cohorts of any size can be reduced.
+
+    combine is called with a list of at most fan_in results, in the order of inputs: the return values of func for
+    leaves of the tree, and the return values of combine above them. It must therefore be associative, e.g. merging
+    dicts or concatenating lists, and return a value of the same kind as func.
+
+        root = Job.wrapJobFn(map_reduce_job, run_sample, merge_tables, samples, config)
+        root.addFollowOnJobFn(write_cohort_table, root.rv())
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param function func: Job function to run per sample as func(job, sample, *args). Its return value, which may
+                          be a promise, is the result of the sample.
+    :param function combine: Called as combine(results) to combine a list of results. Must be a module-level function.
+    :param list inputs: Array of samples
+    :param list args: any arguments to be passed to func
+    :param int fan_in: Keyword only. Maximum number of results combined by one job. Default: 100
+    :param dict combine_requirements: Keyword only. Requirements of the combine jobs, e.g. dict(memory='8G')
+    :return: Combined result of all samples, or None if there are none
+    """
+    options = dict(fan_in=100, combine_requirements={})
+    unknown = set(kwargs) - set(options)
+    if unknown:
+        raise TypeError('Unexpected keyword arguments to map_reduce_job: {}'.format(', '.join(sorted(unknown))))
+    options.update(kwargs)
+    if options['fan_in'] < 2:
+        raise ValueError('The fan-in of a reduction must be at least 2')
+    if not inputs:
+        return None
+    # The tree is spawned under a child, so that its final combine is a descendant of this job, which follow-ons
+    # added to this job wait for. A follow-on added here would run alongside them.
+    return job.addChildJobFn(_reduce_tree, func, combine, inputs, options, *args).rv()
+
+
+def _reduce_tree(job, func, combine, inputs, options, *args):
+    """
+    Spawns a job per sample, or a subtree per partition if there are more than fan_in samples, and a follow-on that
+    combines their results
+
+    :return: Promise of the combined result
+    :rtype: Promise
+    """
+    fan_in = options['fan_in']
+    if len(inputs) > fan_in:
+        partition_size = (len(inputs) + fan_in - 1) / fan_in
+        results = [job.addChildJobFn(_reduce_tree, func, combine, partition, options, *args).rv()
+                   for partition in partitions(inputs, partition_size)]
     else:
-        for sample in inputs:
-            job.addChildJobFn(func, sample, *args)
+        results = [job.addChildJobFn(func, sample, *args).rv() for sample in inputs]
+    return job.addFollowOnJobFn(_combine, combine, results, **options['combine_requirements']).rv()
+
+
+def _combine(job, combine, results):
+    return combine(results)
+
+
+def prefetch_waves(samples, sample_urls, disk_budget, s3_key_path=None, num_threads=16):
+    """
+    Groups samples into waves for `prefetch_map_job`. While one wave is processed the inputs of the next are
+    prefetched, so each wave gets half of the disk budget. Input sizes are looked up in parallel, inputs of unknown
+    size (e.g. from GNOS) count as 0 bytes. A sample larger than half the budget forms a wave on its own.
+
+    :param list samples: Samples as parsed from the manifest
+    :param function sample_urls: Called as sample_urls(sample) to get the input URLs of a sample
+    :param int disk_budget: Cluster-wide disk budget in bytes for the inputs of samples in flight
+    :param str s3_key_path: Path to 32-byte encryption key if inputs are S3 files that use SSE-C
+    :param int num_threads: Number of URLs to look up concurrently
+    :return: Samples grouped in waves
+    :rtype: list[list]
+    """
+    waves, wave_size = [[]], 0
+    for sample, size in zip(samples, sample_sizes(samples, sample_urls, s3_key_path, num_threads)):
+        if waves[-1] and wave_size + size > disk_budget / 2:
+            waves.append([])
+            wave_size = 0
+        waves[-1].append(sample)
+        wave_size += size
+    return [wave for wave in waves if wave]
+
+
+def sample_sizes(samples, sample_urls, s3_key_path=None, num_threads=16):
+    """
+    Total size of the inputs of each sample. Input sizes are looked up in parallel, inputs of unknown size (e.g. from
+    GNOS) count as 0 bytes.
+
+    :param list samples: Samples as parsed from the manifest
+    :param function sample_urls: Called as sample_urls(sample) to get the input URLs of a sample
+    :param str s3_key_path: Path to 32-byte encryption key if inputs are S3 files that use SSE-C
+    :param int num_threads: Number of URLs to look up concurrently
+    :return: Size in bytes of each sample's inputs
+    :rtype: list[int]
+    """
+    urls = [sample_urls(sample) for sample in samples]
+    pool = ThreadPool(num_threads)
+    try:
+        sizes = iter(pool.map(lambda url: url_size(url, s3_key_path=s3_key_path) or 0, sum(urls, [])))
+    finally:
+        pool.close()
+        pool.join()
+    return [sum(next(sizes) for _ in sample_url_list) for sample_url_list in urls]
+
+
+def prefetch_map_job(job, download_func, process_func, waves, disk, *args):
+    """
+    Alternative to map_job that overlaps downloads with processing: the inputs of the next wave of samples are
+    downloaded while the current wave is processed. A wave starts once the previous wave is processed and its own
+    inputs are downloaded. Each sample counts as a prefetch hit if its inputs were downloaded before the previous
+    wave finished processing, or as a stall otherwise. Hits, stalls and the time stalled are logged per wave.
+
+    Files that download_func writes to the file store are deleted from it once the sample's process_func job and its
+    successors finish, so the inputs of at most two waves are held in the job store at a time. Files written by jobs
+    that download_func adds are not tracked.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param function download_func: Called as download_func(job, sample, *args) within a download job to download
+                                   the inputs of a sample into the file store. Returns the arguments of process_func.
+    :param function process_func: Job function to run per sample as process_func(job, *download_func_return_value)
+    :param list[list] waves: Samples grouped in waves, see `prefetch_waves`
+    :param str disk: Disk requirement of each download job (e.g. '2G')
+    :param list args: any arguments to be passed to download_func
+    """
+    prefetched = _prefetch_wave(job, download_func, waves[0], disk, *args)
+    stats = dict(hits=0, stalls=0, stall_time=0.0)
+    job.addFollowOnJobFn(_process_wave, download_func, process_func, waves, 0, prefetched, None, stats, disk, *args)
+
+
+def _prefetch_wave(job, download_func, samples, disk, *args):
+    """
+    :return: Promises of the inputs of each sample, the time their download finished and the IDs of the files written
+    :rtype: list[Promise]
+    """
+    return [job.addChildJobFn(_prefetch_sample, download_func, sample, *args, disk=disk).rv() for sample in samples]
+
+
+def _prefetch_sample(job, download_func, sample, *args):
+    recording_job = _RecordingJob(job)
+    return download_func(recording_job, sample, *args), time.time(), recording_job.file_ids
+
+
+class _RecordingJob(object):
+    """
+    Proxy of a job, or of its file store, that records the IDs of the files written to the file store through it
+    """
+    def __init__(self, target, file_ids=None):
+        self._target = target
+        self.file_ids = file_ids if file_ids is not None else []
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name == 'fileStore':
+            return _RecordingJob(value, self.file_ids)
+        if name == 'writeGlobalFile':
+            def write(*args, **kwargs):
+                file_id = value(*args, **kwargs)
+                self.file_ids.append(file_id)
+                return file_id
+            return write
+        if name == 'writeGlobalFileStream':
+            @contextmanager
+            def write_stream(*args, **kwargs):
+                with value(*args, **kwargs) as (f, file_id):
+                    self.file_ids.append(file_id)
+                    yield f, file_id
+            return write_stream
+        return value
+
+
+def _process_wave(job, download_func, process_func, waves, i, prefetched, processed_time, stats, disk, *args):
+    """
+    Processes wave i and prefetches the inputs of wave i + 1
+
+    :param list[tuple] prefetched: Inputs of each sample of wave i, the time their download finished and the IDs of
+                                   the files written
+    :param float processed_time: Time the previous wave finished processing, or None for the first wave
+    :param dict stats: Prefetch hits, stalls and time stalled so far
+    """
+    # The first wave has nothing to overlap its downloads with, so it does not count towards the statistics
+    if processed_time is not None:
+        for _, download_time, _ in prefetched:
+            if download_time <= processed_time:
+                stats['hits'] += 1
+            else:
+                stats['stalls'] += 1
+                stats['stall_time'] += download_time - processed_time
+    job.fileStore.logToMaster('Prefetch: starting wave {} of {} ({} samples). {} hits, {} stalls, '
+                              '{:.0f}s stalled so far'.format(i + 1, len(waves), len(waves[i]), stats['hits'],
+                                                             stats['stalls'], stats['stall_time']))
+    wave = job.addChildJobFn(_run_wave, process_func, prefetched)
+    processed = wave.addFollowOnJobFn(_timestamp)
+    if i + 1 < len(waves):
+        prefetched = _prefetch_wave(job, download_func, waves[i + 1], disk, *args)
+        job.addFollowOnJobFn(_process_wave, download_func, process_func, waves, i + 1, prefetched, processed.rv(),
+                             stats, disk, *args)
+
+
+def _run_wave(job, process_func, prefetched):
+    for sample_inputs, _, file_ids in prefetched:
+        job.addChildJobFn(process_func, *sample_inputs).addFollowOnJobFn(_delete_files, file_ids)
+
+
+def _delete_files(job, file_ids):
+    for file_id in file_ids:
+        job.fileStore.deleteGlobalFile(file_id)
+
+
+def _timestamp(job):
+    return time.time()
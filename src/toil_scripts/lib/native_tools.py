@@ -0,0 +1,126 @@
+import json
+import os
+import shlex
+from distutils.spawn import find_executable
+
+import yaml
+
+from toil_scripts.lib.docker_pool import translate_paths
+
+
+def native_tools():
+    """
+    Returns the native tools configured by the environment, or None if every tool runs in Docker.
+
+    TOIL_SCRIPTS_NATIVE_TOOLS   Path of a YAML file that maps Docker images to tools installed on the worker nodes
+                                (see `NativeTools`). Calls of mapped images run the tool directly instead of in a
+                                container. Every call runs in Docker if this is unset.
+
+    :return: The native tools or None
+    :rtype: NativeTools
+    """
+    path = os.environ.get('TOIL_SCRIPTS_NATIVE_TOOLS')
+    if not path:
+        return None
+    with open(path) as f:
+        return NativeTools(yaml.safe_load(f) or {})
+
+
+class NativeTools(object):
+    """
+    Maps Docker images to tools installed on the node, so that calls can skip the start of a container. Calls of
+    images that are not mapped still run in Docker, so tools can be moved out of containers one at a time.
+
+    Images are mapped by their pinned name, or by their repository to map every tag. A tool is either the command
+    line that replaces the image's entrypoint, or a dict with the keys:
+        command         Command line that replaces the image's entrypoint, as a string or list. Empty for images whose
+                        parameters are a whole command, e.g. images with a shell entrypoint.
+        conda_env       Prefix of a conda environment, whose bin directory is put first on the PATH of the command
+        env             Environment variables of the command
+
+    For example:
+        quay.io/ucsc_cgl/samtools:1.3--256539928ea162949d8a65ca5c79a72ef557ce7c: samtools
+        quay.io/ucsc_cgl/kallisto: {command: kallisto, conda_env: /opt/conda/envs/kallisto}
+        quay.io/ucsc_cgl/picardtools: {command: java -jar /opt/picard/picard.jar, env: {JAVA_OPTS: -Xmx8g}}
+        ubuntu: {command: []}
+
+    As in a container, the command runs in the work directory of the call, and references to /data in its parameters
+    and environment are rewritten to the work directory.
+    """
+    def __init__(self, tools):
+        """
+        :param dict tools: Tool of each image
+        """
+        self.tools = {}
+        for image, tool in tools.iteritems():
+            if not isinstance(tool, dict):
+                tool = dict(command=tool)
+            unknown = set(tool) - {'command', 'conda_env', 'env'}
+            if unknown:
+                raise ValueError('Unknown keys for native tool {}: {}'.format(image, ', '.join(sorted(unknown))))
+            command = tool.get('command') or []
+            self.tools[image] = dict(command=shlex.split(command) if isinstance(command, basestring) else command,
+                                     conda_env=tool.get('conda_env'), env=tool.get('env') or {})
+
+    def accepts(self, tool):
+        """
+        :param str tool: Name of the Docker image
+        :return: True if the image is mapped to a native tool
+        :rtype: bool
+        """
+        return self._tool(tool) is not None
+
+    def command(self, tool, parameters, work_dir, env=None):
+        """
+        :param str tool: Name of the Docker image, which must be mapped
+        :param list[str] parameters: Command line arguments to be passed to the tool
+        :param str work_dir: Work directory of the call
+        :param dict[str,str] env: Environment variables of the call
+        :return: Command line and its complete environment
+        :rtype: tuple(list[str], dict[str,str])
+        """
+        work_dir = os.path.abspath(work_dir)
+        native = self._tool(tool)
+        command = native['command'] + [translate_paths(p, work_dir) for p in parameters or []]
+        if not command:
+            raise ValueError('No command for native tool {} and no parameters'.format(tool))
+        environ = dict(os.environ)
+        if native['conda_env']:
+            environ['PATH'] = os.pathsep.join([os.path.join(native['conda_env'], 'bin'), environ.get('PATH', '')])
+            environ['CONDA_PREFIX'] = native['conda_env']
+        for e, v in native['env'].items() + (env or {}).items():
+            environ[e] = translate_paths(str(v), work_dir)
+        return command, environ
+
+    def identity(self, tool, parameters=None):
+        """
+        :param str tool: Name of the Docker image, which must be mapped
+        :param list[str] parameters: Command line arguments of the call, the first of which is the executable of tools
+                                     without a command
+        :return: Identity of the native tool of the image, which changes with its command, conda environment or
+                 environment variables, and with the path, size and modification time of its executable and of the
+                 files its command names by absolute path (e.g. a jar), so that upgrading the tool changes it
+        :rtype: str
+        """
+        native = self._tool(tool)
+        command = native['command'] or list(parameters or [])[:1]
+        search_path = os.pathsep.join(([os.path.join(native['conda_env'], 'bin')] if native['conda_env'] else []) +
+                                      [os.environ.get('PATH', '')])
+        files = []
+        for i, word in enumerate(command):
+            path = find_executable(word, search_path) if i == 0 and os.sep not in word else word
+            if path and os.path.isabs(path) and os.path.isfile(path):
+                # Upgrades often only switch a symlink, e.g. in a conda environment
+                path = os.path.realpath(path)
+                stat = os.stat(path)
+                files.append([path, stat.st_size, stat.st_mtime])
+        return 'native:' + json.dumps(dict(native, files=files), sort_keys=True)
+
+    def _tool(self, tool):
+        if tool in self.tools:
+            return self.tools[tool]
+        # Strip the tag or digest, but not a registry port
+        repository = tool.split('@')[0]
+        if ':' in repository.rsplit('/', 1)[-1]:
+            repository = repository.rsplit(':', 1)[0]
+        return self.tools.get(repository)
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+from contextlib import closing, contextmanager
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+from bd2k.util.files import mkdir_p
+
+from toil_scripts.lib.files import copy_files
+from toil_scripts.lib.urls import open_s3_upload, s3am_upload, _parse_s3_url, _s3_connection
+
+manifest_suffix = '.manifest.json'
+
+
+def store_output(fpath, output_dir, s3_key_path=None, num_cores=1):
+    """
+    Copies or uploads a final output, followed by a sidecar manifest (NAME.manifest.json) recording its size and MD5.
+    The manifest is written last, so its presence marks the output as complete (see `output_exists`). A manifest left
+    by a previous run is removed first, so an output that fails to be overwritten is never mistaken for a finished one.
+
+    :param str fpath: Path to output file
+    :param str output_dir: Output directory, either a local path or an S3 URL (s3://bucket/[directory])
+    :param str s3_key_path: (OPTIONAL) Path to 32-byte key to be used for SSE-C encryption of S3 outputs
+    :param int num_cores: Number of parts to upload concurrently to S3
+    """
+    manifest = dict(name=os.path.basename(fpath), size=os.path.getsize(fpath), md5=_md5(fpath))
+    manifest_path = fpath + manifest_suffix
+    _remove_manifest(os.path.join(output_dir, os.path.basename(fpath)))
+    if urlparse(output_dir).scheme == 's3':
+        # The ETag of an SSE-C object is not the MD5 of its content
+        manifest['encrypted'] = bool(s3_key_path)
+        _write_manifest(manifest_path, manifest)
+        s3am_upload(fpath=fpath, s3_dir=output_dir, num_cores=num_cores, s3_key_path=s3_key_path)
+        s3am_upload(fpath=manifest_path, s3_dir=output_dir)
+    else:
+        _write_manifest(manifest_path, manifest)
+        mkdir_p(output_dir)
+        copy_files(file_paths=[fpath, manifest_path], output_dir=output_dir)
+    os.remove(manifest_path)
+
+
+@contextmanager
+def open_output(file_name, output_dirs, s3_key_path=None, num_cores=1):
+    """
+    Opens a final output for writing, streamed to each output directory (local or S3) while it is written, so no
+    local copy is needed. Once the output is written, a sidecar manifest is stored next to each copy as by
+    `store_output`. Manifests left by previous runs are removed first, so a partly written output is never mistaken
+    for a finished one.
+
+        with open_output('sample.tar.gz', [config.output_dir], s3_key_path=config.ssec) as f:
+            f.write(data)
+
+    :param str file_name: Name of the output file
+    :param list[str] output_dirs: Output directories, either local paths or S3 URLs (s3://bucket/[directory])
+    :param str s3_key_path: (OPTIONAL) Path to 32-byte key to be used for SSE-C encryption of S3 outputs
+    :param int num_cores: Number of parts to upload concurrently to S3
+    """
+    sinks = []
+    for output_dir in output_dirs:
+        path = os.path.join(output_dir, file_name)
+        _remove_manifest(path)
+        if urlparse(output_dir).scheme == 's3':
+            sinks.append(open_s3_upload(path, num_cores=num_cores, s3_key_path=s3_key_path))
+        else:
+            mkdir_p(output_dir)
+            sinks.append(open(path, 'wb'))
+    writer = _ManifestWriter(sinks)
+    try:
+        yield writer
+    except Exception:
+        for sink in sinks:
+            getattr(sink, 'abort', sink.close)()
+        raise
+    for sink in sinks:
+        sink.close()
+    manifest = dict(name=file_name, size=writer.size, md5=writer.md5.hexdigest())
+    for output_dir in output_dirs:
+        path = os.path.join(output_dir, file_name)
+        if urlparse(output_dir).scheme == 's3':
+            # The ETag of an SSE-C object is not the MD5 of its content
+            upload = open_s3_upload(path + manifest_suffix)
+            upload.write(json.dumps(dict(manifest, encrypted=bool(s3_key_path))))
+            upload.close()
+        else:
+            _write_manifest(path + manifest_suffix, manifest)
+
+
+class _ManifestWriter(object):
+    """
+    Write-only file object that writes to several files, keeping track of the size and MD5 of the data
+    """
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.size = 0
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.size += len(data)
+        self.md5.update(data)
+        for sink in self.sinks:
+            sink.write(data)
+
+
+def store_output_job(job, file_id, file_name, output_dir, s3_key_path=None, num_cores=1):
+    """
+    Job version of `store_output`
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str file_id: FileStoreID of output file
+    :param str file_name: Name of output file (including extension)
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    fpath = job.fileStore.readGlobalFile(file_id, os.path.join(work_dir, file_name))
+    store_output(fpath, output_dir, s3_key_path=s3_key_path, num_cores=num_cores)
+
+
+def output_exists(path):
+    """
+    Checks whether an output was completely stored by `store_output`: its manifest exists and the output matches
+    the size in the manifest. For S3 objects that were not uploaded in parts and are unencrypted or encrypted with
+    SSE-S3 (AES256), the ETag must also match the MD5 in the manifest. The ETags of other objects, e.g. encrypted with
+    SSE-C or SSE-KMS, are not the MD5 of their content.
+
+    :param str path: Path to output file, either local or an S3 URL
+    :return: True if the output is complete
+    :rtype: bool
+    """
+    if urlparse(path).scheme == 's3':
+        bucket_name, key_name = _parse_s3_url(path)
+        with closing(_s3_connection()) as s3:
+            bucket = s3.get_bucket(bucket_name, validate=False)
+            # A single listing finds the object and its manifest, without needing the SSE-C key of the object
+            keys = {key.name: key for key in bucket.list(prefix=key_name) if key.name in (key_name,
+                                                                                          key_name + manifest_suffix)}
+            if len(keys) != 2:
+                return False
+            manifest = json.loads(keys[key_name + manifest_suffix].get_contents_as_string())
+            key = keys[key_name]
+            etag = key.etag.strip('"')
+            if key.size != manifest['size']:
+                return False
+            if manifest.get('encrypted') or '-' in etag:
+                return True
+            # Listings do not report the encryption of an object, its headers do. SSE-C objects are ruled out above,
+            # as their headers cannot be read without the key.
+            head = bucket.get_key(key_name)
+        if head is None:
+            return False
+        return getattr(head, 'encrypted', None) not in (None, 'AES256') or etag == manifest['md5']
+    try:
+        with open(path + manifest_suffix) as f:
+            manifest = json.load(f)
+        return os.path.getsize(path) == manifest['size']
+    except (IOError, OSError):
+        return False
+
+
+def remove_finished_samples(samples, output_paths, num_threads=16):
+    """
+    Pre-flight check for reruns: drops the samples whose outputs are all complete (see `output_exists`).
+    Outputs are checked in parallel.
+
+    :param list samples: Samples as parsed from the manifest
+    :param function output_paths: Called as output_paths(sample) to get the paths of the final outputs of a sample
+    :param int num_threads: Number of outputs to check concurrently
+    :return: Samples that still need to run
+    :rtype: list
+    """
+    paths = [output_paths(sample) for sample in samples]
+    unique_paths = list(set(sum(paths, [])))
+    pool = ThreadPool(num_threads)
+    try:
+        exists = dict(zip(unique_paths, pool.map(output_exists, unique_paths)))
+    finally:
+        pool.close()
+        pool.join()
+    remaining = [sample for sample, sample_paths in zip(samples, paths)
+                 if not sample_paths or not all(exists[path] for path in sample_paths)]
+    if len(remaining) != len(samples):
+        print 'Skipping {} of {} samples, their outputs already exist'.format(len(samples) - len(remaining),
+                                                                               len(samples))
+    return remaining
+
+
+def _remove_manifest(path):
+    """
+    :param str path: Path to output file, either local or an S3 URL
+    """
+    if urlparse(path).scheme == 's3':
+        bucket_name, key_name = _parse_s3_url(path)
+        with closing(_s3_connection()) as s3:
+            s3.get_bucket(bucket_name, validate=False).delete_key(key_name + manifest_suffix)
+    elif os.path.exists(path + manifest_suffix):
+        os.remove(path + manifest_suffix)
+
+
+def _write_manifest(path, manifest):
+    with open(path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def _md5(fpath):
+    """
+    :param str fpath: Path to file
+    :return: Hex MD5 digest of the file
+    :rtype: str
+    """
+    md5 = hashlib.md5()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            md5.update(block)
+    return md5.hexdigest()
@@ -1,7 +1,32 @@
+import errno
+import fcntl
+import hashlib
+import inspect
+import json
 import os
+import re
+import shutil
+import signal
 import subprocess
+import sys
 import logging
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from uuid import uuid4
+
 from bd2k.util.exceptions import panic
+from bd2k.util.files import mkdir_p
+
+from toil_scripts.lib.cache import call_key, result_cache
+from toil_scripts.lib.docker_pool import node_pool
+from toil_scripts.lib.native_tools import native_tools
+from toil_scripts.lib.telemetry import ContainerMonitor, ProcessMonitor, call_record, caller_tags, record_call, \
+    telemetry_path, tree_size, write_record
 
 _log = logging.getLogger(__name__)
 
@@ -25,7 +50,9 @@ def docker_call(tool,
                 outputs=None,
                 docker_parameters=None,
                 check_output=False,
-                mock=None):
+                mock=None,
+                memoize=False,
+                mounts=None):
     """
     Calls Docker, passing along parameters and tool.
 
@@ -43,6 +70,18 @@ def docker_call(tool,
     :param bool check_output: When True, this function returns docker's output
     :param bool mock: Whether to run in mock mode. If this variable is unset, its value will be determined by
                       the environment variable.
+    :param bool memoize: If True, and a result cache is configured (see `toil_scripts.lib.cache.result_cache`), the
+                         outputs of a call with the same image, parameters, Docker parameters, environment and input
+                         contents as a cached call are restored instead of running the tool. The call must declare all
+                         of its inputs and outputs, and not use outfile or mounts.
+    :param dict[str,str] mounts: Host files or directories to mount read-only into the container, by their path below
+                                 /data (e.g. {'/data/index': '/mnt/cache/index'}), so that shared inputs such as
+                                 reference indexes need not be copied into work_dir
+
+    Calls with rm run in the container pool if one is configured (see `toil_scripts.lib.docker_pool`).
+    Calls with rm run as the owner of work_dir where the tool allows it (see `_caller_parameters`).
+    Tools that are mapped to native tools run without Docker (see `toil_scripts.lib.native_tools`).
+    The resource use of calls is recorded if a telemetry log is configured (see `toil_scripts.lib.telemetry`).
     """
     from toil_scripts.lib.urls import download_url
 
@@ -54,6 +93,11 @@ def docker_call(tool,
         inputs = []
     if outputs is None:
         outputs = {}
+    if mounts is None:
+        mounts = {}
+    for path in mounts:
+        if not path.startswith('/data/'):
+            raise ValueError('Mount outside of /data: {}'.format(path))
 
     for filename in inputs:
         assert(os.path.isfile(os.path.join(work_dir, filename)))
@@ -74,7 +118,114 @@ def docker_call(tool,
                     outfile = download_url(url, work_dir=work_dir, name=filename)
                 assert os.path.exists(file_path)
         return
-    
+
+    native = native_tools()
+    if native and native.accepts(tool):
+        run = partial(_native_call, native, tool, parameters, work_dir, env, outfile, check_output, mounts)
+    else:
+        native = None
+        run = partial(_docker_run, tool, parameters, work_dir, rm, env, outfile, docker_parameters, check_output,
+                      mounts)
+    cache = result_cache() if memoize else None
+    if cache:
+        if outfile:
+            raise ValueError('Calls with an outfile cannot be memoized')
+        if mounts:
+            raise ValueError('Calls with mounts cannot be memoized')
+        image = native.identity(tool, parameters) if native else _image_id(tool)
+        # docker_parameters do not apply to native tools
+        key = call_key(image, parameters, work_dir, env=env, inputs=inputs, check_output=check_output,
+                       docker_parameters=None if native else docker_parameters)
+        output = cache.call(key, work_dir, outputs.keys(), run, check_output=check_output)
+    else:
+        output = run()
+    if check_output:
+        return output
+
+    for filename in outputs.keys():
+        if not os.path.isabs(filename):
+            filename = os.path.join(work_dir, filename)
+        assert(os.path.isfile(filename))
+
+
+def _docker_run(tool, parameters, work_dir, rm, env, outfile, docker_parameters, check_output, mounts=None):
+    """
+    Runs a call of `docker_call` in a new container or in the container pool. Unless docker_parameters set the user
+    or TOIL_SCRIPTS_DOCKER_USER is 'root', a tool that passed the probe of `_caller_parameters` runs as the owner of
+    work_dir, so that its outputs need no change of ownership, and other tools run as root, after which the ownership
+    of work_dir is fixed by running chown in a container of the tool. A call that fails as the caller for lack of a
+    permission (see `_permission_failure`) is retried once as root, and if that succeeds the tool is recorded to run
+    as root from then on. Other failures are raised as is.
+
+    :return: Output of the call if check_output is True
+    :rtype: str
+    """
+    # Pull explicitly so that pull time is not counted as run time of the tool
+    _ensure_image(tool)
+    caller = _user_parameters(tool, work_dir, env, docker_parameters) if rm else None
+    offset = _tell(outfile)
+    # Under a rootless daemon the caller is root already
+    if not caller or not caller[1] or offset is None:
+        return _docker_run_as(tool, parameters, work_dir, rm, env, outfile, docker_parameters, check_output, caller,
+                              mounts=mounts)
+    errors = []
+    try:
+        return _docker_run_as(tool, parameters, work_dir, rm, env, outfile, docker_parameters, check_output, caller,
+                              errors=errors, mounts=mounts)
+    except subprocess.CalledProcessError as e:
+        # The probe bypasses the entrypoint, so a real call may still need root, e.g. for its entrypoint or HOME.
+        # Other failures, e.g. of bad inputs, would only fail again.
+        if not _permission_failure(e.returncode, errors):
+            raise
+        _log.warning('%s was denied a permission as the caller, retrying as root: %s', tool, e)
+    if outfile:
+        outfile.seek(offset)
+        outfile.truncate()
+    output = _docker_run_as(tool, parameters, work_dir, rm, env, outfile, docker_parameters, check_output, None,
+                            mounts=mounts)
+    with _probe_record() as record:
+        record['images'][tool] = False
+    _log.info('%s runs as root.', tool)
+    return output
+
+
+def _permission_failure(returncode, errors):
+    """
+    :param int returncode: Exit status of a call
+    :param list[str] errors: Last lines the call wrote to stderr
+    :return: True if the call failed for lack of a permission, or could not execute its command
+    :rtype: bool
+    """
+    if returncode in (126, 127):
+        return True
+    errors = ''.join(errors).lower()
+    return any(x in errors for x in ['permission denied', 'operation not permitted', 'eacces', 'eperm'])
+
+
+def _tell(outfile):
+    """
+    :return: Position of outfile, 0 if there is none, or None if it cannot be rewound for a retry, e.g. a pipe
+    :rtype: int
+    """
+    if not outfile:
+        return 0
+    try:
+        return outfile.tell()
+    except (IOError, OSError):
+        return None
+
+
+def _docker_run_as(tool, parameters, work_dir, rm, env, outfile, docker_parameters, check_output, caller,
+                   errors=None, mounts=None):
+    """
+    Runs a call of `docker_call` as the caller or, if caller is None, as root
+
+    :param tuple(list[str], list[str]) caller: Parameters of `_user_parameters`
+    :param list errors: See `_run`
+    :param dict[str,str] mounts: See `docker_call`
+    :return: Output of the call if check_output is True
+    :rtype: str
+    """
     base_docker_call = ['docker', 'run',
                         '--log-driver=none',
                         '-v', '{}:/data'.format(os.path.abspath(work_dir))]
@@ -85,31 +236,343 @@ def docker_call(tool,
             base_docker_call.extend(['-e', '{}={}'.format(e, v)])
     if docker_parameters:
         base_docker_call += docker_parameters
+    if caller:
+        run_parameters, user_parameters = caller
+        docker_parameters = (docker_parameters or []) + run_parameters
+        base_docker_call += run_parameters + user_parameters
 
-    _log.debug("Calling docker with %s." % " ".join(base_docker_call + [tool] + parameters))
+    # Mounts are left out of the base call, which the chown of work_dir reuses, as it cannot chown read-only mounts
+    mount_parameters = []
+    for path, host_path in sorted((mounts or {}).iteritems()):
+        mount_parameters.extend(['-v', '{}:{}:ro'.format(os.path.abspath(host_path), path)])
+    docker_call = base_docker_call + mount_parameters + [tool] + parameters
 
-    docker_call = base_docker_call + [tool] + parameters
+    _log.debug("Calling docker with %s." % " ".join(docker_call))
 
+    telemetry = telemetry_path()
+    pool = node_pool() if rm and not mounts else None
+    if pool and pool.accepts(work_dir, tool, docker_parameters):
+        with pool.command(tool, parameters, work_dir, env=env, docker_parameters=docker_parameters,
+                          exec_parameters=caller[1] if caller else None) as (command, name):
+            _log.debug("Calling docker with %s." % " ".join(command))
+            run = partial(_run, command, outfile, check_output,
+                          fix_permissions=None if caller else lambda: _fix_permissions_exec(name, work_dir),
+                          errors=errors)
+            if telemetry:
+                output = record_call(tool, parameters, work_dir, ContainerMonitor(name, shared=True), run)
+            else:
+                output = run()
+    else:
+        fix_permissions = None if caller else lambda: _fix_permissions(base_docker_call, tool, work_dir)
+        with _mount_points(mounts, work_dir):
+            if telemetry:
+                # The ID of the container is needed to find its cgroup
+                cidfile = os.path.join(tempfile.mkdtemp(), 'cid')
+                try:
+                    run = partial(_run, docker_call[:2] + ['--cidfile', cidfile] + docker_call[2:], outfile,
+                                  check_output, fix_permissions=fix_permissions, errors=errors)
+                    output = record_call(tool, parameters, work_dir, ContainerMonitor(cidfile=cidfile), run)
+                finally:
+                    shutil.rmtree(os.path.dirname(cidfile))
+            else:
+                output = _run(docker_call, outfile, check_output, fix_permissions=fix_permissions, errors=errors)
+    return output
+
+
+@contextmanager
+def _mount_points(mounts, work_dir, link=False):
+    """
+    Creates the paths of mounts in work_dir for the duration of a call, and removes them afterwards. Unless link is
+    True, these are empty files or directories for Docker to mount over, which it would otherwise create as root. If
+    link is True, they are symbolic links to the mounted paths, for calls that run outside of a container.
+
+    :param dict[str,str] mounts: See `docker_call`
+    :param str work_dir: Work directory of the call
+    :param bool link: Link the mounted paths rather than create mount points
+    """
+    created = []
     try:
-        if outfile:
-            subprocess.check_call(docker_call, stdout=outfile)
-        else:
-            if check_output:
-                return subprocess.check_output(docker_call)
+        for path, host_path in sorted((mounts or {}).iteritems()):
+            mount_point = os.path.join(work_dir, os.path.relpath(path, '/data'))
+            mkdir_p(os.path.dirname(mount_point))
+            if link:
+                os.symlink(os.path.abspath(host_path), mount_point)
+            elif os.path.isdir(host_path):
+                os.mkdir(mount_point)
+            else:
+                open(mount_point, 'w').close()
+            created.append(mount_point)
+        yield
+    finally:
+        for mount_point in reversed(created):
+            if os.path.isdir(mount_point) and not os.path.islink(mount_point):
+                os.rmdir(mount_point)
             else:
-                subprocess.check_call(docker_call)
-    # Fix root ownership of output files
+                os.remove(mount_point)
+
+
+def _native_call(native, tool, parameters, work_dir, env, outfile, check_output, mounts=None):
+    """
+    Runs a call of `docker_call` with the native tool of the image, in work_dir, with references to /data rewritten to
+    work_dir and mounts linked into it for the duration of the call. docker_parameters and rm do not apply.
+
+    :param NativeTools native: Native tools of the node
+    :param dict[str,str] mounts: See `docker_call`
+    :return: Output of the call if check_output is True
+    :rtype: str
+    """
+    command, environ = native.command(tool, parameters, work_dir, env=env)
+    _log.debug("Calling native tool of %s with %s." % (tool, " ".join(command)))
+    with _mount_points(mounts, work_dir, link=True):
+        if telemetry_path():
+            monitor = ProcessMonitor()
+            run = partial(_run_native, command, environ, work_dir, outfile, check_output, monitor=monitor)
+            return record_call(tool, parameters, work_dir, monitor, run)
+        return _run_native(command, environ, work_dir, outfile, check_output)
+
+
+def _run_native(command, environ, work_dir, outfile, check_output, monitor=None):
+    """
+    Runs a native tool in its work directory
+
+    :param list[str] command: Command line
+    :param dict[str,str] environ: Environment of the command
+    :param str work_dir: Working directory of the command
+    :param file outfile: Pipe output of the command to file handle
+    :param bool check_output: When True, returns the output of the command
+    :param ProcessMonitor monitor: Receives the resource use of the command
+    :return: Output of the command if check_output is True
+    :rtype: str
+    """
+    stdout = outfile if outfile else subprocess.PIPE if check_output else None
+    proc = subprocess.Popen(command, cwd=work_dir, env=environ, stdout=stdout)
+    output = proc.stdout.read() if proc.stdout else None
+    # Waited for directly rather than with Popen.wait, which discards the resource use of the process
+    while True:
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    if monitor:
+        monitor.rusage = rusage
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+    return output
+
+
+def docker_pipe(stages, work_dir='.', outfile=None, check_output=False):
+    """
+    Runs Docker tools as a pipeline: the standard output of each stage is connected to the standard input of the next,
+    so intermediate results are streamed between containers rather than written to work_dir and read back.
+
+    Stages run concurrently. If a stage fails, the containers of the other stages are removed, and an error is raised
+    for the stage that failed first. Like `docker_call`, tools are run as the owner of work_dir where possible, and
+    the resource use of each stage is recorded if telemetry is enabled. Pipelines are not run in the container pool.
+    Stages whose tool is mapped to a native tool (see `toil_scripts.lib.native_tools`) run it directly instead, and
+    may be mixed with containerised stages. Telemetry of native stages is limited to their wall time.
+
+    :param list[dict] stages: Stages in order, each a dict with the keys tool and parameters, and optionally env and
+                              docker_parameters, as for `docker_call`
+    :param str work_dir: Directory to mount into every stage's container at /data
+    :param file outfile: Pipe output of the last stage to file handle
+    :param bool check_output: When True, this function returns the output of the last stage
+    :return: Output of the last stage if check_output is True
+    :rtype: str
+    """
+    work_dir = os.path.abspath(work_dir)
+    pipe_id = uuid4().hex[:12]
+    native = native_tools()
+    names, commands, environs, root_tools = [], [], [], []
+    for i, stage in enumerate(stages):
+        tool, env = stage['tool'], stage.get('env') or {}
+        docker_parameters = stage.get('docker_parameters') or []
+        if native and native.accepts(tool):
+            names.append(None)
+            command, environ = native.command(tool, stage.get('parameters'), work_dir, env=env)
+            commands.append(command)
+            environs.append(environ)
+            continue
+        _ensure_image(tool)
+        environs.append(None)
+        names.append('toil-scripts-pipe-{}-{}'.format(pipe_id, i))
+        # Only stages after the first read standard input
+        command = ['docker', 'run', '--rm', '--log-driver=none', '--name', names[-1],
+                   '-v', '{}:/data'.format(work_dir)] + (['-i'] if i else [])
+        for e, v in env.iteritems():
+            command.extend(['-e', '{}={}'.format(e, v)])
+        caller = _user_parameters(tool, work_dir, env, docker_parameters)
+        if caller:
+            command += caller[0] + caller[1]
+        else:
+            root_tools.append(tool)
+        commands.append(command + docker_parameters + [tool] + (stage.get('parameters') or []))
+    _log.debug("Calling docker with %s." % " | ".join(" ".join(command) for command in commands))
+
+    telemetry = telemetry_path()
+    if telemetry:
+        job_function, uuid = caller_tags()
+        size = tree_size(work_dir)
+        monitors = [ContainerMonitor(name) if name else ProcessMonitor() for name in names]
+        for monitor in monitors:
+            monitor.start()
+    start = time.time()
+    procs, output, failed = [], None, None
+
+    def finish():
+        if any(p.poll() is None for p in procs) or len(procs) < len(commands):
+            _stop_stages(procs, names)
+            for p in procs:
+                p.wait()
+        if telemetry:
+            for i, (stage, monitor) in enumerate(zip(stages, monitors)):
+                record = call_record(stage['tool'], stage.get('parameters'), start,
+                                     i < len(procs) and procs[i].returncode == 0, job_function, uuid,
+                                     backend=monitor.backend)
+                # Growth of the work directory is attributed to the last stage, which writes the output
+                record.update(monitor.stop(), stage=i, stages=len(stages),
+                              work_dir_growth=tree_size(work_dir) - size if i == len(stages) - 1 else None)
+                write_record(telemetry, record)
+        if root_tools:
+            _fix_permissions(['docker', 'run', '--rm', '--log-driver=none', '-v', '{}:/data'.format(work_dir)],
+                             root_tools[0], work_dir)
+
+    try:
+        for i, command in enumerate(commands):
+            stdout = subprocess.PIPE
+            if i == len(commands) - 1:
+                stdout = outfile if outfile else subprocess.PIPE if check_output else None
+            # Native stages run in the work directory, like containers do
+            procs.append(subprocess.Popen(command, stdin=procs[-1].stdout if procs else None, stdout=stdout,
+                                          cwd=work_dir if environs[i] else None, env=environs[i]))
+            if i:
+                # Only the next stage holds the pipe, so that it is closed if that stage exits
+                procs[-2].stdout.close()
+        if check_output and not outfile:
+            output = procs[-1].stdout.read()
+        failed = _wait_pipe(procs, names)
     except:
         # Panic avoids hiding the exception raised in the try block
         with panic():
-            _fix_permissions(base_docker_call, tool, work_dir)
+            finish()
     else:
-        _fix_permissions(base_docker_call, tool, work_dir)
+        finish()
+    if failed is not None:
+        raise subprocess.CalledProcessError(procs[failed].returncode, commands[failed])
+    return output
+
+
+def _wait_pipe(procs, names):
+    """
+    Waits for the stages of a pipeline. Once a stage fails, the others are stopped, as a stage blocked on a full pipe
+    would otherwise never exit.
+
+    :param list[subprocess.Popen] procs: Docker clients or native processes of the stages
+    :param list[str] names: Names of the containers of the stages, None for native stages
+    :return: Index of the stage that failed first, or None
+    :rtype: int
+    """
+    failed = None
+    while any(p.poll() is None for p in procs):
+        if failed is None:
+            failed = _first_failure(procs)
+            if failed is not None:
+                _stop_stages(procs, names)
+        time.sleep(0.1)
+    return failed if failed is not None else _first_failure(procs)
+
+
+def _first_failure(procs):
+    """
+    :return: Index of the failed stage most likely to have caused the failure of the pipeline: the first that was not
+             killed by a broken pipe, which is how a stage fails when a later stage exits
+    :rtype: int
+    """
+    failures = [i for i, p in enumerate(procs) if p.returncode]
+    causes = [i for i in failures if procs[i].returncode not in (-signal.SIGPIPE, 128 + signal.SIGPIPE)]
+    return (causes or failures or [None])[0]
+
+
+def _stop_stages(procs, names):
+    """
+    Removes the containers of a pipeline's stages and kills its native stages. Killing a Docker client would leave its
+    container running.
+    """
+    for p, name in zip(procs, names):
+        if name is None and p.poll() is None:
+            p.kill()
+    _remove_containers([name for name in names if name])
+
+
+def _remove_containers(names):
+    if not names:
+        return
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(['docker', 'rm', '-f'] + names, stdout=devnull, stderr=devnull)
 
-    for filename in outputs.keys():
-        if not os.path.isabs(filename):
-            filename = os.path.join(work_dir, filename)
-        assert(os.path.isfile(filename))
+
+def _run(command, outfile, check_output, fix_permissions, errors=None):
+    """
+    Runs a docker command, then fixes the root ownership of its output files
+
+    :param list[str] command: Docker command line
+    :param file outfile: Pipe output of the command to file handle
+    :param bool check_output: When True, returns the output of the command
+    :param function fix_permissions: Called after the command, whether it succeeded or not. None if the outputs are
+                                     already owned by the caller.
+    :param list errors: If given, stderr of the command is passed through and its last lines are appended to errors
+    :return: Output of the command if check_output is True
+    :rtype: str
+    """
+    output = None
+    fix_permissions = fix_permissions or (lambda: None)
+    try:
+        if errors is not None:
+            output = _run_teeing_stderr(command, outfile, check_output, errors)
+        elif outfile:
+            subprocess.check_call(command, stdout=outfile)
+        elif check_output:
+            output = subprocess.check_output(command)
+        else:
+            subprocess.check_call(command)
+    except:
+        # Panic avoids hiding the exception raised in the try block
+        with panic():
+            fix_permissions()
+    else:
+        fix_permissions()
+    return output
+
+
+def _run_teeing_stderr(command, outfile, check_output, errors, lines=100):
+    """
+    Runs a command like `_run`, passing its stderr through while keeping its last lines
+
+    :param list errors: List the last lines of stderr are appended to
+    :param int lines: Number of lines to keep
+    :return: Output of the command if check_output is True
+    :rtype: str
+    """
+    stdout = outfile if outfile else subprocess.PIPE if check_output else None
+    p = subprocess.Popen(command, stdout=stdout, stderr=subprocess.PIPE)
+    tail = deque(maxlen=lines)
+
+    def forward():
+        for line in iter(p.stderr.readline, ''):
+            sys.stderr.write(line)
+            tail.append(line)
+    thread = threading.Thread(target=forward)
+    thread.daemon = True
+    thread.start()
+    output = p.stdout.read() if stdout is subprocess.PIPE else None
+    p.wait()
+    thread.join()
+    errors.extend(tail)
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, command, output)
+    return output
 
 
 def _fix_permissions(base_docker_call, tool, work_dir):
@@ -124,3 +587,281 @@ def _fix_permissions(base_docker_call, tool, work_dir):
     stat = os.stat(work_dir)
     command = base_docker_call + [tool] + ['-R', '{}:{}'.format(stat.st_uid, stat.st_gid), '/data']
     subprocess.check_call(command)
+
+
+def _fix_permissions_exec(name, work_dir):
+    """
+    Fix permission of a work directory by running chown as root in a pooled container
+
+    :param str name: Name of the pooled container
+    :param str work_dir: Path of work directory to recursively chown
+    """
+    stat = os.stat(work_dir)
+    subprocess.check_call(['docker', 'exec', '-u', '0', name,
+                           'chown', '-R', '{}:{}'.format(stat.st_uid, stat.st_gid), os.path.abspath(work_dir)])
+
+
+def _user_parameters(tool, work_dir, env=None, docker_parameters=None):
+    """
+    Returns the parameters of `_caller_parameters`, setting HOME for tools run as the caller unless env sets it
+
+    :rtype: tuple(list[str], list[str])
+    """
+    caller = _caller_parameters(tool, work_dir, docker_parameters)
+    if caller and caller[1] and 'HOME' not in (env or {}):
+        # The caller's uid may have no home directory in the image
+        caller = caller[0], caller[1] + ['-e', 'HOME=/tmp']
+    return caller
+
+
+def _caller_parameters(tool, work_dir, docker_parameters=None):
+    """
+    Returns the docker parameters that run a tool as the owner of work_dir, or None if the tool must run as root.
+
+    A tool is run as a regular user if its image can run a shell as that user that writes to /data (see `_probe`).
+    The result of this probe is recorded per image in a node-local file, so each image is probed once per node. If
+    the Docker daemon remaps user namespaces, the container is run in the host's user namespace so that its files are
+    owned by the caller. If the daemon is rootless, the container's root already is the caller.
+
+    :param str tool: Name of the Docker image
+    :param str work_dir: Work directory of the call
+    :param list[str] docker_parameters: Parameters to pass to docker
+    :return: Parameters for `docker run` only, and parameters for both `docker run` and `docker exec`
+    :rtype: tuple(list[str], list[str])
+    """
+    if os.environ.get('TOIL_SCRIPTS_DOCKER_USER', 'auto') == 'root':
+        return None
+    if set(docker_parameters or []) & {'-u', '--user'} or \
+            any(p.startswith('--user=') for p in docker_parameters or []):
+        return None
+    stat = os.stat(work_dir)
+    # The record is only locked to be read and updated, probes run without holding up the calls of other images
+    with _probe_record() as record:
+        daemon, as_caller = record.get('daemon'), record['images'].get(tool)
+    if daemon is None:
+        daemon = _daemon_mode()
+        with _probe_record() as record:
+            record['daemon'] = daemon
+    if daemon == 'rootless':
+        return [], []
+    run_parameters = ['--userns=host'] if daemon == 'userns' else []
+    user_parameters = ['--user', '{}:{}'.format(stat.st_uid, stat.st_gid)]
+    if as_caller is None:
+        as_caller = _probe(tool, run_parameters + user_parameters)
+        with _probe_record() as record:
+            # A concurrent probe, or a call that had to be retried as root, may have recorded the image first
+            as_caller = record['images'].setdefault(tool, as_caller)
+        _log.info('%s runs as %s.', tool, 'the caller' if as_caller else 'root')
+    return (run_parameters, user_parameters) if as_caller else None
+
+
+def _probe(tool, user_parameters, timeout=60):
+    """
+    Runs a cheap command in the image as a regular user: a shell that creates a file in /data. The image's entrypoint
+    and default command are bypassed, as they may be slow or wait for input. A probe that does not finish within the
+    timeout is killed and counts as a failure.
+
+    :param str tool: Name of the Docker image, which must be present
+    :param list[str] user_parameters: Parameters that run the container as the caller
+    :param int timeout: Seconds to wait for the probe
+    :return: True if the probe succeeded as the caller
+    :rtype: bool
+    """
+    probe_dir = tempfile.mkdtemp()
+    # The caller's uid is that of the owner of the work directory, which may not be ours
+    os.chmod(probe_dir, 0777)
+    name = 'toil-scripts-probe-{}'.format(uuid4().hex[:12])
+    try:
+        p = subprocess.Popen(['docker', 'run', '--rm', '-i=false', '--log-driver=none', '--name', name,
+                              '-v', '{}:/data'.format(probe_dir)] + user_parameters +
+                             ['--entrypoint', 'sh', tool, '-c', 'touch /data/.probe'],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        deadline = time.time() + timeout
+        while p.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if p.poll() is None:
+            _log.warning('Probe of %s did not finish within %d seconds, running it as root.', tool, timeout)
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(['docker', 'kill', name], stdout=devnull, stderr=devnull)
+            p.kill()
+            p.wait()
+            return False
+        output = p.stdout.read()
+        return p.returncode == 0 and 'permission denied' not in output.lower()
+    finally:
+        shutil.rmtree(probe_dir, ignore_errors=True)
+
+
+def _daemon_mode():
+    """
+    :return: 'rootless' or 'userns' if the Docker daemon runs rootless or remaps user namespaces, else 'root'
+    :rtype: str
+    """
+    options = subprocess.check_output(['docker', 'info', '--format', '{{json .SecurityOptions}}'])
+    for mode in ['rootless', 'userns']:
+        if 'name={}'.format(mode) in options:
+            return mode
+    return 'root'
+
+
+@contextmanager
+def _probe_record():
+    """
+    Yields the node-local record of probed images, which is written back when the context exits
+    """
+    path = os.path.join(tempfile.gettempdir(), 'toil-scripts-docker-user-{}.json'.format(os.getuid()))
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            content = f.read()
+            record = json.loads(content) if content else dict(images={})
+            yield record
+            f.seek(0)
+            f.truncate()
+            json.dump(record, f)
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# Pinned images: registry/repository:tag. Untagged images are left to be pulled by their first call.
+_image_pattern = re.compile(r'^[a-z0-9][\w.-]*(?:/[\w.-]+)+:[\w.-]+$')
+
+
+def referenced_images(*funcs):
+    """
+    Collects the pinned Docker images named in job functions and in the toil_scripts functions they reference,
+    following the functions that are added as child or follow-on jobs. Functions of toil_scripts.lib are not
+    followed, as their images depend on inputs (e.g. GeneTorrent for gnos:// URLs).
+
+    :param list[function] funcs: Job functions, typically those that start each part of a pipeline
+    :return: Sorted names of the images
+    :rtype: list[str]
+    """
+    images, seen = set(), set()
+
+    def walk_code(code, func_globals):
+        for const in code.co_consts:
+            if isinstance(const, str) and _image_pattern.match(const):
+                images.add(const)
+            elif inspect.iscode(const):
+                walk_code(const, func_globals)
+        for name in code.co_names:
+            walk_func(func_globals.get(name))
+
+    def walk_func(func):
+        if inspect.isfunction(func) and func not in seen and \
+                func.__module__.startswith('toil_scripts.') and not func.__module__.startswith('toil_scripts.lib.'):
+            seen.add(func)
+            walk_code(func.__code__, func.__globals__)
+
+    for func in funcs:
+        walk_func(func)
+    return sorted(images)
+
+
+def pull_images(images, num_threads=8):
+    """
+    Pulls the images that are not present on this node, concurrently. Processes on the same node wait for a single
+    pull of each image. A failed pull is logged and left to the first call of the image.
+
+    :param list[str] images: Names of the images
+    :param int num_threads: Number of images to pull concurrently
+    :return: Seconds spent pulling each image: 0 if it was present, None if its pull failed
+    :rtype: dict[str,float]
+    """
+    if not images:
+        return {}
+    pool = ThreadPool(min(num_threads, len(images)))
+    try:
+        return dict(zip(images, pool.map(_pull_image, images)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+_present_images = set()
+
+
+def _ensure_image(tool):
+    _prewarm_images()
+    if tool not in _present_images and pull_images([tool])[tool] is not None:
+        _present_images.add(tool)
+
+
+_prewarm_checked = []
+
+
+def _prewarm_images():
+    """
+    Pulls the images a pipeline will use, once per node, so that a fresh node pulls them in parallel rather than one
+    at a time as each tool is first called. Pipelines list their images in the environment variable
+    TOIL_SCRIPTS_DOCKER_IMAGES, separated by whitespace, which Toil passes on to the workers. The first docker call on
+    a node pulls the images. Calls in other processes on the node do not wait for the whole list, only for the pull of
+    their own image, which they share through its pull lock (see `_pull_image`).
+    """
+    if _prewarm_checked:
+        return
+    _prewarm_checked.append(True)
+    images = os.environ.get('TOIL_SCRIPTS_DOCKER_IMAGES', '').split()
+    if not images:
+        return
+    path = os.path.join(tempfile.gettempdir(), 'toil-scripts-docker-prewarm-{}'.format(
+        hashlib.sha1(' '.join(sorted(images))).hexdigest()))
+    with open(path, 'a+') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            # Another process is pulling the images
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return
+            raise
+        try:
+            f.seek(0)
+            if f.read():
+                return
+            times = pull_images(images)
+            f.write(json.dumps(times))
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _image_id(tool):
+    """
+    :param str tool: Name of the Docker image, which is pulled if it is not present
+    :return: ID of the image, the digest of its configuration, which changes whenever the image is rebuilt
+    :rtype: str
+    """
+    _ensure_image(tool)
+    return subprocess.check_output(['docker', 'inspect', '--type=image', '--format', '{{.Id}}', tool]).strip()
+
+
+def _pull_image(image):
+    """
+    :return: Seconds spent pulling the image, 0 if it was present, None if the pull failed
+    :rtype: float
+    """
+    lock_path = os.path.join(tempfile.gettempdir(), 'toil-scripts-docker-pull-{}.lock'.format(
+        hashlib.sha1(image).hexdigest()))
+    with open(lock_path, 'a') as lock, open(os.devnull, 'w') as devnull:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if subprocess.call(['docker', 'inspect', '--type=image', image], stdout=devnull, stderr=devnull) == 0:
+                return 0
+            start = time.time()
+            p = subprocess.Popen(['docker', 'pull', image], stdout=devnull, stderr=subprocess.PIPE)
+            error = p.communicate()[1]
+            telemetry = telemetry_path()
+            if telemetry:
+                # Pulls are recorded apart from the calls of the image, with the job function that waited for them
+                job_function, uuid = caller_tags()
+                write_record(telemetry, call_record(image, None, start, not p.returncode, job_function, uuid,
+                                                    backend='pull'))
+            if p.returncode:
+                _log.warning('Failed to pull %s: %s', image, error.strip())
+                return None
+            seconds = time.time() - start
+            _log.info('Pulled %s in %.1fs.', image, seconds)
+            return seconds
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
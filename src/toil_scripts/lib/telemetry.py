@@ -0,0 +1,347 @@
+import fcntl
+import inspect
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+from collections import defaultdict
+
+
+def telemetry_path():
+    """
+    Returns the path of the telemetry log configured by the environment, or None if telemetry is disabled.
+
+    TOIL_SCRIPTS_TELEMETRY      Path of a file that a JSON record is appended to for every docker_call, e.g. on a
+                                file system shared by the workers. Telemetry is disabled if this is unset.
+
+    :rtype: str
+    """
+    return os.environ.get('TOIL_SCRIPTS_TELEMETRY') or None
+
+
+def write_record(path, record):
+    """
+    Appends a record to a telemetry log as one line of JSON. Workers on the same file system may share the log.
+
+    :param str path: Path of the telemetry log
+    :param dict record: Record to append
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_records(path):
+    """
+    :param str path: Path of a telemetry log
+    :return: The records of the log
+    :rtype: list[dict]
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records, key=('tool', 'job_function', 'backend')):
+    """
+    Aggregates records, by default per tool, calling job function and backend, which keeps the pulls of an image apart
+    from its calls
+
+    :param list[dict] records: Records of `read_records`
+    :param tuple(str) key: Fields to group by
+    :return: One summary per group: the key fields, the number of calls and failures, the total and maximum of wall
+             and CPU seconds, and the maximum of peak memory, bytes read and written and work directory growth
+    :rtype: list[dict]
+    """
+    groups = defaultdict(list)
+    for record in records:
+        groups[tuple(record.get(field) for field in key)].append(record)
+    summaries = []
+    for group_key, group in sorted(groups.iteritems()):
+        summary = dict(zip(key, group_key), calls=len(group), failures=sum(1 for x in group if not x['success']))
+        for field in ['wall_seconds', 'cpu_seconds']:
+            values = [x[field] for x in group if x.get(field) is not None]
+            summary['total_' + field] = sum(values)
+            summary['max_' + field] = max(values) if values else None
+        for field in ['peak_memory', 'read_bytes', 'write_bytes', 'work_dir_growth']:
+            values = [x[field] for x in group if x.get(field) is not None]
+            summary['max_' + field] = max(values) if values else None
+        summaries.append(summary)
+    return summaries
+
+
+def caller_tags():
+    """
+    Identifies the job function that made a docker call and the sample it processes, from the call stack. The job
+    function is the innermost function whose first argument is named `job`. The sample UUID is taken from the
+    innermost local named `uuid`, or from the `uuid` attribute of a local named `config`.
+
+    :return: Job function as MODULE.FUNCTION and sample UUID, either of which may be None
+    :rtype: tuple(str, str)
+    """
+    job_function = uuid = None
+    frame = inspect.currentframe()
+    try:
+        while frame and not (job_function and uuid):
+            code = frame.f_code
+            if not job_function and code.co_argcount and code.co_varnames[0] == 'job':
+                job_function = '{}.{}'.format(frame.f_globals.get('__name__'), code.co_name)
+            if not uuid:
+                local = frame.f_locals
+                if isinstance(local.get('uuid'), basestring):
+                    uuid = local['uuid']
+                elif isinstance(getattr(local.get('config'), 'uuid', None), basestring):
+                    uuid = local['config'].uuid
+            frame = frame.f_back
+    finally:
+        del frame
+    return job_function, uuid
+
+
+def tree_size(path):
+    """
+    :param str path: Directory
+    :return: Total size in bytes of the files in the directory tree
+    :rtype: int
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass  # Removed while walking
+    return size
+
+
+class ContainerMonitor(object):
+    """
+    Polls the cgroup counters of a running container in a thread: CPU time, memory and block I/O. A container's cgroup
+    is removed when the container exits, so the counters of at most the last polling interval are missed.
+
+    For a container that is shared between calls (see `toil_scripts.lib.docker_pool`), CPU time and block I/O are
+    the increase of the container's counters during the call, and peak memory is the largest memory use seen while
+    polling. These include the use of concurrent calls in the same container.
+    """
+    backend = 'docker'
+
+    def __init__(self, container=None, cidfile=None, shared=False, interval=0.5):
+        """
+        :param str container: Name or ID of the container
+        :param str cidfile: Path of the file that `docker run --cidfile` writes the ID of the container to, if the
+                            container is started after the monitor
+        :param bool shared: True if the container is shared with other calls
+        :param float interval: Seconds between polls
+        """
+        self.container = container
+        self.cidfile = cidfile
+        self.shared = shared
+        self.interval = interval
+        self.first = None
+        self.last = None
+        self.max_memory = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._poll)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        :return: CPU seconds, peak memory in bytes, and bytes read and written, each None if unknown
+        :rtype: dict
+        """
+        self._stop.set()
+        self._thread.join()
+        if not self.last:
+            return dict(cpu_seconds=None, peak_memory=None, read_bytes=None, write_bytes=None)
+        first = self.first if self.shared else dict(cpu=0, read=0, write=0)
+        peak = self.max_memory if self.shared else max(self.last['peak'], self.max_memory)
+        return dict(cpu_seconds=(self.last['cpu'] - first['cpu']) / 1e9, peak_memory=peak,
+                    read_bytes=self.last['read'] - first['read'], write_bytes=self.last['write'] - first['write'])
+
+    def _poll(self):
+        cgroup = None
+        while True:
+            stopping = self._stop.is_set()
+            try:
+                if cgroup is None:
+                    cgroup = self._find_cgroup()
+                if cgroup:
+                    self._sample(cgroup)
+            except (IOError, OSError, ValueError):
+                # The container has not started yet or has exited
+                pass
+            if stopping:
+                break
+            self._stop.wait(self.interval)
+
+    def _find_cgroup(self):
+        """
+        :return: Controller files of the container's cgroup, or None if the container is not running yet
+        :rtype: dict
+        """
+        container = self.container
+        if container is None:
+            with open(self.cidfile) as f:
+                container = f.read().strip()
+            if not container:
+                return None
+        with open(os.devnull, 'w') as devnull:
+            pid = subprocess.Popen(['docker', 'inspect', '--format', '{{.State.Pid}}', container],
+                                   stdout=subprocess.PIPE, stderr=devnull).communicate()[0].strip()
+        if not pid or pid == '0':
+            return None
+        return _cgroup_files(int(pid))
+
+    def _sample(self, cgroup):
+        sample = dict(cpu=_read_cpu(cgroup), read=0, write=0)
+        sample['read'], sample['write'] = _read_io(cgroup)
+        memory, sample['peak'] = _read_memory(cgroup)
+        self.max_memory = max(self.max_memory, memory)
+        if self.first is None:
+            self.first = sample
+        self.last = sample
+
+
+class ProcessMonitor(object):
+    """
+    Resource use of a tool run natively rather than in a container (see `toil_scripts.lib.native_tools`), from the
+    rusage that `os.wait4` returns for its process. The rusage covers the descendants the process waited for, but peak
+    memory is that of the largest process rather than of the whole tree, unlike the memory of a container's cgroup.
+    """
+    backend = 'native'
+    shared = False
+
+    def __init__(self):
+        self.rusage = None
+
+    def start(self):
+        pass
+
+    def stop(self):
+        """
+        :return: CPU seconds, peak memory in bytes, and bytes read and written, each None if the process was not waited
+                 for
+        :rtype: dict
+        """
+        r = self.rusage
+        if r is None:
+            return dict(cpu_seconds=None, peak_memory=None, read_bytes=None, write_bytes=None)
+        # Linux counts maximum RSS in KiB and block I/O in 512-byte units
+        return dict(cpu_seconds=r.ru_utime + r.ru_stime, peak_memory=r.ru_maxrss * 1024,
+                    read_bytes=r.ru_inblock * 512, write_bytes=r.ru_oublock * 512)
+
+
+def _cgroup_files(pid):
+    """
+    :param int pid: Process in the cgroup
+    :return: Version of cgroups (1 or 2) and the directory of each controller
+    :rtype: dict
+    """
+    with open('/proc/{}/cgroup'.format(pid)) as f:
+        lines = [line.strip().split(':', 2) for line in f if line.strip()]
+    dirs = {}
+    for _, controllers, path in lines:
+        for controller in controllers.split(','):
+            if controller in ('cpuacct', 'memory', 'blkio'):
+                dirs[controller] = '/sys/fs/cgroup/{}{}'.format(controllers, path)
+    if dirs:
+        return dict(version=1, cpu=dirs['cpuacct'], memory=dirs['memory'], io=dirs['blkio'])
+    # Only the unified hierarchy
+    directory = '/sys/fs/cgroup' + lines[0][2]
+    return dict(version=2, cpu=directory, memory=directory, io=directory)
+
+
+def _read(directory, name):
+    with open(os.path.join(directory, name)) as f:
+        return f.read()
+
+
+def _read_cpu(cgroup):
+    """
+    :return: CPU time in nanoseconds
+    :rtype: int
+    """
+    if cgroup['version'] == 1:
+        return int(_read(cgroup['cpu'], 'cpuacct.usage'))
+    stats = dict(line.split() for line in _read(cgroup['cpu'], 'cpu.stat').splitlines())
+    return int(stats['usage_usec']) * 1000
+
+
+def _read_memory(cgroup):
+    """
+    :return: Current and peak memory use in bytes. The peak is the current use on kernels that don't record it.
+    :rtype: tuple(int, int)
+    """
+    if cgroup['version'] == 1:
+        return (int(_read(cgroup['memory'], 'memory.usage_in_bytes')),
+                int(_read(cgroup['memory'], 'memory.max_usage_in_bytes')))
+    current = int(_read(cgroup['memory'], 'memory.current'))
+    try:
+        return current, int(_read(cgroup['memory'], 'memory.peak'))
+    except IOError:
+        return current, current
+
+
+def _read_io(cgroup):
+    """
+    :return: Bytes read and written, summed over devices
+    :rtype: tuple(int, int)
+    """
+    read = write = 0
+    if cgroup['version'] == 1:
+        for line in _read(cgroup['io'], 'blkio.throttle.io_service_bytes').splitlines():
+            fields = line.split()
+            if len(fields) == 3 and fields[1] == 'Read':
+                read += int(fields[2])
+            elif len(fields) == 3 and fields[1] == 'Write':
+                write += int(fields[2])
+        return read, write
+    for line in _read(cgroup['io'], 'io.stat').splitlines():
+        stats = dict(field.split('=') for field in line.split()[1:])
+        read += int(stats.get('rbytes', 0))
+        write += int(stats.get('wbytes', 0))
+    return read, write
+
+
+def record_call(tool, parameters, work_dir, monitor, run):
+    """
+    Runs a docker call and appends its telemetry record to the log, whether the call succeeds or not
+
+    :param str tool: Name of the Docker image
+    :param list[str] parameters: Parameters of the call
+    :param str work_dir: Work directory of the call
+    :param ContainerMonitor|ProcessMonitor monitor: Monitor of the call's container or native process
+    :param function run: Runs the call
+    :return: Return value of run
+    """
+    job_function, uuid = caller_tags()
+    size = tree_size(work_dir)
+    start = time.time()
+    monitor.start()
+    success = False
+    try:
+        result = run()
+        success = True
+        return result
+    finally:
+        record = call_record(tool, parameters, start, success, job_function, uuid, monitor.shared, monitor.backend)
+        record.update(monitor.stop(), work_dir_growth=tree_size(work_dir) - size)
+        write_record(telemetry_path(), record)
+
+
+def call_record(tool, parameters, start, success, job_function, uuid, shared=False, backend='docker'):
+    """
+    :return: Telemetry record of a call that started at start and ends now, without its resource use. The backend is
+             'docker' for a call run in a container and 'native' for a tool run directly.
+    :rtype: dict
+    """
+    return dict(time=start, host=socket.gethostname(), tool=tool, command=(parameters or [None])[0],
+                job_function=job_function, uuid=uuid, success=success, shared=shared, backend=backend,
+                wall_seconds=time.time() - start)
@@ -0,0 +1,236 @@
+import os
+import shutil
+import tarfile
+from multiprocessing import Pool
+
+
+def test_file_cache(tmpdir):
+    from toil_scripts.lib.cache import FileCache
+    work_dir = str(tmpdir)
+    cache = FileCache(os.path.join(work_dir, 'cache'), max_size=2048)
+    downloads = []
+
+    def download(path):
+        downloads.append(path)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(1024))
+
+    first = cache.get('file:///foo', os.path.join(work_dir, 'first'), download)
+    second = cache.get('file:///foo', os.path.join(work_dir, 'second'), download)
+    assert len(downloads) == 1
+    assert open(first, 'rb').read() == open(second, 'rb').read()
+    # Files are copied (or reflinked) out of the cache, so that a chown of the work directory leaves the cache alone
+    assert os.stat(first).st_ino != os.stat(second).st_ino
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['files']) == (1, 1, 1)
+    # Exceeding the budget evicts the least recently used file without disturbing linked copies
+    cache.get('file:///bar', os.path.join(work_dir, 'bar'), download)
+    cache.get('file:///baz', os.path.join(work_dir, 'baz'), download)
+    assert cache.stats()['files'] == 2
+    assert os.path.getsize(first) == 1024
+    cache.get('file:///foo', os.path.join(work_dir, 'third'), download)
+    assert len(downloads) == 4
+
+
+def test_file_cache_placed_outside_lock(tmpdir, monkeypatch):
+    import fcntl
+    from toil_scripts.lib import cache as cache_module
+    work_dir = str(tmpdir)
+    cache = cache_module.FileCache(os.path.join(work_dir, 'cache'), max_size=2048, hardlink=True)
+    place_file = cache_module._place_file
+    placed = []
+
+    def place_file_unlocked(src, dest, hardlink=False):
+        # Other cache users can take the global lock while a file is placed
+        with open(os.path.join(work_dir, 'cache', 'lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(f, fcntl.LOCK_UN)
+        placed.append(dest)
+        return place_file(src, dest, hardlink=hardlink)
+    monkeypatch.setattr(cache_module, '_place_file', place_file_unlocked)
+
+    def download(path):
+        with open(path, 'w') as f:
+            f.write('contents')
+
+    first = cache.get('file:///foo', os.path.join(work_dir, 'first'), download)
+    second = cache.get('file:///foo', os.path.join(work_dir, 'second'), download)
+    assert len(placed) == 2
+    # Hard links are opt-in
+    assert os.stat(first).st_ino == os.stat(second).st_ino
+    assert os.listdir(os.path.join(work_dir, 'cache', 'tmp')) == []
+
+
+def test_file_cache_pinned(tmpdir):
+    from toil_scripts.lib.cache import FileCache
+    work_dir = str(tmpdir)
+    cache = FileCache(os.path.join(work_dir, 'cache'), max_size=1024)
+    downloads = []
+
+    def download(path):
+        downloads.append(path)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(1024))
+
+    # Concurrent users share the cached file itself rather than copies of it
+    with cache.pinned('file:///foo', download) as first, cache.pinned('file:///foo', download) as second:
+        assert len(downloads) == 1
+        assert os.stat(first).st_ino == os.stat(second).st_ino
+        # A pinned file outlives its eviction
+        with cache.pinned('file:///bar', download):
+            assert cache.stats()['files'] == 1
+        assert os.path.getsize(first) == 1024
+    assert not os.path.exists(first)
+    assert os.listdir(os.path.join(work_dir, 'cache', 'tmp')) == []
+
+
+def test_file_cache_extracted(tmpdir):
+    from toil_scripts.lib.cache import FileCache
+    work_dir = str(tmpdir)
+    os.mkdir(os.path.join(work_dir, 'index'))
+    with open(os.path.join(work_dir, 'index', 'genome'), 'w') as f:
+        f.write('ACGT')
+    tar_path = os.path.join(work_dir, 'index.tar.gz')
+    with tarfile.open(tar_path, 'w:gz') as f_out:
+        f_out.add(os.path.join(work_dir, 'index'), arcname='index')
+    cache = FileCache(os.path.join(work_dir, 'cache'), max_size=2048)
+    downloads = []
+
+    def download(path):
+        downloads.append(path)
+        shutil.copy(tar_path, path)
+
+    for dest in ['first', 'second']:
+        cache.get_extracted('file:///index.tar.gz', os.path.join(work_dir, dest), download)
+        assert open(os.path.join(work_dir, dest, 'index', 'genome')).read() == 'ACGT'
+    assert len(downloads) == 1
+    # A tree without a completion marker is a partial extraction and is not used
+    tree = [x for x in os.listdir(os.path.join(work_dir, 'cache', 'extracted')) if not x.endswith('.json')][0]
+    os.remove(os.path.join(work_dir, 'cache', 'extracted', tree + '.json'))
+    cache.get_extracted('file:///index.tar.gz', os.path.join(work_dir, 'third'), download)
+    assert len(downloads) == 2
+    # The same content under another URL keeps the complete tree in place rather than replacing it
+    tree = os.path.join(work_dir, 'cache', 'extracted', tree)
+    inode = os.stat(tree).st_ino
+    cache.get_extracted('file:///copy.tar.gz', os.path.join(work_dir, 'fourth'), download)
+    assert len(downloads) == 3
+    assert os.stat(tree).st_ino == inode and os.path.exists(tree + '.json')
+    assert open(os.path.join(work_dir, 'fourth', 'index', 'genome')).read() == 'ACGT'
+    # Concurrent users share the cached tree itself, and the lock of the URL is not held while it is used
+    with cache.pinned_extracted('file:///index.tar.gz', download) as first, \
+            cache.pinned_extracted('file:///index.tar.gz', download) as second:
+        inodes = {os.stat(os.path.join(path, 'index', 'genome')).st_ino for path in [first, second, tree]}
+        assert len(inodes) == 1
+    assert len(downloads) == 3
+    # Leftovers of processes that no longer exist are removed
+    os.mkdir(os.path.join(work_dir, 'cache', 'tmp', '999999999-foo'))
+    cache.evict()
+    assert os.listdir(os.path.join(work_dir, 'cache', 'tmp')) == []
+
+
+def test_file_cache_concurrent(tmpdir):
+    work_dir = str(tmpdir)
+    pool = Pool(4)
+    try:
+        pool.map(_get_from_cache, [(work_dir, i) for i in xrange(8)])
+    finally:
+        pool.close()
+        pool.join()
+    from toil_scripts.lib.cache import FileCache
+    stats = FileCache(os.path.join(work_dir, 'cache'), max_size=2048).stats()
+    assert (stats['hits'], stats['misses'], stats['files']) == (7, 1, 1)
+
+
+def _get_from_cache(args):
+    from toil_scripts.lib.cache import FileCache
+    work_dir, i = args
+    cache = FileCache(os.path.join(work_dir, 'cache'), max_size=2048)
+
+    def download(path):
+        with open(path, 'wb') as f:
+            f.write('contents')
+
+    cache.get('file:///foo', os.path.join(work_dir, str(i)), download)
+
+
+def test_result_cache(tmpdir):
+    from toil_scripts.lib.cache import ResultCache, call_key
+    cache = ResultCache(os.path.join(str(tmpdir), 'cache'), max_size=2048)
+    cache.grace_period = 0
+    runs = []
+
+    def make_run(work_dir, size):
+        def run():
+            runs.append(work_dir)
+            with open(os.path.join(work_dir, 'ref.fa.fai'), 'w') as f:
+                f.write('x' * size)
+            return 'stdout'
+        return run
+
+    work_dirs = []
+    for name in ['a', 'b', 'c']:
+        work_dirs.append(str(tmpdir.mkdir(name)))
+        with open(os.path.join(work_dirs[-1], 'ref.fa'), 'w') as f:
+            f.write('ACGT')
+    # The key is independent of the work directory, and of how paths below /data are written
+    keys = [call_key('sha256:1', ['faidx', '/data/./ref.fa'], work_dirs[0], inputs=['ref.fa'], check_output=True),
+            call_key('sha256:1', ['faidx', work_dirs[1] + '/ref.fa'], work_dirs[1],
+                     inputs=[os.path.join(work_dirs[1], 'ref.fa')], check_output=True)]
+    assert keys[0] == keys[1]
+    assert keys[0] != call_key('sha256:2', ['faidx', '/data/ref.fa'], work_dirs[0], inputs=['ref.fa'],
+                               check_output=True)
+    assert keys[0] != call_key('sha256:1', ['faidx', '/data/ref.fa'], work_dirs[0], inputs=['ref.fa'],
+                               check_output=True, docker_parameters=['--entrypoint', 'samtools'])
+    assert cache.call(keys[0], work_dirs[0], ['ref.fa.fai'], make_run(work_dirs[0], 1024), check_output=True) == \
+        'stdout'
+    assert cache.call(keys[1], work_dirs[1], ['ref.fa.fai'], make_run(work_dirs[1], 1024), check_output=True) == \
+        'stdout'
+    assert runs == work_dirs[:1]
+    assert open(os.path.join(work_dirs[1], 'ref.fa.fai')).read() == 'x' * 1024
+    # Other inputs are a miss, and exceeding the budget evicts the least recently used call
+    with open(os.path.join(work_dirs[2], 'ref.fa'), 'w') as f:
+        f.write('TGCA')
+    key = call_key('sha256:1', ['faidx', '/data/ref.fa'], work_dirs[2], inputs=['ref.fa'], check_output=True)
+    cache.call(key, work_dirs[2], ['ref.fa.fai'], make_run(work_dirs[2], 1536), check_output=True)
+    assert runs == [work_dirs[0], work_dirs[2]]
+    assert cache.stats()['calls'] == 1
+    assert cache.restore(keys[0], work_dirs[0]) is None
+    assert cache.restore(key, work_dirs[0]) == (True, 'stdout')
+
+
+def test_result_cache_partial_restore(tmpdir):
+    import hashlib
+    from toil_scripts.lib.cache import ResultCache
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    cache = ResultCache(cache_dir, max_size=2048)
+    work_dir = str(tmpdir.mkdir('work'))
+    for name in ['a', 'b']:
+        with open(os.path.join(work_dir, name), 'w') as f:
+            f.write(name)
+    cache.save('key', work_dir, ['a', 'b'])
+    restore_dir = str(tmpdir.mkdir('restore'))
+    assert cache.restore('key', restore_dir) == (True, None)
+    assert sorted(os.listdir(restore_dir)) == ['a', 'b']
+    # A missing blob leaves nothing behind for the tool to run over
+    os.remove(os.path.join(cache_dir, 'blobs', hashlib.sha256('b').hexdigest()))
+    restore_dir = str(tmpdir.mkdir('partial'))
+    assert cache.restore('key', restore_dir) is None
+    assert os.listdir(restore_dir) == []
+
+
+def test_docker_call_memoized(tmpdir, monkeypatch):
+    from toil_scripts.lib.programs import docker_call
+    tools = os.path.join(str(tmpdir), 'native-tools.yaml')
+    with open(tools, 'w') as f:
+        f.write('ubuntu: {command: []}\n')
+    monkeypatch.setenv('TOIL_SCRIPTS_NATIVE_TOOLS', tools)
+    monkeypatch.setenv('TOIL_SCRIPTS_RESULT_CACHE', os.path.join(str(tmpdir), 'cache'))
+    for name in ['a', 'b']:
+        work_dir = str(tmpdir.mkdir(name))
+        with open(os.path.join(work_dir, 'in'), 'w') as f:
+            f.write('input\n')
+        docker_call(tool='ubuntu', parameters=['sh', '-c', 'cat in >> /data/out && echo ran >> /data/log'],
+                    work_dir=work_dir, inputs=['in'], outputs={'out': None}, memoize=True)
+        assert open(os.path.join(work_dir, 'out')).read() == 'input\n'
+    # The second call restored the output without running
+    assert not os.path.exists(os.path.join(work_dir, 'log'))
@@ -0,0 +1,78 @@
+import gzip
+import json
+import os
+
+import pytest
+
+
+def _write_fastq(path, reads, opener=open):
+    with opener(path, 'wb') as f:
+        for i, (sequence, quality) in enumerate(reads):
+            f.write('@read{}\n{}\n+\n{}\n'.format(i, sequence, quality))
+
+
+def test_fastq_qc(tmpdir):
+    pytest.importorskip('numpy')
+    from toil_scripts.lib.fastq_qc import fastq_qc
+    reads = [('ACGTN', 'IIII#'), ('GGCC', '5555'), ('ACGTACGTAC', 'I' * 10)] * 100
+    path = str(tmpdir.join('R1.fastq'))
+    _write_fastq(path, reads)
+    gz_path = str(tmpdir.join('R1.fastq.gz'))
+    _write_fastq(gz_path, reads, opener=gzip.open)
+    # Batches that split records give the same summary as a single batch
+    summary = fastq_qc(path, kmer_fraction=1.0, kmer_size=3)
+    assert summary == fastq_qc(path, batch_bytes=37, kmer_fraction=1.0, kmer_size=3)
+    assert summary == fastq_qc(gz_path, kmer_fraction=1.0, kmer_size=3)
+    assert summary['reads'] == 300
+    assert summary['bases'] == 1900
+    assert summary['length'] == dict(min=4, max=10, mean=6.33, histogram={4: 100, 5: 100, 10: 100})
+    quality = summary['per_position']['quality']
+    assert quality['median'][:5] == [40, 40, 40, 40, 2]
+    assert quality['p10'][0] == 20
+    assert quality['mean'][5:] == [40.0] * 5
+    bases = summary['per_position']['bases']
+    assert [bases[x][0] for x in 'ACGTN'] == [66.67, 0, 33.33, 0, 0]
+    assert bases['N'][4] == 50.0
+    assert summary['n_content']['percent'] == round(100 * 100 / 1900.0, 4)
+    assert summary['gc']['histogram'][100] == 100
+    assert summary['gc']['histogram'][40] == 100
+    assert summary['read_quality']['histogram'][20] == 100
+    assert summary['kmers']['sampled_reads'] == 300
+    # ACG occurs once in ACGTN and twice in ACGTACGTAC, GGC only in GGCC
+    counts = {x['kmer']: x['count'] for x in summary['kmers']['top']}
+    assert counts['ACG'] == 300 and counts['GGC'] == 100
+    assert 'NAC' not in counts
+
+
+def test_fastq_qc_malformed(tmpdir):
+    pytest.importorskip('numpy')
+    from toil_scripts.lib.fastq_qc import fastq_qc
+    path = str(tmpdir.join('bad.fastq'))
+    with open(path, 'w') as f:
+        f.write('@read\nACGT\n+\nIIII\nread\nACGT\n+\nIIII\n')
+    with pytest.raises(ValueError):
+        fastq_qc(path)
+    with open(path, 'w') as f:
+        f.write('@read\nACGT\n+\nIIII\n@read\nACGT\n')
+    with pytest.raises(ValueError):
+        fastq_qc(path)
+    with open(path, 'w') as f:
+        f.write('@read\nACGT\n+\nIII\n')
+    with pytest.raises(ValueError):
+        fastq_qc(path)
+
+
+def test_fastq_qc_files(tmpdir):
+    pytest.importorskip('numpy')
+    from toil_scripts.lib.fastq_qc import fastq_qc_files
+    work_dir = str(tmpdir)
+    paths = [os.path.join(work_dir, 'R1.fastq'), os.path.join(work_dir, 'R2.fastq')]
+    _write_fastq(paths[0], [('ACGT', 'IIII')] * 10)
+    _write_fastq(paths[1], [('TTTTTT', '######')] * 20)
+    outputs = fastq_qc_files(paths, work_dir)
+    assert [os.path.basename(x) for x in outputs] == ['R1_qc.json', 'R1_qc.html', 'R2_qc.json', 'R2_qc.html']
+    with open(outputs[2]) as f:
+        summary = json.load(f)
+    assert summary['name'] == 'R2' and summary['reads'] == 20
+    with open(outputs[3]) as f:
+        assert '<svg' in f.read()
@@ -1,5 +1,9 @@
+import filecmp
 import os
+import subprocess
 import tarfile
+
+import pytest
 from toil.job import Job
 
 
@@ -13,6 +17,74 @@ def test_tarball_files(tmpdir):
     assert os.path.exists(os.path.join(work_dir, 'test.tar'))
 
 
+def test_tarball_files_parallel(tmpdir):
+    from toil_scripts.lib.files import tarball_files
+    work_dir = str(tmpdir)
+    fpaths = _random_files(work_dir, [('a', 3 * 1024 * 1024 + 1), ('b', 0), ('c', 1000)])
+    tarball_files(output_dir=work_dir, tar_name='test.tar.gz', file_paths=fpaths, num_cores=4)
+    # Readable by tar as well as tarfile
+    extract_dir = os.path.join(work_dir, 'extract')
+    os.mkdir(extract_dir)
+    subprocess.check_call(['tar', 'xzf', os.path.join(work_dir, 'test.tar.gz'), '-C', extract_dir])
+    for fpath in fpaths:
+        assert filecmp.cmp(fpath, os.path.join(extract_dir, os.path.basename(fpath)), shallow=False)
+    with tarfile.open(os.path.join(work_dir, 'test.tar.gz'), 'r') as f_in:
+        assert f_in.getnames() == ['a', 'b', 'c']
+
+
+def test_consolidate_tarballs(tmpdir):
+    from toil_scripts.lib.files import consolidate_tarballs, tarball_files, _tar_blocks
+    work_dir = str(tmpdir)
+    fpaths = _random_files(work_dir, [('a', 5 * 1024 * 1024 + 1), ('b', 0), ('c', 1000)])
+    tarball_files('new.tar.gz', file_paths=fpaths, output_dir=work_dir, num_cores=2)
+    with tarfile.open(os.path.join(work_dir, 'old.tar.gz'), 'w:gz') as f_out:
+        f_out.add(fpaths[2], arcname='c')
+    # Data is copied from tarballs written by tarball_files, and recompressed from others
+    assert _tar_blocks(os.path.join(work_dir, 'new.tar.gz')) is not None
+    assert _tar_blocks(os.path.join(work_dir, 'old.tar.gz')) is None
+    out_tar = os.path.join(work_dir, 'out.tar.gz')
+    with open(out_tar, 'wb') as f:
+        consolidate_tarballs(f, [(os.path.join(work_dir, 'new.tar.gz'), 'uuid/new'),
+                                 (os.path.join(work_dir, 'old.tar.gz'), 'uuid/old')])
+    assert [x.name for x, _ in _tar_blocks(out_tar)] == ['uuid/new/a', 'uuid/new/b', 'uuid/new/c', 'uuid/old/c']
+    subprocess.check_call(['tar', 'xzf', out_tar, '-C', work_dir])
+    for fpath in fpaths:
+        assert filecmp.cmp(fpath, os.path.join(work_dir, 'uuid', 'new', os.path.basename(fpath)), shallow=False)
+    assert filecmp.cmp(fpaths[2], os.path.join(work_dir, 'uuid', 'old', 'c'), shallow=False)
+
+
+def test_consolidate_tarballs_zstd(tmpdir):
+    pytest.importorskip('zstandard')
+    from toil_scripts.lib.files import consolidate_tarballs, tarball_files
+    work_dir = str(tmpdir)
+    fpaths = _random_files(work_dir, [('a', 5 * 1024 * 1024 + 1), ('b', 1000)])
+    # A zstd tarball of several frames is decompressed and recompressed
+    tarball_files('in.tar.zst', file_paths=fpaths, output_dir=work_dir, compression='zst')
+    out_tar = os.path.join(work_dir, 'out.tar.gz')
+    with open(out_tar, 'wb') as f:
+        consolidate_tarballs(f, [(os.path.join(work_dir, 'in.tar.zst'), 'uuid/in')])
+    with tarfile.open(out_tar, 'r') as f_in:
+        assert f_in.getnames() == ['uuid/in/a', 'uuid/in/b']
+        for fpath in fpaths:
+            assert f_in.extractfile('uuid/in/' + os.path.basename(fpath)).read() == open(fpath, 'rb').read()
+
+
+def test_tarball_files_job(tmpdir):
+    options = Job.Runner.getDefaultOptions(os.path.join(str(tmpdir), 'test_store'))
+    Job.Runner.startToil(Job.wrapJobFn(_tarball_files_job_setup), options)
+
+
+def _tarball_files_job_setup(job):
+    from toil_scripts.lib.files import tarball_files_job
+    work_dir = job.fileStore.getLocalTempDir()
+    fpath = os.path.join(work_dir, 'output_file')
+    with open(fpath, 'wb') as fout:
+        fout.write(os.urandom(1024))
+    file_id = tarball_files_job(job, [fpath], prefix='prefix_')
+    with tarfile.open(job.fileStore.readGlobalFile(file_id), 'r') as f_in:
+        assert f_in.extractfile('prefix_output_file').read() == open(fpath, 'rb').read()
+
+
 def test_copy_files(tmpdir):
     from toil_scripts.lib.files import copy_files
     work_dir = str(tmpdir)
@@ -20,8 +92,44 @@ def test_copy_files(tmpdir):
     fpath = os.path.join(work_dir, 'output_file')
     with open(fpath, 'wb') as fout:
         fout.write(os.urandom(1024))
-    copy_files([fpath], os.path.join(work_dir, 'test'))
-    assert os.path.exists(os.path.join(work_dir, 'test', 'output_file'))
+    dest = os.path.join(work_dir, 'test', 'output_file')
+    # Outputs do not share the inode of the source unless hardlinks are asked for
+    assert copy_files([fpath], os.path.join(work_dir, 'test')) != ['hardlink']
+    assert os.path.exists(dest) and not os.path.samefile(fpath, dest)
+    assert copy_files([fpath], os.path.join(work_dir, 'test'), hardlink=True) == ['hardlink']
+    assert os.path.samefile(fpath, dest)
+    # A file that is already in place is left alone
+    assert copy_files([fpath], os.path.join(work_dir, 'test')) == ['same']
+    assert copy_files([fpath], work_dir) == ['same']
+
+
+def test_copy_files_without_hardlink(tmpdir, monkeypatch):
+    from toil_scripts.lib import files
+    work_dir = str(tmpdir)
+    os.mkdir(os.path.join(work_dir, 'test'))
+    fpath = os.path.join(work_dir, 'output_file')
+    with open(fpath, 'wb') as fout:
+        fout.write(os.urandom(3 * 1024 * 1024 + 1))
+    os.chmod(fpath, 0o640)
+
+    def link(src, dest):
+        raise OSError(18, 'Invalid cross-device link')
+
+    def unsupported(fd_in, fd_out, size):
+        # Fail partway through, as a copy that runs out of space would
+        os.write(fd_out, os.read(fd_in, 100))
+        raise OSError(95, 'Operation not supported')
+    monkeypatch.setattr(os, 'link', link)
+    dest = os.path.join(work_dir, 'test', 'output_file')
+    for disabled in [None, '_reflink', '_copy_file_range', '_sendfile']:
+        if disabled:
+            monkeypatch.setattr(files, disabled, unsupported)
+        method, = files.copy_files([fpath], os.path.join(work_dir, 'test'), hardlink=True)
+        assert method != 'hardlink'
+        assert filecmp.cmp(fpath, dest, shallow=False)
+        assert os.stat(dest).st_mode & 0o777 == 0o640
+        assert not os.path.samefile(fpath, dest)
+    assert method == 'copy'
 
 
 def test_consolidate_tarballs_job(tmpdir):
@@ -46,3 +154,18 @@ def _consolidate_tarball_job_setup(job):
     id1 = job.fileStore.writeGlobalFile(fpath1)
     id2 = job.fileStore.writeGlobalFile(fpath2)
     job.addChildJobFn(consolidate_tarballs_job, dict(test1=id1, test2=id2))
+
+
+def _random_files(work_dir, sizes):
+    """
+    :param str work_dir: Directory to write the files to
+    :param list[tuple(str,int)] sizes: Name and size of each file
+    :return: Paths of the files, filled with random bytes
+    :rtype: list[str]
+    """
+    fpaths = []
+    for name, size in sizes:
+        fpaths.append(os.path.join(work_dir, name))
+        with open(fpaths[-1], 'wb') as fout:
+            fout.write(os.urandom(size))
+    return fpaths
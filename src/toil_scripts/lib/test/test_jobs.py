@@ -1,4 +1,5 @@
 import tempfile
+import time
 
 import os
 from toil.job import Job
@@ -19,3 +20,210 @@ def _test_batch(job, sample, a, b, c):
     assert a == 'a'
     assert b == 'b'
     assert c == 'c'
+
+
+def test_map_job_batched(tmpdir):
+    from toil_scripts.lib.jobs import map_job
+    work_dir = str(tmpdir)
+    options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'test_store'))
+    options.workDir = work_dir
+    done_dir = str(tmpdir.mkdir('done'))
+    j = Job.wrapJobFn(map_job, _test_mark, range(50), done_dir, batch_size=20, batch_workers=4,
+                      batch_requirements=dict(disk='1K'), disk='1K')
+    Job.Runner.startToil(j, options)
+    assert sorted(int(x) for x in os.listdir(done_dir)) == range(50)
+
+
+def test_serialized_job():
+    import threading
+    from contextlib import contextmanager
+    from multiprocessing.pool import ThreadPool
+    from toil_scripts.lib.jobs import _SerializedJob
+    active, overlaps = [], []
+
+    class FileStore(object):
+        def logToMaster(self, message):
+            active.append(message)
+            overlaps.append(len(active))
+            time.sleep(0.01)
+            active.remove(message)
+
+        @contextmanager
+        def writeGlobalFileStream(self):
+            self.logToMaster('enter')
+            yield None, 'file_id'
+            self.logToMaster('exit')
+
+    class FakeJob(object):
+        fileStore = FileStore()
+    shared_job = _SerializedJob(FakeJob(), threading.RLock())
+
+    def call(i):
+        shared_job.fileStore.logToMaster(i)
+        with shared_job.fileStore.writeGlobalFileStream() as (f, file_id):
+            assert file_id == 'file_id'
+    pool = ThreadPool(8)
+    pool.map(call, range(32))
+    pool.close()
+    pool.join()
+    assert len(overlaps) == 96 and max(overlaps) == 1
+
+
+def test_map_job_max_in_flight(tmpdir):
+    from toil_scripts.lib.jobs import map_job
+    work_dir = str(tmpdir)
+    options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'test_store'))
+    options.workDir = work_dir
+    done_dir = str(tmpdir.mkdir('done'))
+    j = Job.wrapJobFn(map_job, _test_in_flight, range(12), done_dir, max_in_flight=2, disk='1K')
+    Job.Runner.startToil(j, options)
+    events = []
+    for name in os.listdir(done_dir):
+        with open(os.path.join(done_dir, name)) as f:
+            start, end = map(float, f.read().split())
+        events += [(start, 1), (end, -1)]
+    in_flight = peak = 0
+    for _, change in sorted(events):
+        in_flight += change
+        peak = max(peak, in_flight)
+    assert len(events) == 24 and peak <= 2
+
+
+def test_map_job_longest_first(tmpdir):
+    from toil_scripts.lib.jobs import map_job
+    work_dir = str(tmpdir)
+    options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'test_store'))
+    options.workDir = work_dir
+    samples = []
+    for i, size in enumerate([100, 400, 200, 300]):
+        fpath = os.path.join(work_dir, str(i))
+        with open(fpath, 'wb') as f:
+            f.write('x' * size)
+        samples.append('file://' + fpath)
+    log = os.path.join(work_dir, 'log')
+    # A single lane runs the samples one at a time, in the order they are scheduled
+    j = Job.wrapJobFn(map_job, _test_log, samples, log, max_in_flight=1, sample_urls=_test_urls, disk='1K')
+    Job.Runner.startToil(j, options)
+    with open(log) as f:
+        assert [os.path.basename(line.strip()) for line in f] == ['1', '3', '2', '0']
+
+
+def test_balanced_partitions():
+    from toil_scripts.lib.jobs import _balanced_partitions
+    assert _balanced_partitions(list('abcdef'), [10, 7, 5, 4, 3, 1], 2) == [(['a', 'd', 'f'], [10, 4, 1]),
+                                                                            (['b', 'c', 'e'], [7, 5, 3])]
+    assert _balanced_partitions(['a'], [1], 3) == [(['a'], [1])]
+
+
+def test_map_reduce_job(tmpdir):
+    from toil_scripts.lib.jobs import map_reduce_job
+    work_dir = str(tmpdir)
+    options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'test_store'))
+    options.workDir = work_dir
+    # Three levels of at most 5 results each. With fractional cores, follow-ons of the root could run alongside the
+    # final, slow combine if it were not a descendant of the root.
+    root = Job.wrapJobFn(map_reduce_job, _test_square, _test_concat, range(60), 'a', fan_in=5,
+                         combine_requirements=dict(cores=0.1, disk='1K'), cores=0.1, disk='1K')
+    root.addFollowOnJobFn(_test_check_reduced, root.rv(), cores=0.1, disk='1K')
+    Job.Runner.startToil(root, options)
+
+
+def _test_square(job, sample, a):
+    assert a == 'a'
+    # Results may be promises of the sample's child jobs
+    return job.addChildFn(_test_listed_square, sample, disk='1K').rv()
+
+
+def _test_listed_square(sample):
+    return [sample * sample]
+
+
+def _test_concat(results):
+    assert len(results) <= 5
+    combined = sum(results, [])
+    if len(combined) == 60:
+        time.sleep(1)
+    return combined
+
+
+def _test_check_reduced(job, result):
+    assert result == [x * x for x in xrange(60)]
+
+
+def _test_urls(sample):
+    return [sample]
+
+
+def _test_log(job, sample, log):
+    with open(log, 'a') as f:
+        f.write(sample + '\n')
+
+
+def _test_mark(job, sample, done_dir):
+    job.fileStore.logToMaster('Marking sample {}'.format(sample))
+    open(os.path.join(done_dir, str(sample)), 'w').close()
+
+
+def _test_in_flight(job, sample, done_dir):
+    # The sample is only done once its child is
+    job.addChildJobFn(_test_in_flight_child, sample, done_dir, time.time(), disk='1K')
+
+
+def _test_in_flight_child(job, sample, done_dir, start):
+    time.sleep(0.2)
+    with open(os.path.join(done_dir, str(sample)), 'w') as f:
+        f.write('{} {}'.format(start, time.time()))
+
+
+def test_prefetch_waves(tmpdir):
+    from toil_scripts.lib.jobs import prefetch_waves
+    samples = []
+    for i, size in enumerate([400, 300, 500, 2000, 100]):
+        fpath = os.path.join(str(tmpdir), str(i))
+        with open(fpath, 'wb') as f:
+            f.write('x' * size)
+        samples.append([str(i), 'file://' + fpath])
+    waves = prefetch_waves(samples, lambda sample: sample[1:], disk_budget=2000)
+    assert [[sample[0] for sample in wave] for wave in waves] == [['0', '1'], ['2'], ['3'], ['4']]
+
+
+def test_prefetch_map_job(tmpdir):
+    work_dir = str(tmpdir)
+    options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'test_store'))
+    options.workDir = work_dir
+    ids_dir = str(tmpdir.mkdir('ids'))
+    waves = [[x, x + 1] for x in xrange(0, 10, 2)]
+    Job.Runner.startToil(Job.wrapJobFn(_test_prefetch_setup, waves, ids_dir), options)
+    assert len(os.listdir(ids_dir)) == 10
+
+
+def _test_prefetch_setup(job, waves, ids_dir):
+    from toil_scripts.lib.jobs import prefetch_map_job
+    job.addChildJobFn(prefetch_map_job, _test_prefetch, _test_process, waves, '1K', ids_dir)
+    job.addFollowOnJobFn(_test_prefetch_deleted, ids_dir)
+
+
+def _test_prefetch(job, sample, ids_dir):
+    file_id = job.fileStore.writeGlobalFile(_write_temp(job, str(sample)))
+    with open(os.path.join(ids_dir, str(sample)), 'w') as f:
+        f.write(file_id)
+    return sample, file_id
+
+
+def _test_process(job, sample, file_id):
+    with open(job.fileStore.readGlobalFile(file_id)) as f:
+        assert f.read() == str(sample)
+
+
+def _test_prefetch_deleted(job, ids_dir):
+    # The prefetched inputs are removed from the job store once their samples are processed
+    for name in os.listdir(ids_dir):
+        with open(os.path.join(ids_dir, name)) as f:
+            assert not job.fileStore.jobStore.fileExists(f.read())
+
+
+def _write_temp(job, content):
+    fpath = os.path.join(job.fileStore.getLocalTempDir(), 'sample')
+    with open(fpath, 'w') as f:
+        f.write(content)
+    return fpath
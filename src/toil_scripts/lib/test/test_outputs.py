@@ -0,0 +1,99 @@
+import json
+import os
+
+import pytest
+
+
+def test_store_output(tmpdir, monkeypatch):
+    from toil_scripts.lib import outputs
+    from toil_scripts.lib.outputs import store_output, output_exists, remove_finished_samples
+    work_dir = str(tmpdir)
+    fpath = os.path.join(work_dir, 'sample.tar.gz')
+    with open(fpath, 'wb') as f:
+        f.write(os.urandom(1024))
+    output_dir = os.path.join(work_dir, 'output')
+    assert not output_exists(os.path.join(output_dir, 'sample.tar.gz'))
+    store_output(fpath, output_dir)
+    assert sorted(os.listdir(output_dir)) == ['sample.tar.gz', 'sample.tar.gz.manifest.json']
+    assert output_exists(os.path.join(output_dir, 'sample.tar.gz'))
+    # A truncated output is not complete
+    with open(os.path.join(output_dir, 'sample.tar.gz'), 'r+b') as f:
+        f.truncate(100)
+    assert not output_exists(os.path.join(output_dir, 'sample.tar.gz'))
+    store_output(fpath, output_dir)
+    assert output_exists(os.path.join(output_dir, 'sample.tar.gz'))
+    # A manifest left by a previous run is removed before the output is overwritten
+    with monkeypatch.context() as m:
+        m.setattr(outputs, 'copy_files', _fail)
+        with pytest.raises(IOError):
+            store_output(fpath, output_dir)
+    assert not output_exists(os.path.join(output_dir, 'sample.tar.gz'))
+    store_output(fpath, output_dir)
+    samples = [['sample'], ['other']]
+    assert remove_finished_samples(samples, lambda x: [os.path.join(output_dir, x[0] + '.tar.gz')]) == [['other']]
+
+
+def test_store_output_s3(tmpdir, monkeypatch):
+    from boto.s3.bucket import Bucket
+    from toil_scripts.benchmarks.s3_standin import S3StandIn
+    from toil_scripts.lib.outputs import store_output, output_exists
+    work_dir = str(tmpdir)
+    os.makedirs(os.path.join(work_dir, 'store', 'bucket'))
+    fpath = os.path.join(work_dir, 'sample.bam')
+    with open(fpath, 'wb') as f:
+        f.write(os.urandom(1024))
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'standin')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'standin')
+    with S3StandIn(os.path.join(work_dir, 'store')) as endpoint:
+        monkeypatch.setenv('TOIL_SCRIPTS_S3_ENDPOINT', endpoint)
+        assert not output_exists('s3://bucket/dir/sample.bam')
+        store_output(fpath, 's3://bucket/dir')
+        assert output_exists('s3://bucket/dir/sample.bam')
+        # An object whose content does not match the MD5 in its manifest is not complete
+        manifest_path = os.path.join(work_dir, 'store', 'bucket', 'dir', 'sample.bam.manifest.json')
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        with open(manifest_path, 'w') as f:
+            json.dump(dict(manifest, md5='0' * 32), f)
+        assert not output_exists('s3://bucket/dir/sample.bam')
+        # The ETag of an SSE-KMS object is not the MD5 of its content, so only its size is checked
+        get_key = Bucket.get_key
+
+        def get_kms_key(self, *args, **kwargs):
+            key = get_key(self, *args, **kwargs)
+            key.encrypted = 'aws:kms'
+            return key
+        monkeypatch.setattr(Bucket, 'get_key', get_kms_key)
+        assert output_exists('s3://bucket/dir/sample.bam')
+
+
+def test_open_output(tmpdir, monkeypatch):
+    from toil_scripts.benchmarks.s3_standin import S3StandIn
+    from toil_scripts.lib.outputs import open_output, output_exists
+    work_dir = str(tmpdir)
+    os.makedirs(os.path.join(work_dir, 'store', 'bucket'))
+    output_dir = os.path.join(work_dir, 'output')
+    data = os.urandom(250 * 1024)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'standin')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'standin')
+    with S3StandIn(os.path.join(work_dir, 'store')) as endpoint:
+        monkeypatch.setenv('TOIL_SCRIPTS_S3_ENDPOINT', endpoint)
+        with open_output('sample.tar.gz', [output_dir, 's3://bucket/dir']) as f:
+            f.write(data)
+        assert output_exists(os.path.join(output_dir, 'sample.tar.gz'))
+        assert output_exists('s3://bucket/dir/sample.tar.gz')
+        # A failed rewrite does not leave a complete output behind
+        try:
+            with open_output('sample.tar.gz', [output_dir, 's3://bucket/dir']) as f:
+                f.write(data[:100])
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        assert not output_exists(os.path.join(output_dir, 'sample.tar.gz'))
+        assert not output_exists('s3://bucket/dir/sample.tar.gz')
+    with open(os.path.join(output_dir, 'sample.tar.gz'), 'rb') as f:
+        assert f.read() == data[:100]
+
+
+def _fail(*args, **kwargs):
+    raise IOError('No space left on device')
@@ -12,3 +12,358 @@ def test_docker_call(tmpdir):
     with open(fpath, 'w') as f:
         docker_call(tool='ubuntu', env=dict(foo='bar'), parameters=['printenv', 'foo'], outfile=f)
     assert open(fpath).read() == 'bar\n'
+
+
+def test_docker_call_pooled(tmpdir, monkeypatch):
+    from toil_scripts.lib.docker_pool import ContainerPool
+    from toil_scripts.lib.programs import docker_call
+    root = str(tmpdir)
+    monkeypatch.setenv('TOIL_SCRIPTS_DOCKER_POOL_ROOT', root)
+    try:
+        for name in ['a', 'b']:
+            work_dir = os.path.join(root, name)
+            os.mkdir(work_dir)
+            # Both calls run in the same container, each with its own work directory mapped to /data
+            docker_call(tool='ubuntu', parameters=['sh', '-c', 'echo $foo > /data/out'], env=dict(foo=name),
+                        work_dir=work_dir, outputs={'out': None})
+            assert open(os.path.join(work_dir, 'out')).read() == name + '\n'
+            assert os.stat(os.path.join(work_dir, 'out')).st_uid == os.getuid()
+        assert len(os.listdir(os.path.join(root, '.toil-scripts-docker-pool'))) == 1
+    finally:
+        ContainerPool(root).reap(idle_timeout=0)
+
+
+def test_container_pool_concurrent(tmpdir, monkeypatch):
+    import threading
+    import time
+    from toil_scripts.lib.docker_pool import ContainerPool
+    pool = ContainerPool(str(tmpdir))
+    monkeypatch.setattr(pool, '_running', lambda f, name: dict(entrypoint=[], cmd=[]))
+    monkeypatch.setattr(pool, 'reap', lambda: None)
+
+    def call():
+        with pool.command('ubuntu', ['true'], os.path.join(str(tmpdir), 'work')):
+            time.sleep(1)
+    # Calls of the same image share the container's lock, so they do not wait for each other
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.time() - start < 2
+
+
+def test_container_pool_reaper(tmpdir, monkeypatch):
+    from toil_scripts.lib import docker_pool
+    removed = []
+    monkeypatch.setattr(docker_pool, '_remove', removed.append)
+    pool = docker_pool.ContainerPool(str(tmpdir), idle_timeout=0)
+    for name in ['a', 'b']:
+        with open(os.path.join(pool.state_dir, name), 'w') as f:
+            f.write('{}')
+    open(os.path.join(pool.state_dir, 'c'), 'w').close()
+    # Returns once every container is removed, leaving removed containers alone
+    pool.run_reaper(interval=0)
+    assert sorted(removed) == ['a', 'b']
+    assert not pool._containers()
+
+
+def test_translate_paths():
+    from toil_scripts.lib.docker_pool import translate_paths
+    assert translate_paths('/data', '/work') == '/work'
+    assert translate_paths('/data/ref.fa', '/work') == '/work/ref.fa'
+    assert translate_paths('INPUT=/data/in.bam', '/work') == 'INPUT=/work/in.bam'
+    assert translate_paths('/data/a.bam,/data/b.bam', '/work') == '/work/a.bam,/work/b.bam'
+    assert translate_paths('/database/x', '/work') == '/database/x'
+    assert translate_paths('/mnt/data/x', '/work') == '/mnt/data/x'
+    assert translate_paths('echo > /data/out', '/work') == 'echo > /work/out'
+    assert translate_paths('-o/data/out', '/work') == '-o/work/out'
+    assert translate_paths("sh -c 'cat -I/data/x > /data'", '/work') == "sh -c 'cat -I/work/x > /work'"
+    assert translate_paths('--o/data/out', '/work') == '--o/data/out'
+
+
+def test_container_pool_accepts(tmpdir, monkeypatch):
+    from toil_scripts.lib import docker_pool
+    checked = []
+
+    def uses_data(tool):
+        checked.append(tool)
+        return tool == 'wrapper'
+    monkeypatch.setattr(docker_pool, '_entrypoint_uses_data', uses_data)
+    pool = docker_pool.ContainerPool(str(tmpdir))
+    work_dir = os.path.join(str(tmpdir), 'work')
+    assert not pool.accepts(os.path.join(str(tmpdir) + '-other', 'work'), 'ubuntu')
+    # Images whose entrypoint refers to /data run in a new container, and each image is checked once
+    for _ in range(2):
+        assert pool.accepts(work_dir, 'ubuntu')
+        assert not pool.accepts(work_dir, 'wrapper')
+    assert checked == ['ubuntu', 'wrapper']
+    # Calls that set the entrypoint would replace the one that keeps the container running
+    assert not pool.accepts(work_dir, 'ubuntu', ['--entrypoint', 'sh'])
+    assert not pool.accepts(work_dir, 'ubuntu', ['--entrypoint=sh'])
+    assert pool.accepts(work_dir, 'ubuntu', ['--memory', '1g'])
+
+
+def test_caller_parameters(tmpdir, monkeypatch):
+    from toil_scripts.lib.programs import _caller_parameters
+    work_dir = str(tmpdir)
+    monkeypatch.setenv('TOIL_SCRIPTS_DOCKER_USER', 'root')
+    assert _caller_parameters('ubuntu', work_dir) is None
+    monkeypatch.delenv('TOIL_SCRIPTS_DOCKER_USER')
+    # The user set by the caller is kept
+    assert _caller_parameters('ubuntu', work_dir, docker_parameters=['--user', '0']) is None
+    assert _caller_parameters('ubuntu', work_dir, docker_parameters=['--user=0']) is None
+    run_parameters, user_parameters = _caller_parameters('ubuntu', work_dir)
+    stat = os.stat(work_dir)
+    assert user_parameters in ([], ['--user', '{}:{}'.format(stat.st_uid, stat.st_gid)])
+
+
+def test_caller_parameters_probe_unlocked(tmpdir, monkeypatch):
+    import fcntl
+    import json
+    import tempfile
+    from toil_scripts.lib import programs
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+    monkeypatch.setattr(programs, '_daemon_mode', lambda: 'root')
+    path = os.path.join(str(tmpdir), 'toil-scripts-docker-user-{}.json'.format(os.getuid()))
+
+    def probe(tool, user_parameters):
+        # Other calls can read the record while the image is probed
+        with open(path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    monkeypatch.setattr(programs, '_probe', probe)
+    assert programs._caller_parameters('tool', str(tmpdir))
+    with open(path) as f:
+        assert json.load(f) == dict(daemon='root', images=dict(tool=True))
+
+
+def test_probe_timeout(monkeypatch):
+    from toil_scripts.lib import programs
+    commands = []
+
+    class Hung(object):
+        returncode = None
+
+        def __init__(self, command, **kwargs):
+            commands.append(command)
+
+        def poll(self):
+            return self.returncode
+
+        def kill(self):
+            self.returncode = -9
+
+        def wait(self):
+            return self.returncode
+
+    monkeypatch.setattr(programs.subprocess, 'Popen', Hung)
+    monkeypatch.setattr(programs.subprocess, 'call', lambda command, **kwargs: commands.append(command))
+    # A probe that hangs is killed and runs the image as root
+    assert not programs._probe('tool', ['--user', '1000:1000'], timeout=0.2)
+    run, kill = commands
+    assert '-i=false' in run
+    assert run[run.index('--entrypoint') + 1:] == ['sh', 'tool', '-c', 'touch /data/.probe']
+    assert kill == ['docker', 'kill', run[run.index('--name') + 1]]
+
+
+def test_docker_run_root_fallback(tmpdir, monkeypatch):
+    import json
+    import subprocess
+    import tempfile
+    import pytest
+    from toil_scripts.lib import programs
+    work_dir = str(tmpdir.mkdir('work'))
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+    monkeypatch.setattr(programs, '_ensure_image', lambda tool: None)
+    monkeypatch.setattr(programs, '_user_parameters', lambda *args: ([], ['--user', '1000:1000']))
+    path = os.path.join(str(tmpdir), 'toil-scripts-docker-user-{}.json'.format(os.getuid()))
+    calls = []
+
+    def run_as(tool, parameters, work_dir, rm, env, outfile, docker_parameters, check_output, caller, errors=None,
+               mounts=None):
+        calls.append(caller)
+        outfile.write('partial' if caller else 'complete')
+        if caller:
+            errors.append(parameters[0])
+            raise subprocess.CalledProcessError(1, ['docker', 'run'])
+    monkeypatch.setattr(programs, '_docker_run_as', run_as)
+    # A failure that is not for lack of a permission is raised, without a retry or a record of the image
+    with open(os.path.join(work_dir, 'out'), 'w+') as f:
+        with pytest.raises(subprocess.CalledProcessError):
+            programs._docker_run('tool', ['Out of memory\n'], work_dir, True, None, f, None, False)
+    assert calls == [([], ['--user', '1000:1000'])]
+    assert not os.path.exists(path)
+    # An image that passes the probe but is denied a permission in a real call as the caller is run again as root,
+    # and recorded as such
+    del calls[:]
+    with open(os.path.join(work_dir, 'out'), 'w+') as f:
+        programs._docker_run('tool', ['mkdir: /root/.cache: Permission denied\n'], work_dir, True, None, f, None,
+                             False)
+        f.seek(0)
+        assert f.read() == 'complete'
+    assert calls == [([], ['--user', '1000:1000']), None]
+    with open(path) as f:
+        assert json.load(f)['images'] == dict(tool=False)
+
+
+def test_run_teeing_stderr():
+    import subprocess
+    import pytest
+    from toil_scripts.lib.programs import _run
+    errors = []
+    assert _run(['sh', '-c', 'echo out; echo err >&2'], None, True, None, errors=errors) == 'out\n'
+    assert errors == ['err\n']
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        _run(['sh', '-c', 'echo denied >&2; exit 126'], None, False, None, errors=errors)
+    assert e.value.returncode == 126 and errors[-1] == 'denied\n'
+
+
+def test_referenced_images():
+    from toil_scripts.lib.programs import referenced_images
+    from toil_scripts.tools.preprocessing import run_gatk_preprocessing, run_samtools_index
+    # Images of the child jobs are collected, untagged and lib images are not
+    assert referenced_images(run_gatk_preprocessing) == [
+        'quay.io/ucsc_cgl/gatk:3.5--dba6dae49156168a909c43330350c6161dc7ecc2']
+    assert referenced_images(run_gatk_preprocessing, run_samtools_index) == [
+        'quay.io/ucsc_cgl/gatk:3.5--dba6dae49156168a909c43330350c6161dc7ecc2',
+        'quay.io/ucsc_cgl/samtools:0.1.19--dd5ac549b95eb3e5d166a5e310417ef13651994e']
+
+
+def test_pull_images():
+    from toil_scripts.lib.programs import pull_images
+    times = pull_images(['ubuntu', 'quay.io/ucsc_cgl/no-such-image:0'])
+    assert times['ubuntu'] is not None
+    # Present images are not pulled again, failed pulls are left to the first call
+    assert pull_images(['ubuntu']) == {'ubuntu': 0}
+    assert times['quay.io/ucsc_cgl/no-such-image:0'] is None
+
+
+def test_prewarm_images(tmpdir, monkeypatch):
+    import fcntl
+    import hashlib
+    import tempfile
+    from toil_scripts.lib import programs
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+    monkeypatch.setenv('TOIL_SCRIPTS_DOCKER_IMAGES', 'image:1 image:2')
+    pulled = []
+    monkeypatch.setattr(programs, 'pull_images', lambda images: pulled.append(images) or dict.fromkeys(images, 1.0))
+    monkeypatch.setattr(programs, '_prewarm_checked', [])
+    # The first call on the node pulls the list, later calls in the same or other processes do not
+    programs._prewarm_images()
+    programs._prewarm_images()
+    monkeypatch.setattr(programs, '_prewarm_checked', [])
+    programs._prewarm_images()
+    assert pulled == [['image:1', 'image:2']]
+    # Calls do not wait for a pre-warm that is in progress in another process
+    monkeypatch.setenv('TOIL_SCRIPTS_DOCKER_IMAGES', 'image:3')
+    monkeypatch.setattr(programs, '_prewarm_checked', [])
+    lock_path = os.path.join(str(tmpdir), 'toil-scripts-docker-prewarm-' + hashlib.sha1('image:3').hexdigest())
+    with open(lock_path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        programs._prewarm_images()
+    assert pulled == [['image:1', 'image:2']]
+
+
+def test_pull_image_telemetry(tmpdir, monkeypatch):
+    import tempfile
+    from toil_scripts.lib import programs
+    from toil_scripts.lib.telemetry import read_records
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+    log = os.path.join(str(tmpdir), 'telemetry.jsonl')
+    monkeypatch.setenv('TOIL_SCRIPTS_TELEMETRY', log)
+
+    class Pull(object):
+        returncode = 0
+
+        def __init__(self, command, **kwargs):
+            assert command == ['docker', 'pull', 'image:1']
+
+        def communicate(self):
+            return '', ''
+
+    monkeypatch.setattr(programs.subprocess, 'call', lambda command, **kwargs: 1)
+    monkeypatch.setattr(programs.subprocess, 'Popen', Pull)
+    assert programs._pull_image('image:1') is not None
+    # Pulls have records of their own
+    record, = read_records(log)
+    assert record['tool'] == 'image:1' and record['backend'] == 'pull' and record['success']
+
+
+def test_docker_pipe(tmpdir):
+    import subprocess
+    from toil_scripts.lib.programs import docker_pipe
+    work_dir = str(tmpdir)
+    with open(os.path.join(work_dir, 'in'), 'w') as f:
+        f.write('\n'.join(str(i) for i in xrange(100000)) + '\n')
+    output = docker_pipe([dict(tool='ubuntu', parameters=['cat', '/data/in']),
+                          dict(tool='ubuntu', parameters=['grep', '7']),
+                          dict(tool='ubuntu', parameters=['wc', '-l'])], work_dir=work_dir, check_output=True)
+    assert int(output) == sum(1 for i in xrange(100000) if '7' in str(i))
+    # The failure of a later stage is reported, not the broken pipe of the stages before it
+    try:
+        docker_pipe([dict(tool='ubuntu', parameters=['cat', '/data/in']),
+                     dict(tool='ubuntu', parameters=['sh', '-c', 'head -n 1 && exit 3'])], work_dir=work_dir)
+    except subprocess.CalledProcessError as e:
+        assert e.returncode == 3
+    else:
+        assert False, 'Failure of a stage was not raised'
+
+
+def test_docker_call_native(tmpdir, monkeypatch):
+    import subprocess
+    from toil_scripts.lib.programs import docker_call, docker_pipe
+    from toil_scripts.lib.telemetry import read_records
+    work_dir = str(tmpdir.mkdir('work'))
+    tools = os.path.join(str(tmpdir), 'native-tools.yaml')
+    with open(tools, 'w') as f:
+        f.write('ubuntu: {command: [], env: {foo: /data/foo}}\n'
+                'quay.io/ucsc_cgl/samtools: printf "%s|"\n')
+    monkeypatch.setenv('TOIL_SCRIPTS_NATIVE_TOOLS', tools)
+    log = os.path.join(str(tmpdir), 'telemetry.jsonl')
+    monkeypatch.setenv('TOIL_SCRIPTS_TELEMETRY', log)
+    # Every tag of a repository is mapped, /data is rewritten in parameters and the environment
+    output = docker_call(tool='quay.io/ucsc_cgl/samtools:1.3', parameters=['view', 'INPUT=/data/in.bam'],
+                         work_dir=work_dir, check_output=True)
+    assert output == 'view|INPUT={}/in.bam|'.format(work_dir)
+    docker_call(tool='ubuntu', parameters=['sh', '-c', 'echo $foo $bar > out'], env=dict(bar='/data'),
+                work_dir=work_dir, outputs={'out': None})
+    assert open(os.path.join(work_dir, 'out')).read() == '{0}/foo {0}\n'.format(work_dir)
+    try:
+        docker_call(tool='ubuntu', parameters=['false'], work_dir=work_dir)
+    except subprocess.CalledProcessError as e:
+        assert e.returncode == 1
+    else:
+        assert False, 'Failure of the native tool was not raised'
+    records = read_records(log)
+    assert [(x['backend'], x['success']) for x in records] == [('native', True)] * 2 + [('native', False)]
+    assert records[0]['cpu_seconds'] is not None
+    # Mounts are linked into the work directory for the duration of the call
+    index = os.path.join(str(tmpdir), 'index')
+    with open(index, 'w') as f:
+        f.write('ACGT')
+    output = docker_call(tool='ubuntu', parameters=['cat', '/data/ref/index'], work_dir=work_dir, check_output=True,
+                         mounts={'/data/ref/index': index})
+    assert output == 'ACGT'
+    assert not os.path.lexists(os.path.join(work_dir, 'ref', 'index'))
+    # Native stages of a pipeline run in the work directory too
+    output = docker_pipe([dict(tool='ubuntu', parameters=['cat', '/data/out']),
+                          dict(tool='ubuntu', parameters=['wc', '-c'])], work_dir=work_dir, check_output=True)
+    assert int(output) == len(work_dir) * 2 + 6
+
+
+def test_native_tool_identity(tmpdir, monkeypatch):
+    from toil_scripts.lib.native_tools import NativeTools
+    bin_dir = str(tmpdir.mkdir('bin'))
+    executable = os.path.join(bin_dir, 'tool')
+    with open(executable, 'w') as f:
+        f.write('#!/bin/sh\n')
+    os.chmod(executable, 0o755)
+    monkeypatch.setenv('PATH', bin_dir)
+    native = NativeTools({'image': 'tool', 'shell': {'command': []}})
+    identity = native.identity('image')
+    assert native.identity('shell', ['tool', '--help']) == native.identity('shell', ['tool'])
+    # Upgrading the installed tool changes its identity
+    os.utime(executable, (0, 0))
+    assert native.identity('image') != identity
@@ -0,0 +1,33 @@
+import os
+
+
+def test_record_call(tmpdir, monkeypatch):
+    from toil_scripts.lib.telemetry import ContainerMonitor, read_records, record_call, summarize
+    log = os.path.join(str(tmpdir), 'telemetry.jsonl')
+    monkeypatch.setenv('TOIL_SCRIPTS_TELEMETRY', log)
+    work_dir = str(tmpdir.mkdir('work'))
+
+    def run_tool(job, config):
+        def write():
+            with open(os.path.join(work_dir, 'out'), 'w') as f:
+                f.write('x' * 1000)
+            return 'output'
+        # The container never starts, so there are no cgroup counters
+        monitor = ContainerMonitor(cidfile=os.path.join(work_dir, 'cid'), interval=0.01)
+        return record_call('quay.io/ucsc_cgl/tool:1', ['index'], work_dir, monitor, write)
+
+    class Config(object):
+        uuid = 'sample-1'
+
+    assert run_tool(None, Config()) == 'output'
+    record, = read_records(log)
+    assert record['tool'] == 'quay.io/ucsc_cgl/tool:1'
+    assert record['command'] == 'index'
+    assert record['job_function'].endswith('.run_tool')
+    assert record['uuid'] == 'sample-1'
+    assert record['success'] and record['work_dir_growth'] == 1000
+    assert record['cpu_seconds'] is None
+    summary, = summarize(read_records(log) * 2)
+    assert summary['calls'] == 2 and summary['failures'] == 0
+    assert summary['total_wall_seconds'] == 2 * record['wall_seconds']
+    assert summary['max_work_dir_growth'] == 1000
@@ -1,6 +1,9 @@
 import os
 import subprocess
+import tarfile
 import filecmp
+import threading
+from contextlib import contextmanager
 from toil.job import Job
 
 
@@ -11,6 +14,107 @@ def test_download_url_job(tmpdir):
     Job.Runner.startToil(j, options)
 
 
+def test_download_url_job_stream(tmpdir, monkeypatch):
+    from toil_scripts.benchmarks.s3_standin import S3StandIn, create_object
+    work_dir = str(tmpdir)
+    src = create_object(os.path.join(work_dir, 'store'), 'bucket', 'object', 3 * 1024 * 1024 + 1)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'standin')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'standin')
+    options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'test_store'))
+    with S3StandIn(os.path.join(work_dir, 'store')) as endpoint:
+        monkeypatch.setenv('TOIL_SCRIPTS_S3_ENDPOINT', endpoint)
+        Job.Runner.startToil(Job.wrapJobFn(_download_url_job_stream_setup, src), options)
+
+
+def _download_url_job_stream_setup(job, src):
+    from toil_scripts.lib.urls import download_url_job
+    for url in ['file://' + src, 's3://bucket/object']:
+        file_id = job.addChildJobFn(download_url_job, url, stream=True).rv()
+        job.addFollowOnJobFn(_assert_file_store_copy, file_id, src)
+
+
+def _assert_file_store_copy(job, file_id, src):
+    assert filecmp.cmp(job.fileStore.readGlobalFile(file_id), src, shallow=False)
+
+
+def test_stream_url_etag(tmpdir, monkeypatch):
+    from io import BytesIO
+    import pytest
+    from toil_scripts.lib import urls
+
+    def open_url(url, s3_key_path=None):
+        # An S3 key with an ETag that is not the MD5 of its content
+        key = BytesIO('content')
+        key.etag, key.encrypted = '"{}"'.format('0' * 32), url
+        yield key
+    monkeypatch.setattr(urls, '_open_url', contextmanager(open_url))
+    job = _FakeJob(str(tmpdir))
+    with pytest.raises(IOError):
+        urls._stream_url_to_file_store(job, 'AES256')
+    # The file that failed the check is not left in the file store
+    assert job.deleted == ['file_id']
+    # ETags of objects encrypted with KMS keys are not checked
+    assert urls._stream_url_to_file_store(_FakeJob(str(tmpdir)), 'aws:kms') == 'file_id'
+
+
+def test_stream_url_resume(tmpdir, monkeypatch):
+    from toil_scripts.benchmarks.s3_standin import S3StandIn, create_object
+    from toil_scripts.lib import urls
+    work_dir = str(tmpdir)
+    src = create_object(os.path.join(work_dir, 'store'), 'bucket', 'object', 3 * 1024 * 1024 + 1)
+    truncated = _truncate_first_response(monkeypatch)
+    monkeypatch.setattr(urls.time, 'sleep', lambda seconds: None)
+    # A stream cut short is resumed where it stopped rather than stored as if it were complete
+    with S3StandIn(os.path.join(work_dir, 'store')) as endpoint:
+        urls._stream_url_to_file_store(_FakeJob(work_dir), endpoint + '/bucket/object')
+    assert truncated == [None]
+    assert filecmp.cmp(src, os.path.join(work_dir, 'copy'), shallow=False)
+
+
+class _FakeJob(object):
+    """
+    Job whose file store writes the single file it is given to work_dir/copy
+    """
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.fileStore = self
+        self.deleted = []
+
+    @contextmanager
+    def writeGlobalFileStream(self):
+        with open(os.path.join(self.work_dir, 'copy'), 'wb') as f:
+            yield f, 'file_id'
+
+    def deleteGlobalFile(self, file_id):
+        self.deleted.append(file_id)
+
+    def logToMaster(self, message):
+        pass
+
+
+def _truncate_first_response(monkeypatch):
+    """
+    Cuts the body of the first GET response short after 1000 bytes, as a dropped connection does
+
+    :return: Range headers of the truncated requests
+    :rtype: list
+    """
+    import urllib2
+    urlopen = urllib2.urlopen
+    truncated = []
+
+    def flaky_urlopen(request):
+        response = urlopen(request)
+        if request.get_method() == 'GET' and not truncated:
+            truncated.append(request.get_header('Range'))
+            chunks = [response.fp.read(1000)]
+            response.read = lambda *args: chunks.pop() if chunks else ''
+        return response
+    monkeypatch.setattr(urllib2, 'urlopen', flaky_urlopen)
+    return truncated
+
+
 def test_download_url(tmpdir):
     from toil_scripts.lib.urls import download_url
     work_dir = str(tmpdir)
@@ -46,3 +150,264 @@ def test_upload_and_download_with_encryption(tmpdir):
     k = Key(b)
     k.key = 'test/upload_file'
     k.delete()
+
+
+def test_download_ranges(tmpdir):
+    from toil_scripts.lib.urls import _download_ranges
+    data = os.urandom(1000)
+    fpath = os.path.join(str(tmpdir), 'ranges')
+
+    def fetch_range(start, end, f):
+        f.write(data[start:end + 1])
+
+    _download_ranges(fpath, len(data), fetch_range, part_size=64, num_cores=4)
+    assert open(fpath, 'rb').read() == data
+
+
+def test_download_s3_url_in_parts(tmpdir, monkeypatch):
+    from toil_scripts.benchmarks.s3_standin import S3StandIn, create_object
+    from toil_scripts.lib.urls import download_url
+    work_dir = str(tmpdir)
+    src = create_object(os.path.join(work_dir, 'store'), 'bucket', 'dir/object', 1024 * 1024 + 1)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'standin')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'standin')
+    with S3StandIn(os.path.join(work_dir, 'store')) as endpoint:
+        monkeypatch.setenv('TOIL_SCRIPTS_S3_ENDPOINT', endpoint)
+        dst = download_url('s3://bucket/dir/object', work_dir=work_dir, part_size=100 * 1024, num_cores=4)
+    assert filecmp.cmp(src, dst, shallow=False)
+
+
+def test_download_encrypted_file_in_parts(tmpdir, monkeypatch):
+    import urllib2
+    from toil_scripts.benchmarks.s3_standin import S3StandIn, create_object
+    from toil_scripts.lib import urls
+    work_dir = str(tmpdir)
+    src = create_object(os.path.join(work_dir, 'store'), 'bucket', 'object', 1024 * 1024 + 1)
+    key_path = os.path.join(work_dir, 'foo.key')
+    with open(key_path, 'wb') as f:
+        f.write(os.urandom(32))
+    # Cut the first ranged response short to check that the part resumes where it stopped
+    urlopen = urllib2.urlopen
+    truncated = []
+
+    def flaky_urlopen(request):
+        response = urlopen(request)
+        if request.has_header('Range') and not truncated:
+            truncated.append(request.get_header('Range'))
+            chunks = [response.fp.read(1000)]
+            response.read = lambda *args: chunks.pop() if chunks else ''
+        return response
+
+    monkeypatch.setattr(urllib2, 'urlopen', flaky_urlopen)
+    monkeypatch.setattr(urls.time, 'sleep', lambda seconds: None)
+    with S3StandIn(os.path.join(work_dir, 'store')) as endpoint:
+        dst = urls.download_url(endpoint + '/bucket/object', work_dir=work_dir, s3_key_path=key_path,
+                                part_size=100 * 1024, num_cores=4)
+    assert truncated
+    assert filecmp.cmp(src, dst, shallow=False)
+
+
+def test_download_http_url(tmpdir, monkeypatch):
+    import threading
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from toil_scripts.benchmarks.s3_standin import S3StandIn, create_object
+    from toil_scripts.lib.urls import download_url
+    work_dir = str(tmpdir)
+    src = create_object(os.path.join(work_dir, 'store'), 'bucket', 'object', 1024 * 1024 + 1)
+    # Segmented download from a server that supports byte ranges
+    with S3StandIn(os.path.join(work_dir, 'store')) as endpoint:
+        dst = download_url(endpoint + '/bucket/object', work_dir=work_dir, name='segmented',
+                           part_size=100 * 1024, num_cores=4)
+    assert filecmp.cmp(src, dst, shallow=False)
+    # Single stream from a server that does not
+    monkeypatch.chdir(os.path.join(work_dir, 'store'))
+    server = HTTPServer(('127.0.0.1', 0), SimpleHTTPRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        dst = download_url('http://127.0.0.1:{}/bucket/object'.format(server.server_address[1]), work_dir=work_dir,
+                           name='single', part_size=100 * 1024, num_cores=4)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert filecmp.cmp(src, dst, shallow=False)
+
+
+@contextmanager
+def _http_server(directory, refuse_head=False):
+    """
+    Serves a directory over HTTP in a thread, optionally refusing HEAD requests as presigned URLs do
+
+    :return: URL of the directory
+    """
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return os.path.join(directory, path.lstrip('/'))
+
+        def do_HEAD(self):
+            if refuse_head:
+                self.send_error(403)
+            else:
+                SimpleHTTPRequestHandler.do_HEAD(self)
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_url_size(tmpdir):
+    from toil_scripts.lib.urls import url_size
+    work_dir = str(tmpdir)
+    with open(os.path.join(work_dir, 'object'), 'wb') as f:
+        f.write(os.urandom(1000))
+    assert url_size('file://' + os.path.join(work_dir, 'object')) == 1000
+    with _http_server(work_dir) as url:
+        assert url_size(url + '/object') == 1000
+    # Sizes are best-effort, a server that refuses HEAD requests gives an unknown size rather than an error
+    with _http_server(work_dir, refuse_head=True) as url:
+        assert url_size(url + '/object') is None
+    assert url_size('file://' + os.path.join(work_dir, 'missing')) is None
+
+
+def test_download_http_url_without_head(tmpdir, monkeypatch):
+    from toil_scripts.lib import urls
+    work_dir = str(tmpdir)
+    src = os.path.join(work_dir, 'object')
+    with open(src, 'wb') as f:
+        f.write(os.urandom(1024 * 1024 + 1))
+    # A server that refuses HEAD requests is downloaded from as a single stream
+    with _http_server(work_dir, refuse_head=True) as url:
+        dst = urls.download_url(url + '/object', work_dir=work_dir, name='downloaded', part_size=100 * 1024,
+                                num_cores=4)
+    assert filecmp.cmp(src, dst, shallow=False)
+    # A single stream cut short is fetched again rather than kept
+    truncated = _truncate_first_response(monkeypatch)
+    monkeypatch.setattr(urls.time, 'sleep', lambda seconds: None)
+    with _http_server(work_dir, refuse_head=True) as url:
+        dst = urls.download_url(url + '/object', work_dir=work_dir, name='retried', part_size=100 * 1024,
+                                num_cores=4)
+    assert truncated
+    assert filecmp.cmp(src, dst, shallow=False)
+
+
+def test_download_and_extract_url(tmpdir):
+    from toil_scripts.lib.urls import download_and_extract_url
+    work_dir = str(tmpdir)
+    fpath = os.path.join(work_dir, 'genome')
+    with open(fpath, 'w') as f:
+        f.write('ACGT')
+    tar_path = os.path.join(work_dir, 'index.tar.gz')
+    with tarfile.open(tar_path, 'w:gz') as f_out:
+        f_out.add(fpath, arcname='index/genome')
+    os.mkdir(os.path.join(work_dir, 'out'))
+    download_and_extract_url('file://' + tar_path, work_dir=os.path.join(work_dir, 'out'))
+    assert os.listdir(os.path.join(work_dir, 'out')) == ['index']
+    assert open(os.path.join(work_dir, 'out', 'index', 'genome')).read() == 'ACGT'
+
+
+def test_s3am_upload_resume(tmpdir, monkeypatch):
+    from toil_scripts.benchmarks.s3_standin import S3StandIn
+    from toil_scripts.lib import urls
+    work_dir = str(tmpdir)
+    os.makedirs(os.path.join(work_dir, 'store', 'bucket'))
+    fpath = os.path.join(work_dir, 'upload_file')
+    with open(fpath, 'wb') as fout:
+        fout.write(os.urandom(250 * 1024))
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'standin')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'standin')
+    # Fail the first attempt at the third part
+    from boto.s3.multipart import MultiPartUpload
+    upload_part_from_file = MultiPartUpload.upload_part_from_file
+    uploaded = []
+
+    def flaky_upload_part_from_file(self, fp, part_num, **kwargs):
+        if part_num == 3 and 3 not in uploaded:
+            uploaded.append(3)
+            raise IOError('Connection reset')
+        uploaded.append(part_num)
+        return upload_part_from_file(self, fp, part_num, **kwargs)
+
+    monkeypatch.setattr(MultiPartUpload, 'upload_part_from_file', flaky_upload_part_from_file)
+    with S3StandIn(os.path.join(work_dir, 'store')) as endpoint:
+        monkeypatch.setenv('TOIL_SCRIPTS_S3_ENDPOINT', endpoint)
+        # Leave behind an unfinished upload to the same key that is not ours
+        bucket = urls._s3_connection().get_bucket('bucket', validate=False)
+        foreign = bucket.initiate_multipart_upload('dir/upload_file')
+        with open(fpath, 'rb') as f:
+            upload_part_from_file(foreign, f, 1, size=100 * 1024)
+        urls.s3am_upload(fpath, 's3://bucket/dir', num_cores=1, part_size=100 * 1024)
+        # The retry resumed the upload named by the sidecar, not uploading its first two parts again, and the
+        # foreign upload was aborted rather than resumed
+        assert sorted(uploaded) == [1, 2, 3, 3]
+        assert list(bucket.list_multipart_uploads()) == []
+    assert filecmp.cmp(fpath, os.path.join(work_dir, 'store', 'bucket', 'dir', 'upload_file'), shallow=False)
+    assert not os.path.exists(urls._upload_state_path(fpath, 's3://bucket/dir/upload_file'))
+
+
+def test_sse_c_key_url():
+    from toil_scripts.lib.urls import _s3_https_url, _sse_c_key_url
+
+    class Bucket(object):
+        def __init__(self, location):
+            self.name, self.location = 'bucket', location
+
+        def get_location(self):
+            return self.location
+
+    # The uploader and the downloader derive the key from the same URL, whichever endpoint the object is read from
+    for location, urls in [('', ['https://s3.amazonaws.com/bucket/dir/key',
+                                 'https://s3-external-1.amazonaws.com/bucket/dir/key',
+                                 'https://s3.us-east-1.amazonaws.com/bucket/dir/key',
+                                 'https://bucket.s3.amazonaws.com/dir/key']),
+                           ('EU', ['https://s3-eu-west-1.amazonaws.com/bucket/dir/key',
+                                   'https://s3.eu-west-1.amazonaws.com/bucket/dir/key']),
+                           ('us-west-2', ['https://s3-us-west-2.amazonaws.com/bucket/dir/key',
+                                          'https://s3.us-west-2.amazonaws.com/bucket/dir/key',
+                                          'https://s3.dualstack.us-west-2.amazonaws.com/bucket/dir/key',
+                                          'https://bucket.s3.us-west-2.amazonaws.com/dir/key'])]:
+        uploaded = _s3_https_url(Bucket(location), 'dir/key')
+        assert uploaded == urls[0]
+        for url in urls:
+            assert _sse_c_key_url(url) == uploaded
+    # Other hosts are left alone
+    assert _sse_c_key_url('http://localhost:8000/bucket/key') == 'http://localhost:8000/bucket/key'
+
+
+def test_open_s3_upload(tmpdir, monkeypatch):
+    from toil_scripts.benchmarks.s3_standin import S3StandIn
+    from toil_scripts.lib.urls import open_s3_upload, _s3_connection
+    work_dir = str(tmpdir)
+    os.makedirs(os.path.join(work_dir, 'store', 'bucket'))
+    data = os.urandom(250 * 1024)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'standin')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'standin')
+    with S3StandIn(os.path.join(work_dir, 'store')) as endpoint:
+        monkeypatch.setenv('TOIL_SCRIPTS_S3_ENDPOINT', endpoint)
+        # Uploaded in parts while being written
+        upload = open_s3_upload('s3://bucket/dir/parts', num_cores=2, part_size=100 * 1024)
+        for i in xrange(0, len(data), 10 * 1024):
+            upload.write(data[i:i + 10 * 1024])
+        upload.close()
+        # Smaller than a part
+        upload = open_s3_upload('s3://bucket/dir/single', part_size=100 * 1024)
+        upload.write(data[:1000])
+        upload.close()
+        # An aborted upload leaves nothing behind
+        upload = open_s3_upload('s3://bucket/dir/aborted', part_size=100 * 1024)
+        upload.write(data)
+        upload.abort()
+        bucket = _s3_connection().get_bucket('bucket', validate=False)
+        assert list(bucket.list_multipart_uploads()) == []
+    assert open(os.path.join(work_dir, 'store', 'bucket', 'dir', 'parts'), 'rb').read() == data
+    assert open(os.path.join(work_dir, 'store', 'bucket', 'dir', 'single'), 'rb').read() == data[:1000]
+    assert not os.path.exists(os.path.join(work_dir, 'store', 'bucket', 'dir', 'aborted'))
@@ -1,14 +1,33 @@
 import base64
+import ftplib
 import glob
 import hashlib
+import httplib
+import json
+import math
 import os
+import re
 import subprocess
+import threading
+import time
+import urllib2
+from cStringIO import StringIO
+from collections import deque
+from contextlib import closing, contextmanager
+from multiprocessing.pool import ThreadPool
+from urllib import unquote
 from urlparse import urlparse
 import shutil
+
+from bd2k.util.exceptions import panic
+from bd2k.util.files import mkdir_p
+
+from toil_scripts.lib.cache import node_cache, _write_json
 from toil_scripts.lib.programs import docker_call
 
 
-def download_url(url, work_dir='.', name=None, s3_key_path=None, cghub_key_path=None):
+def download_url(url, work_dir='.', name=None, s3_key_path=None, cghub_key_path=None,
+                 part_size=50 * 1024 * 1024, num_cores=4, cached=False):
     """
     Downloads URL, can pass in file://, http://, s3://, or ftp://, gnos://cghub/analysisID, or gnos:///analysisID
 
@@ -17,50 +36,124 @@ def download_url(url, work_dir='.', name=None, s3_key_path=None, cghub_key_path=
     :param str name: Name of output file, if None, basename of URL is used
     :param str s3_key_path: Path to 32-byte encryption key if url points to S3 file that uses SSE-C
     :param str cghub_key_path: Path to cghub key used to download from CGHub.
+    :param int part_size: Size in bytes of each byte range when downloading in parts
+    :param int num_cores: Number of byte ranges to download concurrently
+    :param bool cached: If True, and a node-local cache is configured (see `toil_scripts.lib.cache.node_cache`),
+                        the file is downloaded once per node and copied (read-only) into work_dir. See
+                        `mounted_url` to use the cached file in place.
     :return: Path to the downloaded file
     :rtype: str
     """
     file_path = os.path.join(work_dir, name) if name else os.path.join(work_dir, os.path.basename(url))
+    cache = node_cache() if cached else None
+    if cache:
+        return cache.get(url, file_path, lambda path: download_url(
+            url, work_dir=os.path.dirname(path), name=os.path.basename(path), s3_key_path=s3_key_path,
+            cghub_key_path=cghub_key_path, part_size=part_size, num_cores=num_cores))
     if s3_key_path:
-        _download_encrypted_file(url, file_path, s3_key_path)
+        _download_encrypted_file(url, file_path, s3_key_path, part_size=part_size, num_cores=num_cores)
     elif cghub_key_path:
         _download_from_genetorrent(url, file_path, cghub_key_path)
     elif urlparse(url).scheme == 's3':
-        _download_s3_url(file_path, url)
+        _download_s3_url(file_path, url, part_size=part_size, num_cores=num_cores)
     elif urlparse(url).scheme == 'file':
         shutil.copy(urlparse(url).path, file_path)
     else:
-        subprocess.check_call(['curl', '-fs', '--retry', '5', '--create-dir', url, '-o', file_path])
+        _download_http_url(file_path, url, part_size=part_size, num_cores=num_cores)
     assert os.path.exists(file_path)
     return file_path
 
 
-def download_url_job(job, url, name=None, s3_key_path=None, cghub_key_path=None):
-    """Job version of `download_url`"""
+def download_and_extract_url(url, work_dir='.', s3_key_path=None, cached=False):
+    """
+    Downloads a tarball and extracts its contents into work_dir. The tarball itself is not kept.
+
+    :param str url: URL of the tarball
+    :param str work_dir: Directory to extract the contents of the tarball into
+    :param str s3_key_path: Path to 32-byte encryption key if url points to S3 file that uses SSE-C
+    :param bool cached: If True, and a node-local cache is configured (see `toil_scripts.lib.cache.node_cache`),
+                        the tarball is downloaded and extracted once per node and its contents are copied
+                        (read-only) into work_dir. See `mounted_url` to use the cached contents in place.
+    :return: Path to work_dir
+    :rtype: str
+    """
+    cache = node_cache() if cached else None
+    if cache:
+        return cache.get_extracted(url, work_dir, lambda tar_path: download_url(
+            url, work_dir=os.path.dirname(tar_path), name=os.path.basename(tar_path), s3_key_path=s3_key_path))
+    tar_path = download_url(url, work_dir=work_dir, s3_key_path=s3_key_path)
+    subprocess.check_call(['tar', '-xf', tar_path, '-C', work_dir])
+    os.remove(tar_path)
+    return work_dir
+
+
+@contextmanager
+def mounted_url(url, work_dir, name, s3_key_path=None, extract=False):
+    """
+    Makes the content of a URL, or the extracted contents of a tarball URL, available to tool calls at /data/NAME for
+    the duration of the context.
+
+    If a node-local cache is configured (see `toil_scripts.lib.cache.node_cache`), the URL is downloaded (and
+    extracted) once per node and used in place: it is pinned in the cache, and yielded as a mount to pass to
+    `docker_call`, so that the jobs on a node share a single copy. Otherwise it is downloaded to work_dir/NAME, or
+    extracted into that directory, and there are no mounts.
+
+    :param str url: URL to download from
+    :param str work_dir: Work directory of the tool calls
+    :param str name: Name of the file, or of the directory of the extracted contents, below /data
+    :param str s3_key_path: Path to 32-byte encryption key if url points to S3 file that uses SSE-C
+    :param bool extract: If True, url is a tarball whose contents are made available rather than the tarball
+    :return: Path of the file or directory on the host, and the mounts to pass to `docker_call`
+    :rtype: tuple(str, dict[str,str])
+    """
+    cache = node_cache()
+    if not cache:
+        if extract:
+            mkdir_p(os.path.join(work_dir, name))
+            yield download_and_extract_url(url, work_dir=os.path.join(work_dir, name), s3_key_path=s3_key_path), {}
+        else:
+            yield download_url(url, work_dir=work_dir, name=name, s3_key_path=s3_key_path), {}
+        return
+    pinned = cache.pinned_extracted if extract else cache.pinned
+    with pinned(url, lambda path: download_url(
+            url, work_dir=os.path.dirname(path), name=os.path.basename(path), s3_key_path=s3_key_path)) as path:
+        yield path, {os.path.join('/data', name): path}
+
+
+def download_url_job(job, url, name=None, s3_key_path=None, cghub_key_path=None,
+                     part_size=50 * 1024 * 1024, num_cores=4, stream=False):
+    """
+    Job version of `download_url`
+
+    If stream is True, file://, http(s)://, ftp:// and s3:// URLs are piped straight into the file store instead of
+    being written to local disk first, so the job needs no disk for the download. HTTP and FTP streams are checked
+    against the size the server reports, and resume where they stopped if the connection drops. The MD5 of the
+    content is computed on the way through, logged, and checked against the ETag of S3 objects that were not uploaded
+    in parts.
+    """
+    if stream and not cghub_key_path and urlparse(url).scheme in ('file', 'http', 'https', 'ftp', 's3'):
+        return _stream_url_to_file_store(job, url, s3_key_path=s3_key_path)
     work_dir = job.fileStore.getLocalTempDir()
-    fpath = download_url(url, work_dir=work_dir, name=name,
-                         s3_key_path=s3_key_path, cghub_key_path=cghub_key_path)
+    fpath = download_url(url, work_dir=work_dir, name=name, s3_key_path=s3_key_path, cghub_key_path=cghub_key_path,
+                         part_size=part_size, num_cores=num_cores)
     return job.fileStore.writeGlobalFile(fpath)
 
 
-def s3am_upload(fpath, s3_dir, num_cores=1, s3_key_path=None):
+def s3am_upload(fpath, s3_dir, num_cores=1, s3_key_path=None, part_size=50 * 1024 * 1024):
     """
-    Uploads a file to s3 via S3AM
+    Uploads a file to s3 as a resumable multipart upload. Uploads are compatible with S3AM, which this replaces.
     For SSE-C encryption: provide a path to a 32-byte file
 
     :param str fpath: Path to file to upload
     :param str s3_dir: Ouptut S3 path. Format: s3://bucket/[directory]
-    :param int num_cores: Number of cores to use for up/download with S3AM
+    :param int num_cores: Number of parts to upload concurrently
     :param str s3_key_path: (OPTIONAL) Path to 32-byte key to be used for SSE-C encryption
+    :param int part_size: Size in bytes of each part
     """
     if not s3_dir.startswith('s3://'):
         raise ValueError('Format of s3_dir (s3://) is incorrect: {}'.format(s3_dir))
-    s3_dir = os.path.join(s3_dir, os.path.basename(fpath))
-    if s3_key_path:
-        _s3am_with_retry(num_cores, '--sse-key-is-master', '--sse-key-file', s3_key_path,
-                         'file://{}'.format(fpath), s3_dir)
-    else:
-        _s3am_with_retry(num_cores, 'file://{}'.format(fpath), s3_dir)
+    s3_url = os.path.join(s3_dir, os.path.basename(fpath))
+    _upload_with_retry(fpath, s3_url, num_cores=num_cores, part_size=part_size, s3_key_path=s3_key_path)
 
 
 def s3am_upload_job(job, file_id, file_name, s3_dir, num_cores, s3_key_path=None):
@@ -70,52 +163,515 @@ def s3am_upload_job(job, file_id, file_name, s3_dir, num_cores, s3_key_path=None
     s3am_upload(fpath=fpath, s3_dir=s3_dir, num_cores=num_cores, s3_key_path=s3_key_path)
 
 
-def _download_s3_url(file_path, url, ceph=None):
+def open_s3_upload(url, num_cores=1, s3_key_path=None, part_size=50 * 1024 * 1024):
+    """
+    Opens an S3 object for writing. Data written to it is uploaded in parts while it is being written, num_cores
+    parts at a time. Since the size is not known in advance, at most 10,000 parts (500 GB with the default part size)
+    can be written. Outputs smaller than one part are uploaded with a single PUT.
+
+        upload = open_s3_upload('s3://bucket/dir/file')
+        try:
+            upload.write(data)
+        except Exception:
+            upload.abort()
+            raise
+        upload.close()
+
+    :param str url: S3 URL of the object to upload to
+    :param int num_cores: Number of parts to upload concurrently
+    :param str s3_key_path: (OPTIONAL) Path to 32-byte master key to be used for SSE-C encryption
+    :param int part_size: Size in bytes of each part
+    :return: Write-only file object. close() completes the upload, abort() cancels it.
+    :rtype: _MultipartUploadStream
+    """
+    if not url.startswith('s3://'):
+        raise ValueError('Format of url (s3://) is incorrect: {}'.format(url))
+    return _MultipartUploadStream(url, num_cores=num_cores, s3_key_path=s3_key_path, part_size=part_size)
+
+
+def url_size(url, s3_key_path=None):
+    """
+    Size of the file at a file://, http(s)://, ftp:// or s3:// URL, without downloading it
+
+    The lookup is best-effort, as sizes only guide scheduling: servers that refuse the lookup, e.g. presigned URLs
+    that only allow GET, or that fail, give None rather than an error.
+
+    :param str url: URL
+    :param str s3_key_path: Path to 32-byte encryption key if url points to S3 file that uses SSE-C
+    :return: Size in bytes, or None if it cannot be determined (e.g. for GNOS URLs)
+    :rtype: int
+    """
+    from boto.exception import BotoClientError, BotoServerError
+    try:
+        return _url_size(url, s3_key_path)
+    except (IOError, OSError, EOFError, httplib.HTTPException, ftplib.Error, BotoClientError, BotoServerError):
+        return None
+
+
+def _url_size(url, s3_key_path):
+    parsed_url = urlparse(url)
+    if parsed_url.scheme == 'file':
+        return os.path.getsize(parsed_url.path)
+    elif parsed_url.scheme == 's3' and not s3_key_path:
+        bucket_name, key_name = _parse_s3_url(url)
+        with closing(_s3_connection()) as s3:
+            key = s3.get_bucket(bucket_name, validate=False).get_key(key_name)
+            return key.size if key is not None else None
+    elif parsed_url.scheme in ('http', 'https'):
+        headers = _sse_c_headers(s3_key_path, url) if s3_key_path else {}
+        return _http_content_length(url, headers, require_ranges=False)
+    elif parsed_url.scheme == 'ftp':
+        return _ftp_size(url)
+    return None
+
+
+def _stream_url_to_file_store(job, url, s3_key_path=None):
+    """
+    Streams a URL into the file store, computing its MD5 on the way through
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str url: URL to download from
+    :param str s3_key_path: Path to 32-byte encryption key if url points to S3 file that uses SSE-C
+    :return: FileStoreID of the file
+    :rtype: str
+    """
+    md5 = hashlib.md5()
+    file_id = None
+    try:
+        with _open_url(url, s3_key_path=s3_key_path) as f_in:
+            with job.fileStore.writeGlobalFileStream() as (f_out, file_id):
+                for block in iter(lambda: f_in.read(1024 * 1024), ''):
+                    md5.update(block)
+                    f_out.write(block)
+            etag = getattr(f_in, 'etag', None)
+            encryption = getattr(f_in, 'encrypted', None)
+        etag = etag.strip('"') if etag else None
+        # ETags of objects uploaded in parts are not the MD5 of the content, and contain a dash. Nor are ETags of
+        # objects encrypted with KMS or customer keys, only those of unencrypted and SSE-S3 (AES256) objects are.
+        if etag and '-' not in etag and encryption in (None, 'AES256') and etag != md5.hexdigest():
+            raise IOError('MD5 of {} ({}) does not match its ETag ({})'.format(url, md5.hexdigest(), etag))
+    except:
+        # The file store has the file as soon as it is opened, so a failed attempt would leave it behind
+        with panic():
+            if file_id is not None:
+                job.fileStore.deleteGlobalFile(file_id)
+    job.fileStore.logToMaster('Streamed {} into the file store. MD5: {}'.format(url, md5.hexdigest()))
+    return file_id
+
+
+@contextmanager
+def _open_url(url, s3_key_path=None):
     """
-    Downloads from S3 URL via Boto
+    Opens a file://, http(s)://, ftp:// or s3:// URL as a readable stream
+
+    :param str url: URL to open
+    :param str s3_key_path: Path to 32-byte encryption key if url points to S3 file that uses SSE-C
+    """
+    parsed_url = urlparse(url)
+    if parsed_url.scheme == 'file':
+        with open(parsed_url.path, 'rb') as f:
+            yield f
+    elif parsed_url.scheme == 's3' and not s3_key_path:
+        bucket_name, key_name = _parse_s3_url(url)
+        with closing(_s3_connection()) as s3:
+            key = s3.get_bucket(bucket_name, validate=False).get_key(key_name)
+            if key is None:
+                raise ValueError('S3 object does not exist: {}'.format(url))
+            with closing(key):
+                yield key
+    else:
+        headers = _sse_c_headers(s3_key_path, url) if s3_key_path else {}
+        with closing(_ResumableStream(url, headers)) as f:
+            yield f
+
+
+class _ResumableStream(object):
+    """
+    Readable stream of an http(s):// or ftp:// URL. If the connection drops, or closes before the size the server
+    reported, the stream is reopened at the first byte not yet read, as a byte range (HTTP) or a transfer offset
+    (FTP). Streams of HTTP servers that do not report a size can only be checked if they use chunked encoding.
+    """
+
+    def __init__(self, url, headers, retries=5):
+        """
+        :param str url: URL to read
+        :param dict headers: Headers to send with every HTTP request
+        :param int retries: Number of times the stream is reopened for a single read
+        """
+        self.url = url
+        self.headers = headers
+        self.retries = retries
+        self.position = 0
+        self.size = None
+        self._response = None
+        self._ftp = None
+        self._done = False
+
+    def read(self, size):
+        if self._done:
+            return ''
+        for attempt in _retries(self.retries):
+            with attempt:
+                try:
+                    if self._response is None:
+                        self._open()
+                    data = self._response.read(size) if self._ftp is None else self._response.recv(size)
+                    if not data:
+                        self._finish()
+                    self.position += len(data)
+                    return data
+                except Exception:
+                    self.close()
+                    raise
+
+    def close(self):
+        for connection in [self._response, self._ftp]:
+            if connection is not None:
+                connection.close()
+        self._response = self._ftp = None
+
+    def _open(self):
+        parsed_url = urlparse(self.url)
+        if parsed_url.scheme == 'ftp':
+            path = unquote(parsed_url.path)
+            self._ftp = _ftp_connection(self.url)
+            self._ftp.voidcmd('TYPE I')
+            if not self.position:
+                try:
+                    self.size = self._ftp.size(path)
+                except ftplib.error_perm:
+                    self.size = None
+            self._response = self._ftp.transfercmd('RETR ' + path, rest=self.position or None)
+            return
+        headers = dict(self.headers)
+        if self.position:
+            headers['Range'] = 'bytes={}-'.format(self.position)
+        self._response = urllib2.urlopen(urllib2.Request(self.url, headers=headers))
+        if self.position and self._response.getcode() != 206:
+            raise ValueError('Server does not support byte ranges, cannot resume {}'.format(self.url))
+        if not self.position:
+            size = self._response.info().getheader('Content-Length')
+            self.size = int(size) if size is not None else None
+
+    def _finish(self):
+        if self._ftp is not None:
+            # The server confirms that the transfer is complete, or reports why it is not
+            self._response.close()
+            self._response = None
+            self._ftp.voidresp()
+        if self.size is not None and self.position < self.size:
+            raise IOError('Connection closed after {} of {} bytes of {}'.format(self.position, self.size, self.url))
+        self.close()
+        self._done = True
+
+
+def _download_s3_url(file_path, url, part_size=50 * 1024 * 1024, num_cores=4):
+    """
+    Downloads from S3 URL via Boto. Objects larger than one part are fetched as concurrent byte ranges.
 
     :param str file_path: Path to file
     :param str url: S3 URL
+    :param int part_size: Size in bytes of each byte range
+    :param int num_cores: Number of byte ranges to download concurrently
+    """
+    bucket_name, key_name = _parse_s3_url(url)
+    with closing(_s3_connection()) as s3:
+        key = s3.get_bucket(bucket_name, validate=False).get_key(key_name)
+        if key is None:
+            raise ValueError('S3 object does not exist: {}'.format(url))
+        if num_cores == 1 or key.size <= part_size:
+            key.get_contents_to_filename(file_path)
+            return
+        size = key.size
+
+    def fetch_range(start, end, f):
+        # Each part uses its own connection, Boto connections are not shared across threads
+        with closing(_s3_connection()) as s3:
+            part = s3.get_bucket(bucket_name, validate=False).get_key(key_name, validate=False)
+            part.get_contents_to_file(f, headers={'Range': 'bytes={}-{}'.format(start, end)})
+
+    _download_ranges(file_path, size, fetch_range, part_size=part_size, num_cores=num_cores)
+
+
+def _download_ranges(file_path, size, fetch_range, part_size, num_cores):
+    """
+    Downloads a file of known size as concurrent byte ranges, each written in place at its offset
+
+    :param str file_path: Output path to file
+    :param int size: Size of the file in bytes
+    :param function fetch_range: Called as fetch_range(start, end, f) to write bytes start through end (inclusive)
+                                 to the file handle f, which is positioned at start
+    :param int part_size: Size in bytes of each byte range
+    :param int num_cores: Number of byte ranges to download concurrently
     """
-    from boto.s3.connection import S3Connection
-    s3 = S3Connection()
+    # Preallocate the file so parts can be written at their offset as soon as they arrive
+    with open(file_path, 'wb') as f:
+        f.truncate(size)
+    ranges = [(start, min(start + part_size, size) - 1) for start in xrange(0, size, part_size)]
+
+    def download_part(byte_range):
+        start, end = byte_range
+        with open(file_path, 'r+b') as f:
+            f.seek(start)
+            fetch_range(start, end, f)
+            if f.tell() != end + 1:
+                raise IOError('Incomplete download of bytes {}-{} for {}'.format(start, end, file_path))
+
+    pool = ThreadPool(max(1, min(num_cores, len(ranges))))
     try:
-        parsed_url = urlparse(url)
-        if not parsed_url.netloc or not parsed_url.path.startswith('/'):
-            raise ValueError("An S3 URL must be of the form s3:/BUCKET/ or "
-                             "s3://BUCKET/KEY. '%s' is not." % url)
-        bucket = s3.get_bucket(parsed_url.netloc)
-        key = bucket.get_key(parsed_url.path[1:])
-        key.get_contents_to_filename(file_path)
+        pool.map(download_part, ranges)
     finally:
-        s3.close()
+        pool.close()
+        pool.join()
+
+
+def _parse_s3_url(url):
+    """
+    :param str url: S3 URL
+    :return: Bucket name and key name
+    :rtype: tuple(str, str)
+    """
+    parsed_url = urlparse(url)
+    if not parsed_url.netloc or not parsed_url.path.startswith('/'):
+        raise ValueError("An S3 URL must be of the form s3:/BUCKET/ or "
+                         "s3://BUCKET/KEY. '%s' is not." % url)
+    return parsed_url.netloc, parsed_url.path[1:]
+
+
+def _s3_connection():
+    """
+    Opens a Boto S3 connection. If the TOIL_SCRIPTS_S3_ENDPOINT environment variable is set
+    (e.g. http://localhost:9000), connects to that S3-compatible endpoint instead of AWS.
+
+    :return: S3 connection
+    :rtype: boto.s3.connection.S3Connection
+    """
+    from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+    endpoint = os.environ.get('TOIL_SCRIPTS_S3_ENDPOINT')
+    if endpoint:
+        endpoint = urlparse(endpoint)
+        return S3Connection(host=endpoint.hostname, port=endpoint.port, is_secure=endpoint.scheme == 'https',
+                            calling_format=OrdinaryCallingFormat())
+    return S3Connection()
 
 
-def _download_encrypted_file(url, file_path, key_path):
+def _download_encrypted_file(url, file_path, key_path, part_size=50 * 1024 * 1024, num_cores=4):
     """
-    Downloads encrypted files from S3
+    Downloads encrypted files from S3. Every request carries the SSE-C headers of the key derived for the URL.
 
     :param str url: URL to be downloaded
     :param str file_path: Output path to file
     :param str key_path: Path to the 32-byte key file
+    :param int part_size: Size in bytes of each byte range
+    :param int num_cores: Number of byte ranges to download concurrently
+    """
+    _download_http_url(file_path, url, headers=_sse_c_headers(key_path, url), part_size=part_size,
+                       num_cores=num_cores)
+
+
+def _download_http_url(file_path, url, headers=None, part_size=50 * 1024 * 1024, num_cores=4):
+    """
+    Downloads an http(s):// or ftp:// URL. If the server reports the size of the file and supports byte ranges,
+    files larger than one part are fetched as concurrent byte ranges, and dropped connections resume where they
+    stopped. Otherwise, or if the HEAD request for the size fails, the file is fetched as a single stream, which
+    restarts if the connection drops.
+
+    :param str file_path: Output path to file
+    :param str url: URL to be downloaded
+    :param dict headers: Headers to send with every HTTP request
+    :param int part_size: Size in bytes of each byte range
+    :param int num_cores: Number of byte ranges to download concurrently
     """
-    # Grab master key
-    with open(key_path, 'r') as f:
-        key = f.read()
-    if len(key) != 32:
-        raise ValueError('Bad key in {}. Must be 32 bytes'.format(key_path))
-
-    key = _generate_unique_key(key_path, url)
-    # Create necessary headers for SSE-C encryption and download
-    encoded_key = base64.b64encode(key)
-    encoded_key_md5 = base64.b64encode(hashlib.md5(key).digest())
-    h1 = 'x-amz-server-side-encryption-customer-algorithm:AES256'
-    h2 = 'x-amz-server-side-encryption-customer-key:{}'.format(encoded_key)
-    h3 = 'x-amz-server-side-encryption-customer-key-md5:{}'.format(encoded_key_md5)
-    subprocess.check_call(['curl', '-fs', '--retry', '5', '-H', h1, '-H', h2, '-H', h3, url, '-o', file_path])
+    mkdir_p(os.path.dirname(os.path.abspath(file_path)))
+    if not urlparse(url).scheme:
+        # As with curl, URLs without a scheme are fetched over HTTP
+        url = 'http://' + url
+    if urlparse(url).scheme == 'ftp':
+        # FTP servers resume transfers at an offset (REST), which serves as a byte range
+        size = _ftp_size(url)
+        fetch_range = _fetch_ftp_range
+    else:
+        try:
+            size = _http_content_length(url, headers or {})
+        except (IOError, httplib.HTTPException) as e:
+            # Some servers refuse HEAD requests, e.g. presigned URLs that only allow GET
+            print 'Downloading as a single stream after HEAD request failed: {}'.format(e)
+            size = None
+        fetch_range = lambda url, start, end, f: _fetch_http_range(url, headers or {}, start, end, f)
+    if size is None:
+        with open(file_path, 'wb') as f:
+            fetch_range(url, 0, None, f)
+    elif num_cores == 1 or size <= part_size:
+        with open(file_path, 'wb') as f:
+            if size:
+                fetch_range(url, 0, size - 1, f)
+    else:
+        _download_ranges(file_path, size, lambda start, end, f: fetch_range(url, start, end, f),
+                         part_size=part_size, num_cores=num_cores)
     assert os.path.exists(file_path)
 
 
+def _http_content_length(url, headers, retries=5, require_ranges=True):
+    """
+    Size of a URL, as reported by a HEAD request
+
+    :param str url: URL
+    :param dict headers: Headers to send with the request
+    :param int retries: Number of retries on connection errors and server errors
+    :param bool require_ranges: If True, the size is only returned if the server supports byte ranges
+    :return: Size in bytes, or None if the server does not report it (or does not support byte ranges)
+    :rtype: int
+    """
+    request = urllib2.Request(url, headers=headers)
+    request.get_method = lambda: 'HEAD'
+    for attempt in _retries(retries):
+        with attempt:
+            with closing(urllib2.urlopen(request)) as response:
+                size = response.info().getheader('Content-Length')
+                accept_ranges = response.info().getheader('Accept-Ranges', 'none')
+            if size is None or (require_ranges and accept_ranges != 'bytes'):
+                return None
+            return int(size)
+
+
+def _fetch_http_range(url, headers, start, end, f, retries=5):
+    """
+    Writes bytes start through end (inclusive) of a URL to the file handle f, which is positioned at start.
+    If the connection drops, the request is retried for the bytes not yet written.
+
+    :param str url: URL
+    :param dict headers: Headers to send with every request
+    :param int start: First byte
+    :param int end: Last byte, or None to fetch the whole URL in a single request without a Range header
+    :param file f: File handle to write to
+    :param int retries: Number of retries on connection errors and server errors
+    """
+    offset = f.tell()
+    for attempt in _retries(retries):
+        with attempt:
+            request_headers = dict(headers)
+            if end is not None:
+                request_headers['Range'] = 'bytes={}-{}'.format(start + f.tell() - offset, end)
+            elif f.tell() != offset:
+                # Without a byte range the download restarts from the beginning
+                f.seek(offset)
+                f.truncate()
+            with closing(urllib2.urlopen(urllib2.Request(url, headers=request_headers))) as response:
+                if end is not None and response.getcode() != 206:
+                    raise ValueError('Server does not support byte ranges: {}'.format(url))
+                size = end - start + 1 if end is not None else response.info().getheader('Content-Length')
+                shutil.copyfileobj(response, f, 1024 * 1024)
+            # Reads do not fail when the connection closes early, only the number of bytes tells
+            if size is not None and f.tell() - offset != int(size):
+                raise IOError('Connection closed after {} of {} bytes of {}'.format(f.tell() - offset, size, url))
+            return
+
+
+def _ftp_size(url):
+    """
+    Size of an ftp:// URL, as reported by the SIZE command
+
+    :param str url: URL
+    :return: Size in bytes, or None if the server does not report it
+    :rtype: int
+    """
+    with closing(_ftp_connection(url)) as ftp:
+        try:
+            return ftp.size(unquote(urlparse(url).path))
+        except ftplib.error_perm:
+            return None
+
+
+def _fetch_ftp_range(url, start, end, f, retries=5):
+    """
+    FTP version of `_fetch_http_range`. Each attempt starts the transfer at the first byte not yet written.
+    """
+    path = unquote(urlparse(url).path)
+    offset = f.tell()
+    for attempt in _retries(retries):
+        with attempt:
+            if end is None and f.tell() != offset:
+                f.seek(offset)
+                f.truncate()
+            with closing(_ftp_connection(url)) as ftp:
+                ftp.voidcmd('TYPE I')
+                remaining = end - start + 1 - (f.tell() - offset) if end is not None else None
+                with closing(ftp.transfercmd('RETR ' + path, rest=start + f.tell() - offset or None)) as conn:
+                    while remaining is None or remaining:
+                        data = conn.recv(min(1024 * 1024, remaining or 1024 * 1024))
+                        if not data:
+                            break
+                        f.write(data)
+                        if remaining is not None:
+                            remaining -= len(data)
+                if remaining:
+                    raise IOError('Connection closed with {} bytes left of {}'.format(remaining, url))
+                if remaining is None:
+                    ftp.voidresp()
+            return
+
+
+def _ftp_connection(url):
+    """
+    :param str url: ftp:// URL, with optional user and password
+    :return: Logged in FTP connection
+    :rtype: ftplib.FTP
+    """
+    parsed_url = urlparse(url)
+    ftp = ftplib.FTP()
+    ftp.connect(parsed_url.hostname, parsed_url.port or ftplib.FTP_PORT)
+    ftp.login(unquote(parsed_url.username or 'anonymous'), unquote(parsed_url.password or ''))
+    return ftp
+
+
+def _retries(retries):
+    """
+    Yields context managers for successive attempts at an operation. An attempt that raises a connection error, a
+    5XX server error or a transient FTP error is retried after an exponential backoff, the last attempt's error is
+    raised.
+
+        for attempt in _retries(5):
+            with attempt:
+                ...
+                return
+
+    :param int retries: Number of retries after the first attempt
+    """
+    for i in xrange(retries + 1):
+        yield _attempt(i, last=i == retries)
+
+
+@contextmanager
+def _attempt(i, last):
+    try:
+        yield
+    except urllib2.HTTPError as e:
+        if last or e.code < 500:
+            raise
+        print 'Retrying after HTTP error: {}'.format(e)
+        time.sleep(min(2 ** i, 30))
+    except (IOError, EOFError, httplib.HTTPException, ftplib.error_temp, ftplib.error_reply) as e:
+        if last:
+            raise
+        print 'Retrying after error: {}'.format(e)
+        time.sleep(min(2 ** i, 30))
+
+
+def _sse_c_headers(key_path, url):
+    """
+    Creates the headers necessary to download a file from S3 that uses SSE-C encryption
+
+    :param str key_path: Path to the 32-byte master key file
+    :param str url: URL of the file, used to derive its unique key from the master key
+    :return: HTTP headers
+    :rtype: dict[str,str]
+    """
+    key = _generate_unique_key(key_path, _sse_c_key_url(url))
+    return {'x-amz-server-side-encryption-customer-algorithm': 'AES256',
+            'x-amz-server-side-encryption-customer-key': base64.b64encode(key),
+            'x-amz-server-side-encryption-customer-key-md5': base64.b64encode(hashlib.md5(key).digest())}
+
+
 def _download_from_genetorrent(url, file_path, cghub_key_path):
     url = urlparse(url)
     analysis_id = url.path[1:]
@@ -129,24 +685,297 @@ def _download_from_genetorrent(url, file_path, cghub_key_path):
     assert len(sample) == 1, 'More than one sample tar in CGHub download: {}'.format(analysis_id)
 
 
-def _s3am_with_retry(num_cores, *args):
+def _upload_with_retry(fpath, url, num_cores=1, part_size=50 * 1024 * 1024, s3_key_path=None):
     """
-    Calls S3AM upload with retries
+    Uploads a file to S3 with retries. A retry resumes the upload from the parts that were already committed.
 
-    :param int num_cores: Number of cores to pass to upload/download slots
-    :param list[str] args: Additional arguments to append to s3am
+    :param str fpath: Path to file to upload
+    :param str url: S3 URL of the object to upload to
+    :param int num_cores: Number of parts to upload concurrently
+    :param int part_size: Size in bytes of each part
+    :param str s3_key_path: (OPTIONAL) Path to 32-byte master key to be used for SSE-C encryption
     """
     retry_count = 3
     for i in xrange(retry_count):
-        s3am_command = ['s3am', 'upload', '--force', '--part-size=50M', '--exists=overwrite',
-                        '--upload-slots={}'.format(num_cores),
-                        '--download-slots={}'.format(num_cores)] + list(args)
-        ret_code = subprocess.call(s3am_command)
-        if ret_code == 0:
+        try:
+            _multipart_upload(fpath, url, num_cores=num_cores, part_size=part_size, s3_key_path=s3_key_path)
             return
-        else:
-            print 'S3AM failed with status code: {}'.format(ret_code)
-    raise RuntimeError('S3AM failed to upload after {} retries.'.format(retry_count))
+        except Exception as e:
+            print 'Upload to {} failed: {}'.format(url, e)
+    raise RuntimeError('Failed to upload {} after {} retries.'.format(url, retry_count))
+
+
+def _multipart_upload(fpath, url, num_cores=1, part_size=50 * 1024 * 1024, s3_key_path=None):
+    """
+    Uploads a file to S3 in parts, num_cores parts at a time. The upload is recorded in a sidecar file next to fpath,
+    along with the size and mtime of the file and the MD5 of every part uploaded. If the upload fails, the next attempt
+    resumes the upload named by the sidecar, provided the file and the encryption key are unchanged, and skips the
+    committed parts whose MD5 matches the record. Any other unfinished upload to the same URL is aborted.
+
+    :param str fpath: Path to file to upload
+    :param str url: S3 URL of the object to upload to
+    :param int num_cores: Number of parts to upload concurrently
+    :param int part_size: Size in bytes of each part
+    :param str s3_key_path: (OPTIONAL) Path to 32-byte master key to be used for SSE-C encryption
+    """
+    from boto.exception import S3ResponseError
+    from boto.s3.multipart import MultiPartUpload
+    bucket_name, key_name = _parse_s3_url(url)
+    stat = os.stat(fpath)
+    size = stat.st_size
+    # S3 allows at most 10,000 parts
+    part_size = max(part_size, int(math.ceil(size / 10000.0)))
+    with closing(_s3_connection()) as s3:
+        bucket = s3.get_bucket(bucket_name, validate=False)
+        headers = _sse_c_headers(s3_key_path, _s3_https_url(bucket, key_name)) if s3_key_path else {}
+        if size <= part_size:
+            bucket.new_key(key_name).set_contents_from_filename(fpath, headers=headers)
+            return
+        state_path = _upload_state_path(fpath, url)
+        state = {'url': url, 'size': size, 'mtime': stat.st_mtime, 'part_size': part_size,
+                 'key_md5': headers.get('x-amz-server-side-encryption-customer-key-md5'), 'parts': {}}
+        upload_id, committed = None, {}
+        previous = _read_upload_state(state_path)
+        if previous and all(previous.get(k) == v for k, v in state.iteritems() if k != 'parts'):
+            mp = MultiPartUpload(bucket)
+            mp.key_name, mp.id = key_name, previous['upload_id']
+            try:
+                committed = {part.part_number: part for part in mp}
+            except S3ResponseError as e:
+                # The upload was completed or aborted since
+                if e.status != 404:
+                    raise
+            else:
+                upload_id, state['parts'] = mp.id, previous['parts']
+        for upload in bucket.list_multipart_uploads():
+            if upload.key_name == key_name and upload.id != upload_id:
+                upload.cancel_upload()
+        if upload_id is None:
+            upload_id = bucket.initiate_multipart_upload(key_name, headers=headers).id
+        state['upload_id'] = upload_id
+        _write_json(state_path, state)
+    lock = threading.Lock()
+
+    def upload_part(part):
+        part_number, start, length = part
+        with open(fpath, 'rb') as f:
+            f.seek(start)
+            md5 = _md5(f, length)
+            f.seek(start)
+            previous = committed.get(part_number)
+            # ETags of SSE-C encrypted parts are not the MD5 of the content, so the recorded MD5 is what identifies them
+            if (previous and previous.size == length and state['parts'].get(str(part_number)) == md5 and
+                    (s3_key_path or previous.etag.strip('"') == md5)):
+                return
+            with closing(_s3_connection()) as s3:
+                mp = MultiPartUpload(s3.get_bucket(bucket_name, validate=False))
+                mp.key_name, mp.id = key_name, upload_id
+                mp.upload_part_from_file(f, part_number, headers=headers, size=length)
+        with lock:
+            state['parts'][str(part_number)] = md5
+            _write_json(state_path, state)
+
+    parts = [(i + 1, start, min(part_size, size - start)) for i, start in enumerate(xrange(0, size, part_size))]
+    pool = ThreadPool(max(1, min(num_cores, len(parts))))
+    try:
+        pool.map(upload_part, parts)
+    finally:
+        pool.close()
+        pool.join()
+    with closing(_s3_connection()) as s3:
+        mp = MultiPartUpload(s3.get_bucket(bucket_name, validate=False))
+        mp.key_name, mp.id = key_name, upload_id
+        mp.complete_upload()
+    os.remove(state_path)
+
+
+def _upload_state_path(fpath, url):
+    """
+    :param str fpath: Path to file being uploaded
+    :param str url: S3 URL the file is uploaded to
+    :return: Path of the sidecar file recording the multipart upload of fpath to url
+    :rtype: str
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(fpath)),
+                        '.{}.{}.upload'.format(os.path.basename(fpath), hashlib.sha1(url).hexdigest()[:16]))
+
+
+def _read_upload_state(path):
+    """
+    :param str path: Path of an upload sidecar file
+    :return: The recorded upload, or None if there is no usable record
+    :rtype: dict|None
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+class _MultipartUploadStream(object):
+    """
+    Write-only file object that uploads the data written to it as the parts of a multipart upload. See `open_s3_upload`.
+    """
+    def __init__(self, url, num_cores, s3_key_path, part_size):
+        self.bucket_name, self.key_name = _parse_s3_url(url)
+        with closing(_s3_connection()) as s3:
+            bucket = s3.get_bucket(self.bucket_name, validate=False)
+            self.headers = _sse_c_headers(s3_key_path, _s3_https_url(bucket, self.key_name)) if s3_key_path else {}
+        self.num_cores = num_cores
+        self.part_size = part_size
+        self.pool = ThreadPool(num_cores)
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        self.part_number = 0
+        self.upload_id = None
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.part_size:
+            self._submit()
+
+    def close(self):
+        """
+        Uploads the remaining data and completes the upload
+        """
+        from boto.s3.multipart import MultiPartUpload
+        try:
+            if self.upload_id is None:
+                with closing(_s3_connection()) as s3:
+                    key = s3.get_bucket(self.bucket_name, validate=False).new_key(self.key_name)
+                    key.set_contents_from_string(''.join(self.buffer), headers=self.headers)
+                return
+            if self.buffered:
+                self._submit()
+            while self.pending:
+                self.pending.popleft().get()
+            with closing(_s3_connection()) as s3:
+                mp = MultiPartUpload(s3.get_bucket(self.bucket_name, validate=False))
+                mp.key_name, mp.id = self.key_name, self.upload_id
+                mp.complete_upload()
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+    def abort(self):
+        """
+        Cancels the upload, deleting the parts that were uploaded
+        """
+        from boto.s3.multipart import MultiPartUpload
+        self.pool.terminate()
+        self.pool.join()
+        if self.upload_id is not None:
+            with closing(_s3_connection()) as s3:
+                mp = MultiPartUpload(s3.get_bucket(self.bucket_name, validate=False))
+                mp.key_name, mp.id = self.key_name, self.upload_id
+                mp.cancel_upload()
+            self.upload_id = None
+
+    def _submit(self):
+        if self.upload_id is None:
+            with closing(_s3_connection()) as s3:
+                bucket = s3.get_bucket(self.bucket_name, validate=False)
+                self.upload_id = bucket.initiate_multipart_upload(self.key_name, headers=self.headers).id
+        self.part_number += 1
+        if self.part_number > 10000:
+            raise RuntimeError('Upload to s3://{}/{} exceeds 10,000 parts, increase the part size'.format(
+                self.bucket_name, self.key_name))
+        part = ''.join(self.buffer)
+        self.buffer, self.buffered = [], 0
+        self.pending.append(self.pool.apply_async(self._upload_part, (self.part_number, part)))
+        # Bound the memory used by parts waiting to be uploaded
+        while len(self.pending) > self.num_cores:
+            self.pending.popleft().get()
+
+    def _upload_part(self, part_number, part):
+        from boto.s3.multipart import MultiPartUpload
+        for attempt in _retries(3):
+            with attempt:
+                with closing(_s3_connection()) as s3:
+                    mp = MultiPartUpload(s3.get_bucket(self.bucket_name, validate=False))
+                    mp.key_name, mp.id = self.key_name, self.upload_id
+                    mp.upload_part_from_file(StringIO(part), part_number, headers=self.headers, size=len(part))
+                return
+
+
+def _md5(f, length):
+    """
+    :param file f: File handle to read from, starting at its current position
+    :param int length: Number of bytes to read
+    :return: Hex MD5 digest of the bytes read
+    :rtype: str
+    """
+    md5 = hashlib.md5()
+    while length:
+        block = f.read(min(length, 1024 * 1024))
+        if not block:
+            break
+        md5.update(block)
+        length -= len(block)
+    return md5.hexdigest()
+
+
+def _s3_https_url(bucket, key_name):
+    """
+    HTTPS URL of an S3 object in the form its unique SSE-C key is derived from, see `_sse_c_key_url`
+
+    :param boto.s3.bucket.Bucket bucket: Bucket of the object
+    :param str key_name: Key name of the object
+    :return: HTTPS URL
+    :rtype: str
+    """
+    location = bucket.get_location()
+    return _s3_region_url(_legacy_locations.get(location, location), bucket.name, key_name)
+
+
+# Bucket location constraints that are not the name of the bucket's region
+_legacy_locations = {'': 'us-east-1', 'EU': 'eu-west-1'}
+
+_s3_host = re.compile(r'^(?:(?P<bucket>.+)\.)?s3(?:[.-]dualstack)?(?:[.-](?P<region>[a-z0-9-]+))?\.amazonaws\.com$')
+
+
+def _s3_region_url(region, bucket_name, key_name):
+    """
+    :param str region: AWS region of the bucket
+    :param str bucket_name: Name of the bucket
+    :param str key_name: Key name of the object
+    :return: Path-style HTTPS URL of an S3 object on the s3-REGION endpoint, the form S3AM derives SSE-C keys from
+    :rtype: str
+    """
+    host = 's3.amazonaws.com' if region == 'us-east-1' else 's3-{}.amazonaws.com'.format(region)
+    return 'https://{}/{}/{}'.format(host, bucket_name, key_name)
+
+
+def _sse_c_key_url(url):
+    """
+    Normalizes the HTTPS URL of an S3 object to the form its unique SSE-C key is derived from, so that an object
+    uploaded by `s3am_upload` or S3AM can be downloaded through any of its endpoints: s3-REGION, s3.REGION, dualstack
+    or virtual-hosted. URLs of other hosts are returned unchanged.
+
+    :param str url: URL of the object
+    :return: URL to derive the key from
+    :rtype: str
+    """
+    parsed = urlparse(url)
+    match = _s3_host.match(parsed.hostname or '') if parsed.scheme == 'https' else None
+    if match is None:
+        return url
+    region = match.group('region') or 'us-east-1'
+    region = 'us-east-1' if region == 'external-1' else region
+    path = parsed.path[1:]
+    if match.group('bucket'):
+        bucket_name, key_name = match.group('bucket'), path
+    elif '/' in path:
+        bucket_name, key_name = path.split('/', 1)
+    else:
+        return url
+    return _s3_region_url(region, bucket_name, key_name)
 
 
 def _generate_unique_key(master_key_path, url):
@@ -6,22 +6,22 @@ import multiprocessing
 import os
 import subprocess
 import sys
-import tarfile
 import textwrap
-from contextlib import closing
 from subprocess import PIPE
 from urlparse import urlparse
 
 import yaml
-from bd2k.util.files import mkdir_p
+from bd2k.util.humanize import human2bytes
 from bd2k.util.processes import which
 from toil.job import Job
 
 from toil_scripts.lib import require, UserError
-from toil_scripts.lib.files import copy_files
-from toil_scripts.lib.jobs import map_job
+from toil_scripts.lib.files import copy_files, consolidate_tarballs
+from toil_scripts.lib.jobs import map_job, prefetch_map_job, prefetch_waves
+from toil_scripts.lib.outputs import open_output, remove_finished_samples
+from toil_scripts.lib.programs import referenced_images
 from toil_scripts.lib.urls import download_url_job, s3am_upload
-from toil_scripts.tools.QC import run_fastqc
+from toil_scripts.tools.QC import run_fastqc, run_fastq_qc
 from toil_scripts.tools.aligners import run_star
 from toil_scripts.tools.preprocessing import run_cutadapt
 from toil_scripts.tools.quantifiers import run_kallisto, run_rsem, run_rsem_postprocess
@@ -38,31 +38,70 @@ def download_sample(job, sample, config):
     :param list sample: Information pertaining to a sample: filetype, paired/unpaired, UUID, and URL
     :param Namespace config: Argparse Namespace object containing argument inputs
     """
-    # Create copy of config that is sample specific
+    config = sample_config(sample, config)
+    # Inputs are streamed into the file store, so only GeneTorrent downloads need local disk
+    disk = '20G' if config.gtkey and not config.ci_test else '2G'
+    job.fileStore.logToMaster('UUID: {}\nURL: {}\nPaired: {}\nFile Type: {}\nCores: {}\nCIMode: {}'.format(
+        config.uuid, config.url, config.paired, config.file_type, config.cores, config.ci_test))
+    # Download or locate local file and place in the jobStore
+    ids = [job.addChildJobFn(download_url_job, url, cghub_key_path=config.gtkey, s3_key_path=config.ssec,
+                             stream=True, disk=disk).rv() for url in sample_urls(sample)]
+    job.addFollowOnJobFn(preprocessing_declaration, config, *input_ids(config, ids))
+
+
+def prefetch_sample(job, sample, config):
+    """
+    Downloads the inputs of a sample within the calling job, for use with `prefetch_map_job`
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list sample: Information pertaining to a sample: filetype, paired/unpaired, UUID, and URL
+    :param Namespace config: Argparse Namespace object containing argument inputs
+    :return: Arguments of preprocessing_declaration: sample specific config and FileStoreIDs of the inputs
+    :rtype: tuple(Namespace, str, str, str)
+    """
+    config = sample_config(sample, config)
+    ids = [download_url_job(job, url, cghub_key_path=config.gtkey, s3_key_path=config.ssec, stream=True)
+           for url in sample_urls(sample)]
+    return (config,) + input_ids(config, ids)
+
+
+def sample_config(sample, config):
+    """
+    :param list sample: Information pertaining to a sample: filetype, paired/unpaired, UUID, and URL
+    :param Namespace config: Argparse Namespace object containing argument inputs
+    :return: Copy of config that is sample specific
+    :rtype: Namespace
+    """
     config = argparse.Namespace(**vars(config))
     config.file_type, config.paired, config.uuid, config.url = sample
     config.paired = True if config.paired == 'paired' else False
     config.cores = min(config.maxCores, multiprocessing.cpu_count())
-    disk = '2G' if config.ci_test else '20G'
-    job.fileStore.logToMaster('UUID: {}\nURL: {}\nPaired: {}\nFile Type: {}\nCores: {}\nCIMode: {}'.format(
-        config.uuid, config.url, config.paired, config.file_type, config.cores, config.ci_test))
-    # Download or locate local file and place in the jobStore
-    tar_id, r1_id, r2_id = None, None, None
+    return config
+
+
+def sample_urls(sample):
+    """
+    :param list sample: Information pertaining to a sample: filetype, paired/unpaired, UUID, and URL
+    :return: Input URLs of the sample: a tarball, or one or two fastqs
+    :rtype: list[str]
+    """
+    file_type, paired, uuid, url = sample
+    if file_type == 'fq' and paired == 'paired':
+        require(len(url.split(',')) == 2, 'Fastq pairs must have 2 URLS separated by comma')
+        return url.split(',')
+    return [url]
+
+
+def input_ids(config, ids):
+    """
+    :param Namespace config: Sample specific config
+    :param list ids: FileStoreIDs of the sample inputs, in the order of `sample_urls`
+    :return: FileStoreIDs of the tarball, R1 and R2, or None for those the sample does not have
+    :rtype: tuple(str, str, str)
+    """
     if config.file_type == 'tar':
-        tar_id = job.addChildJobFn(download_url_job, config.url, cghub_key_path=config.gtkey,
-                                   s3_key_path=config.ssec, disk=disk).rv()
-    else:
-        if config.paired:
-            require(len(config.url.split(',')) == 2, 'Fastq pairs must have 2 URLS separated by comma')
-            r1_url, r2_url = config.url.split(',')
-            r1_id = job.addChildJobFn(download_url_job, r1_url, cghub_key_path=config.gtkey,
-                                      s3_key_path=config.ssec, disk=disk).rv()
-            r2_id = job.addChildJobFn(download_url_job, r2_url, cghub_key_path=config.gtkey,
-                                      s3_key_path=config.ssec, disk=disk).rv()
-        else:
-            r1_id = job.addChildJobFn(download_url_job, config.url, cghub_key_path=config.gtkey,
-                                      s3_key_path=config.ssec, disk=disk).rv()
-    job.addFollowOnJobFn(preprocessing_declaration, config, tar_id, r1_id, r2_id)
+        return ids[0], None, None
+    return None, ids[0], ids[1] if config.paired else None
 
 
 def preprocessing_declaration(job, config, tar_id, r1_id, r2_id):
@@ -100,7 +139,10 @@ def pipeline_declaration(job, config, preprocessing_output):
     r1_id, r2_id = preprocessing_output
     kallisto_output, rsem_output, fastqc_output = None, None, None
     disk = '2G' if config.ci_test else '40G'
-    if config.fastqc:
+    if config.fastqc == 'python':
+        job.fileStore.logToMaster('Queueing QC job for: ' + config.uuid)
+        fastqc_output = job.addChildJobFn(run_fastq_qc, r1_id, r2_id, cores=2, disk=disk).rv()
+    elif config.fastqc:
         job.fileStore.logToMaster('Queueing FastQC job for: ')
         fastqc_output = job.addChildJobFn(run_fastqc, r1_id, r2_id, cores=2, disk=disk).rv()
     if config.kallisto_index:
@@ -248,35 +290,33 @@ def consolidate_output(job, config, kallisto_output, rsem_output, fastqc_output)
     # I/O
     if not config.paired:
         config.uuid = 'SINGLE-END.{}'.format(config.uuid)
-    out_tar = os.path.join(work_dir, config.uuid + '.tar.gz')
-    # Consolidate separate tarballs into one as streams (avoids unnecessary untaring)
-    tar_list = [x for x in [rsem_tar, hugo_tar, kallisto_tar, fastqc_tar] if x is not None]
-    with tarfile.open(os.path.join(work_dir, out_tar), 'w:gz') as f_out:
-        for tar in tar_list:
-            with tarfile.open(tar, 'r') as f_in:
-                for tarinfo in f_in:
-                    with closing(f_in.extractfile(tarinfo)) as f_in_file:
-                        if tar == rsem_tar:
-                            tarinfo.name = os.path.join(config.uuid, 'RSEM', os.path.basename(tarinfo.name))
-                        elif tar == hugo_tar:
-                            tarinfo.name = os.path.join(config.uuid, 'RSEM', 'Hugo', os.path.basename(tarinfo.name))
-                        elif tar == kallisto_tar:
-                            tarinfo.name = os.path.join(config.uuid, 'Kallisto', os.path.basename(tarinfo.name))
-                        else:
-                            tarinfo.name = os.path.join(config.uuid, 'QC', os.path.basename(tarinfo.name))
-                        f_out.addfile(tarinfo, fileobj=f_in_file)
-    # Move to output directory
-    if config.output_dir:
-        job.fileStore.logToMaster('Moving {} to output dir: {}'.format(config.uuid, config.output_dir))
-        mkdir_p(config.output_dir)
-        copy_files(file_paths=[os.path.join(work_dir, config.uuid + '.tar.gz')], output_dir=config.output_dir)
-    # Upload to S3
-    if config.s3_output_dir:
-        job.fileStore.logToMaster('Uploading {} to S3: {}'.format(config.uuid, config.s3_output_dir))
-        s3am_upload(fpath=out_tar, s3_dir=config.s3_output_dir, num_cores=config.cores)
+    tars = [(rsem_tar, 'RSEM'), (hugo_tar, os.path.join('RSEM', 'Hugo')), (kallisto_tar, 'Kallisto'),
+            (fastqc_tar, 'QC')]
+    output_dirs = [x for x in [config.output_dir, config.s3_output_dir] if x]
+    job.fileStore.logToMaster('Writing {} to: {}'.format(config.uuid, ', '.join(output_dirs)))
+    # Consolidate separate tarballs into one, copying their compressed data where possible (avoids recompression),
+    # and stream it to the output directories
+    with open_output(config.uuid + '.tar.gz', output_dirs, num_cores=config.cores) as f_out:
+        consolidate_tarballs(f_out, [(tar, os.path.join(config.uuid, subdir)) for tar, subdir in tars if tar],
+                             num_cores=config.cores)
 
 
 # Pipeline specific functions
+def pipeline_images(config):
+    """
+    Docker images used by the pipeline with the given config
+
+    :param Namespace config: Argparse Namespace object containing argument inputs
+    :return: Names of the images
+    :rtype: list[str]
+    """
+    funcs = [run_cutadapt] if config.cutadapt else []
+    funcs += [run_fastqc] if config.fastqc and config.fastqc != 'python' else []
+    funcs += [run_kallisto] if config.kallisto_index else []
+    funcs += [star_alignment] if config.star_index and config.rsem_ref else []
+    return referenced_images(*funcs)
+
+
 def parse_samples(path_to_manifest=None, sample_urls=None):
     """
     Parses samples, specified in either a manifest or listed with --samples
@@ -309,6 +349,20 @@ def parse_samples(path_to_manifest=None, sample_urls=None):
     return samples
 
 
+def output_paths(sample, config):
+    """
+    Paths of the final output tarball of a sample, in the output directory and/or S3
+
+    :param list sample: Sample as parsed from the manifest
+    :param Namespace config: Argparse Namespace object containing argument inputs
+    :return: Output paths
+    :rtype: list[str]
+    """
+    file_type, paired, uuid, url = sample
+    name = uuid + '.tar.gz' if paired == 'paired' else 'SINGLE-END.{}.tar.gz'.format(uuid)
+    return [os.path.join(x, name) for x in [config.output_dir, config.s3_output_dir] if x]
+
+
 def generate_config():
     return textwrap.dedent("""
         # RNA-seq CGL Pipeline configuration file
@@ -337,7 +391,8 @@ def generate_config():
         # Optional: If true, will preprocess samples with cutadapt using adapter sequences.
         cutadapt: true
 
-        # Optional: If true, will run FastQC and include QC in sample output
+        # Optional: If true, will run FastQC and include QC in sample output. If python, will run the in-process
+        # QC engine instead, which requires numpy on the workers and writes a JSON summary and HTML report per mate.
         fastqc: true
 
         # Adapter sequence to trim. Defaults set for Illumina
@@ -433,7 +488,6 @@ def main():
     7 = Consoliate output and upload to S3
     =======================================
     Dependencies
-    Curl:       apt-get install curl
     Docker:     wget -qO- https://get.docker.com/ | sh
     Toil:       pip install toil
     Boto:       pip install boto (OPTIONAL)
@@ -459,6 +513,16 @@ def main():
                             'file:///full/path/to/file.tar. The UUID for the sample will be derived from the file.'
                             'Samples passed in this way will be assumed to be paired end, if using single-end data, '
                             'please use the manifest option.')
+    parser_run.add_argument('--rerun-finished', action='store_true',
+                            help='Rerun samples whose output tarball is already complete from a previous run. '
+                                 'By default these samples are skipped.')
+    parser_run.add_argument('--longest-first', action='store_true',
+                            help='Look up the size of every input before the run and start the samples with the '
+                                 'largest inputs first, so that they do not leave a long tail. Inputs whose size '
+                                 'cannot be looked up count as empty.')
+    parser_run.add_argument('--prefetch-budget', default=None, type=str,
+                            help='Download the inputs of the next samples while the current samples are processed, '
+                                 'using at most this much disk across the cluster for inputs (e.g. 500G).')
     # If no arguments provided, print full help menu
     if len(sys.argv) == 1:
         parser.print_help()
@@ -498,11 +562,26 @@ def main():
             require(urlparse(input).scheme in schemes,
                     'Input in config must have the appropriate URL prefix: {}'.format(schemes))
         # Program checks
-        for program in ['curl', 'docker']:
+        for program in ['docker']:
             require(next(which(program), None), program + ' must be installed on every node.'.format(program))
 
+        # Skip samples whose outputs are complete, so a rerun after failures only processes the failed samples
+        if not args.rerun_finished:
+            samples = remove_finished_samples(samples, lambda sample: output_paths(sample, config))
         # Start the workflow by using map_job() to run the pipeline for each sample
-        Job.Runner.startToil(Job.wrapJobFn(map_job, download_sample, samples, config), args)
+        if args.prefetch_budget:
+            waves = prefetch_waves(samples, sample_urls, human2bytes(args.prefetch_budget), s3_key_path=config.ssec)
+            disk = '20G' if config.gtkey and not config.ci_test else '2G'
+            root = Job.wrapJobFn(prefetch_map_job, prefetch_sample, preprocessing_declaration, waves, disk, config)
+        elif args.longest_first:
+            # Largest samples first, by the size of their inputs
+            root = Job.wrapJobFn(map_job, download_sample, samples, config, sample_urls=sample_urls,
+                                 s3_key_path=config.ssec)
+        else:
+            root = Job.wrapJobFn(map_job, download_sample, samples, config)
+        # The first tool call on each node pulls the tools' images in parallel (Toil passes the environment to jobs)
+        os.environ.setdefault('TOIL_SCRIPTS_DOCKER_IMAGES', ' '.join(pipeline_images(config)))
+        Job.Runner.startToil(root, args)
 
 
 if __name__ == '__main__':
@@ -31,7 +31,7 @@ from glob import glob
 
 from toil.job import Job
 
-from toil_scripts.lib.files import tarball_files
+from toil_scripts.lib.files import tarball_files_job
 from toil_scripts.lib.jobs import map_job
 from toil_scripts.lib.programs import docker_call
 from toil_scripts.lib.urls import s3am_upload_job
@@ -276,8 +276,7 @@ def variant_calling_and_qc(job, inputs, bam_id, bai_id):
     # Write output to fileStore and return ids
     output_tsv = glob(os.path.join(work_dir, '*counts.tsv*'))[0]
     output_vcf = os.path.join(work_dir, 'output.vcf.gz')
-    tarball_files('vcqc.tar.gz', file_paths=[output_tsv, output_vcf], output_dir=work_dir)
-    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'vcqc.tar.gz'))
+    return tarball_files_job(job, file_paths=[output_tsv, output_vcf])
 
 
 def spladder(job, inputs, bam_id, bai_id):
@@ -331,8 +330,7 @@ def spladder(job, inputs, bam_id, bai_id):
     output_filt = os.path.join(work_dir, 'alignment.filt.hdf5')
     output = os.path.join(work_dir, 'alignment.hdf5')
     print os.listdir(work_dir)
-    tarball_files('spladder.tar.gz', file_paths=[output_pickle, output_filt, output], output_dir=work_dir)
-    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'spladder.tar.gz'))
+    return tarball_files_job(job, file_paths=[output_pickle, output_filt, output])
 
 
 def consolidate_output_tarballs(job, inputs, vcqc_id, spladder_id):
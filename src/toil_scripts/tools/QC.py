@@ -1,6 +1,7 @@
 import os
 
-from toil_scripts.lib.files import tarball_files
+from toil_scripts.lib.fastq_qc import fastq_qc_files
+from toil_scripts.lib.files import tarball_files_job
 from toil_scripts.lib.programs import docker_call
 
 
@@ -25,5 +26,26 @@ def run_fastqc(job, r1_id, r2_id):
     docker_call(tool='quay.io/ucsc_cgl/fastqc:0.11.5--be13567d00cd4c586edf8ae47d991815c8c72a49',
                 work_dir=work_dir, parameters=parameters)
     output_files = [os.path.join(work_dir, x) for x in output_names]
-    tarball_files(tar_name='fastqc.tar.gz', file_paths=output_files, output_dir=work_dir)
-    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'fastqc.tar.gz'))
+    return tarball_files_job(job, file_paths=output_files)
+
+
+def run_fastq_qc(job, r1_id, r2_id):
+    """
+    Quality control of the input reads in process, with `toil_scripts.lib.fastq_qc`, as an alternative to FastQC.
+    Each mate is read once, in a worker process of its own, from the file store's copy rather than from a copy of
+    its own.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str r1_id: FileStoreID of fastq read 1
+    :param str r2_id: FileStoreID of fastq read 2
+    :return: FileStoreID of the QC output (tarball of a JSON summary and HTML report per mate)
+    :rtype: str
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    paths = [job.fileStore.readGlobalFile(r1_id)]
+    names = ['R1']
+    if r2_id:
+        paths.append(job.fileStore.readGlobalFile(r2_id))
+        names.append('R2')
+    output_files = fastq_qc_files(paths, work_dir, names=names)
+    return tarball_files_job(job, file_paths=output_files)
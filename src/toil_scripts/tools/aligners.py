@@ -1,9 +1,7 @@
 import os
 
-import subprocess
-
 from toil_scripts.lib.programs import docker_call
-from toil_scripts.lib.urls import download_url
+from toil_scripts.lib.urls import mounted_url
 
 
 def run_star(job, cores, r1_id, r2_id, star_index_url, wiggle=False):
@@ -20,14 +18,8 @@ def run_star(job, cores, r1_id, r2_id, star_index_url, wiggle=False):
     :rtype: str
     """
     work_dir = job.fileStore.getLocalTempDir()
-    download_url(url=star_index_url, name='starIndex.tar.gz', work_dir=work_dir)
-    subprocess.check_call(['tar', '-xvf', os.path.join(work_dir, 'starIndex.tar.gz'), '-C', work_dir])
-    os.remove(os.path.join(work_dir, 'starIndex.tar.gz'))
-    # Determine tarball structure - star index contains are either in a subdir or in the tarball itself
-    star_index = os.path.join('/data', os.listdir(work_dir)[0]) if len(os.listdir(work_dir)) == 1 else '/data'
     # Parameter handling for paired / single-end data
     parameters = ['--runThreadN', str(cores),
-                  '--genomeDir', star_index,
                   '--outFileNamePrefix', 'rna',
                   '--outSAMtype', 'BAM', 'SortedByCoordinate',
                   '--outSAMunmapped', 'Within',
@@ -54,9 +46,14 @@ def run_star(job, cores, r1_id, r2_id, star_index_url, wiggle=False):
     else:
         job.fileStore.readGlobalFile(r1_id, os.path.join(work_dir, 'R1_cutadapt.fastq'))
         parameters.extend(['--readFilesIn', '/data/R1.fastq'])
-    # Call: STAR Mapping
-    docker_call(tool='quay.io/ucsc_cgl/star:2.4.2a--bcbd5122b69ff6ac4ef61958e47bde94001cfe80',
-                work_dir=work_dir, parameters=parameters)
+    # The index is mounted from the node-local cache if there is one, and extracted into work_dir otherwise
+    with mounted_url(star_index_url, work_dir, 'star_index', extract=True) as (index_dir, mounts):
+        # Determine tarball structure - star index contains are either in a subdir or in the tarball itself
+        contents = os.listdir(index_dir)
+        star_index = os.path.join('/data/star_index', contents[0]) if len(contents) == 1 else '/data/star_index'
+        # Call: STAR Mapping
+        docker_call(tool='quay.io/ucsc_cgl/star:2.4.2a--bcbd5122b69ff6ac4ef61958e47bde94001cfe80',
+                    work_dir=work_dir, parameters=['--genomeDir', star_index] + parameters, mounts=mounts)
     # Write to fileStore
     transcriptome_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'rnaAligned.toTranscriptome.out.bam'))
     sorted_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'rnaAligned.sortedByCoord.out.bam'))
@@ -37,6 +37,6 @@ def run_samtools_faidx(job, ref_id):
     work_dir = job.fileStore.getLocalTempDir()
     job.fileStore.readGlobalFile(ref_id, os.path.join(work_dir, 'ref.fasta'))
     command = ['faidx', '/data/ref.fasta']
-    docker_call(work_dir=work_dir, parameters=command,
-                tool='quay.io/ucsc_cgl/samtools:0.1.19--dd5ac549b95eb3e5d166a5e310417ef13651994e')
+    docker_call(work_dir=work_dir, parameters=command, inputs=['ref.fasta'], outputs={'ref.fasta.fai': None},
+                tool='quay.io/ucsc_cgl/samtools:0.1.19--dd5ac549b95eb3e5d166a5e310417ef13651994e', memoize=True)
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'ref.fasta.fai'))
@@ -2,7 +2,7 @@ import os
 from glob import glob
 
 from toil_scripts.tools import get_mean_insert_size
-from toil_scripts.lib.files import tarball_files
+from toil_scripts.lib.files import tarball_files_job
 from toil_scripts.lib.programs import docker_call
 
 
@@ -46,8 +46,7 @@ def run_mutect(job, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, ref_dict,
     # Write output to file store
     output_file_names = ['mutect.vcf', 'mutect.cov', 'mutect.out']
     output_file_paths = [os.path.join(work_dir, x) for x in output_file_names]
-    tarball_files('mutect.tar.gz', file_paths=output_file_paths, output_dir=work_dir)
-    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'mutect.tar.gz'))
+    return tarball_files_job(job, file_paths=output_file_paths)
 
 
 def run_muse(job, cores, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, ref_dict, fai, dbsnp):
@@ -87,8 +86,7 @@ def run_muse(job, cores, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, ref_
     docker_call(tool='quay.io/ucsc_cgl/muse:1.0--6add9b0a1662d44fd13bbc1f32eac49326e48562',
                 work_dir=work_dir, parameters=parameters)
     # Return fileStore ID
-    tarball_files('muse.tar.gz', file_paths=[os.path.join(work_dir, 'muse.vcf')], output_dir=work_dir)
-    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'muse.tar.gz'))
+    return tarball_files_job(job, file_paths=[os.path.join(work_dir, 'muse.vcf')])
 
 
 def run_pindel(job, cores, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, fai):
@@ -127,5 +125,4 @@ def run_pindel(job, cores, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, fa
                 work_dir=work_dir, parameters=parameters)
     # Collect output files and write to file store
     output_files = glob(os.path.join(work_dir, 'pindel*'))
-    tarball_files('pindel.tar.gz', file_paths=output_files, output_dir=work_dir)
-    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'pindel.tar.gz'))
+    return tarball_files_job(job, file_paths=output_files)
@@ -58,8 +58,8 @@ def run_samtools_faidx(job, ref_id):
     work_dir = job.fileStore.getLocalTempDir()
     job.fileStore.readGlobalFile(ref_id, os.path.join(work_dir, 'ref.fasta'))
     command = ['faidx', 'ref.fasta']
-    docker_call(work_dir=work_dir, parameters=command,
-                tool='quay.io/ucsc_cgl/samtools:0.1.19--dd5ac549b95eb3e5d166a5e310417ef13651994e')
+    docker_call(work_dir=work_dir, parameters=command, inputs=['ref.fasta'], outputs={'ref.fasta.fai': None},
+                tool='quay.io/ucsc_cgl/samtools:0.1.19--dd5ac549b95eb3e5d166a5e310417ef13651994e', memoize=True)
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'ref.fasta.fai'))
 
 
@@ -95,8 +95,8 @@ def run_picard_create_sequence_dictionary(job, ref_id):
     work_dir = job.fileStore.getLocalTempDir()
     job.fileStore.readGlobalFile(ref_id, os.path.join(work_dir, 'ref.fasta'))
     command = ['CreateSequenceDictionary', 'R=ref.fasta', 'O=ref.dict']
-    docker_call(work_dir=work_dir, parameters=command,
-                tool='quay.io/ucsc_cgl/picardtools:1.95--dd5ac549b95eb3e5d166a5e310417ef13651994e')
+    docker_call(work_dir=work_dir, parameters=command, inputs=['ref.fasta'], outputs={'ref.dict': None},
+                tool='quay.io/ucsc_cgl/picardtools:1.95--dd5ac549b95eb3e5d166a5e310417ef13651994e', memoize=True)
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'ref.dict'))
 
 
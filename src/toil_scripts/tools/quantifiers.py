@@ -1,10 +1,8 @@
 import os
 
-import subprocess
-
-from toil_scripts.lib.files import tarball_files
+from toil_scripts.lib.files import tarball_files_job
 from toil_scripts.lib.programs import docker_call
-from toil_scripts.lib.urls import download_url
+from toil_scripts.lib.urls import mounted_url
 
 
 def run_kallisto(job, cores, r1_id, r2_id, kallisto_index_url):
@@ -20,7 +18,6 @@ def run_kallisto(job, cores, r1_id, r2_id, kallisto_index_url):
     :rtype: str
     """
     work_dir = job.fileStore.getLocalTempDir()
-    download_url(url=kallisto_index_url, name='kallisto_hg38.idx', work_dir=work_dir)
     # Retrieve files
     parameters = ['quant',
                   '-i', '/data/kallisto_hg38.idx',
@@ -35,13 +32,13 @@ def run_kallisto(job, cores, r1_id, r2_id, kallisto_index_url):
         job.fileStore.readGlobalFile(r1_id, os.path.join(work_dir, 'R1_cutadapt.fastq'))
         parameters.extend(['--single', '-l', '200', '-s', '15', '/data/R1_cutadapt.fastq'])
 
-    # Call: Kallisto
-    docker_call(tool='quay.io/ucsc_cgl/kallisto:0.42.4--35ac87df5b21a8e8e8d159f26864ac1e1db8cf86',
-                work_dir=work_dir, parameters=parameters)
+    # Call: Kallisto, with the index mounted from the node-local cache if there is one
+    with mounted_url(kallisto_index_url, work_dir, 'kallisto_hg38.idx') as (_, mounts):
+        docker_call(tool='quay.io/ucsc_cgl/kallisto:0.42.4--35ac87df5b21a8e8e8d159f26864ac1e1db8cf86',
+                    work_dir=work_dir, parameters=parameters, mounts=mounts)
     # Tar output files together and store in fileStore
     output_files = [os.path.join(work_dir, x) for x in ['run_info.json', 'abundance.tsv', 'abundance.h5']]
-    tarball_files(tar_name='kallisto.tar.gz', file_paths=output_files, output_dir=work_dir)
-    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'kallisto.tar.gz'))
+    return tarball_files_job(job, file_paths=output_files, num_cores=cores)
 
 
 def run_rsem(job, cores, bam_id, rsem_ref_url, paired=True):
@@ -57,33 +54,33 @@ def run_rsem(job, cores, bam_id, rsem_ref_url, paired=True):
     :rtype: str
     """
     work_dir = job.fileStore.getLocalTempDir()
-    download_url(url=rsem_ref_url, name='rsem_ref.tar.gz', work_dir=work_dir)
-    subprocess.check_call(['tar', '-xvf', os.path.join(work_dir, 'rsem_ref.tar.gz'), '-C', work_dir])
-    os.remove(os.path.join(work_dir, 'rsem_ref.tar.gz'))
-    # Determine tarball structure - based on it, ascertain folder name and rsem reference prefix
-    rsem_files = []
-    for root, directories, files in os.walk(work_dir):
-        rsem_files.extend([os.path.join(root, x) for x in files])
-    # "grp" is a required RSEM extension that should exist in the RSEM reference
-    ref_prefix = [os.path.basename(os.path.splitext(x)[0]) for x in rsem_files if 'grp' in x][0]
-    ref_folder = os.path.join('/data', os.listdir(work_dir)[0]) if len(os.listdir(work_dir)) == 1 else '/data'
     # I/O
     job.fileStore.readGlobalFile(bam_id, os.path.join(work_dir, 'transcriptome.bam'))
     output_prefix = 'rsem'
-    # Call: RSEM
-    parameters = ['--quiet',
-                  '--no-qualities',
-                  '-p', str(cores),
-                  '--forward-prob', '0.5',
-                  '--seed-length', '25',
-                  '--fragment-length-mean', '-1.0',
-                  '--bam', '/data/transcriptome.bam',
-                  os.path.join(ref_folder, ref_prefix),
-                  output_prefix]
-    if paired:
-        parameters = ['--paired-end'] + parameters
-    docker_call(tool='quay.io/ucsc_cgl/rsem:1.2.25--d4275175cc8df36967db460b06337a14f40d2f21',
-                parameters=parameters, work_dir=work_dir)
+    # The reference is mounted from the node-local cache if there is one, and extracted into work_dir otherwise
+    with mounted_url(rsem_ref_url, work_dir, 'rsem_ref', extract=True) as (ref_dir, mounts):
+        # Determine tarball structure - based on it, ascertain folder name and rsem reference prefix
+        rsem_files = []
+        for root, directories, files in os.walk(ref_dir):
+            rsem_files.extend([os.path.join(root, x) for x in files])
+        # "grp" is a required RSEM extension that should exist in the RSEM reference
+        ref_prefix = [os.path.basename(os.path.splitext(x)[0]) for x in rsem_files if 'grp' in x][0]
+        contents = os.listdir(ref_dir)
+        ref_folder = os.path.join('/data/rsem_ref', contents[0]) if len(contents) == 1 else '/data/rsem_ref'
+        # Call: RSEM
+        parameters = ['--quiet',
+                      '--no-qualities',
+                      '-p', str(cores),
+                      '--forward-prob', '0.5',
+                      '--seed-length', '25',
+                      '--fragment-length-mean', '-1.0',
+                      '--bam', '/data/transcriptome.bam',
+                      os.path.join(ref_folder, ref_prefix),
+                      output_prefix]
+        if paired:
+            parameters = ['--paired-end'] + parameters
+        docker_call(tool='quay.io/ucsc_cgl/rsem:1.2.25--d4275175cc8df36967db460b06337a14f40d2f21',
+                    parameters=parameters, work_dir=work_dir, mounts=mounts)
     os.rename(os.path.join(work_dir, output_prefix + '.genes.results'), os.path.join(work_dir, 'rsem_gene.tab'))
     os.rename(os.path.join(work_dir, output_prefix + '.isoforms.results'), os.path.join(work_dir, 'rsem_isoform.tab'))
     # Write to FileStore
@@ -122,8 +119,6 @@ def run_rsem_postprocess(job, uuid, rsem_gene_id, rsem_isoform_id):
     docker_call(tool='jvivian/gencode_hugo_mapping', parameters=command, work_dir=work_dir)
     hugo_files = [os.path.splitext(x)[0] + '.hugo' + os.path.splitext(x)[1] for x in genes + isoforms]
     # Create tarballs for outputs
-    tarball_files('rsem.tar.gz', file_paths=[os.path.join(work_dir, x) for x in output_files], output_dir=work_dir)
-    tarball_files('rsem_hugo.tar.gz', [os.path.join(work_dir, x) for x in hugo_files], output_dir=work_dir)
-    rsem_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'rsem.tar.gz'))
-    hugo_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'rsem_hugo.tar.gz'))
+    rsem_id = tarball_files_job(job, file_paths=[os.path.join(work_dir, x) for x in output_files])
+    hugo_id = tarball_files_job(job, file_paths=[os.path.join(work_dir, x) for x in hugo_files])
     return rsem_id, hugo_id